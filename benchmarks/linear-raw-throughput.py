@@ -15,7 +15,13 @@ def usage(f):
     f.write("  --use-p2p            Use P2P links, to avoid bridging\n")
     f.write("  --delay=SECS         Add delay emulation in links\n")
     f.write("  --jitter=PERCENT     Add jitter emulation in links\n")
-    f.write("  --bandwidth=BPS      Maximum bandwidth of links\n\n")
+    f.write("  --bandwidth=BPS      Maximum bandwidth of links\n")
+    f.write("  --queues=NUM         Number of transmit and receive queues " +
+            "of each interface\n")
+    f.write("  --txqueuelen=NUM     Transmit queue length of each " +
+            "interface\n")
+    f.write("  --offloads=on|off    Turn GSO, GRO and TSO on or off in " +
+            "every interface\n\n")
 
     f.write("Test specification:\n")
     f.write(" Parameters take single values or ranges of falues in the form " +
@@ -40,12 +46,14 @@ def main():
     try:
         opts, args = getopt.getopt(sys.argv[1:], "hn:s:t:p:b:", [
             "help", "nodes=", "pktsize=", "time=", "packets=", "bytes=",
-            "use-p2p", "delay=", "jitter=", "bandwidth=", "format=" ])
+            "use-p2p", "delay=", "jitter=", "bandwidth=", "queues=",
+            "txqueuelen=", "offloads=", "format=" ])
     except getopt.GetoptError as err:
         error = str(err) # opts will be empty
 
     pktsize = nr = time = packets = nbytes = None
     delay = jitter = bandwidth = None
+    queues = txqueuelen = offloads = None
     use_p2p = False
     format = "verbose"
 
@@ -72,6 +80,16 @@ def main():
             jitter = float(a)
         elif o in ("--bandwidth"):
             bandwidth = float(a)
+        elif o == "--queues":
+            queues = int(a)
+        elif o == "--txqueuelen":
+            txqueuelen = int(a)
+        elif o == "--offloads":
+            if a not in ("on", "off"):
+                error = "Invalid value for %s: %s" % (o, a)
+                break
+            offloads = (a == "on")
+            continue
         elif o in ("--use-p2p"):
             use_p2p = True
             continue # avoid the value check
@@ -94,8 +112,6 @@ def main():
             error = "Missing mandatory --nodes argument"
         elif not pktsize:
             error = "Missing mandatory --pktsize argument"
-        elif use_p2p and (delay or jitter or bandwidth):
-            error = "Cannot use links emulation with P2P links"
 
     if error:
         sys.stderr.write("%s: %s\n" % (os.path.basename(sys.argv[0]), error))
@@ -112,8 +128,13 @@ def main():
     if not udp_perf:
         raise RuntimeError("Cannot find `udp-perf'")
 
+    options = {}
+    if txqueuelen:
+        options["txqueuelen"] = txqueuelen
+    if offloads is not None:
+        options["gso"] = options["gro"] = options["tso"] = offloads
     nodes, interfaces, links = create_topo(nr, use_p2p, delay, jitter,
-            bandwidth)
+            bandwidth, queues, options)
 
     cmdline = [udp_perf, "--server"]
     if time:
@@ -139,7 +160,7 @@ def main():
             r = os.read(srv.stdout.fileno(), 1024)
             if not r:
                 break
-            out += r
+            out += r.decode()
         if srv.poll() is not None or clt.poll() is not None:
             break
 
@@ -169,11 +190,15 @@ def main():
     data["cfg_dly"] = delay if delay else ""
     data["cfg_bw"] = bandwidth if bandwidth else ""
     data["cfg_jit"] = jitter if jitter else ""
+    data["cfg_queues"] = queues if queues else ""
+    data["cfg_txqlen"] = txqueuelen if txqueuelen else ""
+    data["cfg_offloads"] = "" if offloads is None else int(offloads)
 
     res = []
     for i in ["nodes", "bridge", "cfg_dly", "cfg_bw", "cfg_jit",
             "brx", "prx", "pksz", "plsz", "err", "mind", "avgd",
-            "maxd", "jit", "time"]:
+            "maxd", "jit", "time", "cfg_queues", "cfg_txqlen",
+            "cfg_offloads"]:
         res.append(data[i])
 
     writer = csv.writer(sys.stdout)
@@ -192,7 +217,7 @@ def dec2ip(dec):
         dec >>= 8
     return "%d.%d.%d.%d" % tuple(res)
 
-def create_topo(n, p2p, delay, jitter, bw):
+def create_topo(n, p2p, delay, jitter, bw, queues = None, options = {}):
     nodes = []
     interfaces = []
     links = []
@@ -201,7 +226,9 @@ def create_topo(n, p2p, delay, jitter, bw):
     if p2p:
         interfaces = [[None]]
         for i in range(n - 1):
-            a, b = nemu.P2PInterface.create_pair(nodes[i], nodes[i + 1])
+            a, b = nemu.P2PInterface.create_pair(nodes[i], nodes[i + 1],
+                    bandwidth = bw, delay = delay, delay_jitter = jitter,
+                    numtxqueues = queues, numrxqueues = queues, **options)
             interfaces[i].append(a)
             interfaces.append([])
             interfaces[i + 1] = [b]
@@ -209,21 +236,23 @@ def create_topo(n, p2p, delay, jitter, bw):
     else:
         for i in range(n):
             if i > 0:
-                left = nodes[i].add_if()
+                left = nodes[i].add_if(numtxqueues = queues,
+                        numrxqueues = queues, **options)
             else:
                 left = None
             if i < n - 1:
-                right = nodes[i].add_if()
+                right = nodes[i].add_if(numtxqueues = queues,
+                        numrxqueues = queues, **options)
             else:
                 right = None
             interfaces.append((left, right))
         for i in range(n - 1):
-            links = nemu.Switch(bandwidth = bw, delay = delay,
+            link = nemu.Switch(bandwidth = bw, delay = delay,
                     delay_jitter = jitter)
-            links.up = True
-            links.connect(interfaces[i][1])
-            links.connect(interfaces[i + 1][0])
-            links.append(links)
+            link.up = True
+            link.connect(interfaces[i][1], **options)
+            link.connect(interfaces[i + 1][0], **options)
+            links.append(link)
 
     for i in range(n):
         for j in (0, 1):
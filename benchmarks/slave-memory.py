@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# vim: ts=4:sw=4:et:ai:sts=4
+
+import gc, getopt, nemu, os, os.path, sys, time
+
+__doc__ = """Creates a number of nodes and reports the memory used by each
+node's slave process, as read from /proc/PID/smaps_rollup. The proportional
+set size (PSS) is the figure to look at: it splits pages shared between
+processes, so the sum over all slaves is their real cost."""
+
+def usage(f):
+    f.write("Usage: %s [OPTIONS]\n%s\n\n" %
+            (os.path.basename(sys.argv[0]), __doc__))
+
+    f.write("  -n, --nodes=NUM      Number of nodes to create (default 10)\n")
+    f.write("  --lean               Use lean (exec'd) slaves instead of " +
+            "forks of the controller\n")
+    f.write("  --ballast=MB         Grow the controller heap by roughly MB " +
+            "megabytes before\n" +
+            "                       creating the nodes, to emulate a big " +
+            "controller\n")
+    f.write("  --churn              Replace the ballast after the nodes " +
+            "are created, as a\n" +
+            "                       long-running controller would do " +
+            "with its data\n")
+    f.write("  --format=FMT         Valid values are `csv', `brief', " +
+            "and `verbose'\n")
+
+def smaps_rollup(pid):
+    """Return a dictionary with the values (in kB) from smaps_rollup."""
+    res = {}
+    with open("/proc/%d/smaps_rollup" % pid) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == "kB":
+                res[fields[0].rstrip(":")] = int(fields[1])
+    return res
+
+def main():
+    error = None
+    opts = []
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:", [
+            "help", "nodes=", "lean", "ballast=", "churn", "format=" ])
+    except getopt.GetoptError as err:
+        error = str(err) # opts will be empty
+
+    nr = 10
+    lean = churn = False
+    ballast = 0
+    format = "verbose"
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage(sys.stdout)
+            sys.exit(0)
+        elif o in ("-n", "--nodes"):
+            nr = int(a)
+            if nr <= 0:
+                error = "Invalid value for %s: %s" % (o, a)
+                break
+        elif o == "--lean":
+            lean = True
+        elif o == "--churn":
+            churn = True
+        elif o == "--ballast":
+            ballast = int(a)
+            if ballast < 0:
+                error = "Invalid value for %s: %s" % (o, a)
+                break
+        elif o == "--format":
+            if a not in ('csv', 'brief', 'verbose'):
+                error = "Invalid value for %s: %s" % (o, a)
+                break
+            format = a
+        else:
+            raise RuntimeError("Cannot happen")
+
+    if not error and args:
+        error = "Unknown argument(s): %s" % " ".join(args)
+
+    if error:
+        sys.stderr.write("%s: %s\n" % (os.path.basename(sys.argv[0]), error))
+        sys.stderr.write("Try `%s --help' for more information.\n" %
+                os.path.basename(sys.argv[0]))
+        sys.exit(2)
+
+    # Lots of small objects, like a real controller would accumulate.
+    def make_heap():
+        return [[i] for i in range(ballast * 1024 * 1024 // 88)]
+    heap = make_heap()
+
+    start = time.time()
+    nodes = [nemu.Node(lean = lean) for i in range(nr)]
+    elapsed = time.time() - start
+
+    # Exercise the slaves a bit, so copy-on-write pages get touched as they
+    # would during a normal emulation.
+    for node in nodes:
+        for i in range(10):
+            node.system(["true"])
+        node.get_interfaces()
+    if churn:
+        # Pages freed or rewritten by the controller stay alive, now
+        # private, in every forked slave.
+        heap = None
+        gc.collect()
+        heap = make_heap()
+    gc.collect()
+
+    keys = ("Rss", "Pss", "Private_Clean", "Private_Dirty")
+    total = dict((k, 0) for k in keys)
+    for node in nodes:
+        data = smaps_rollup(node.pid)
+        for k in keys:
+            total[k] += data[k]
+    avg = dict((k, total[k] / nr) for k in keys)
+    private = avg["Private_Clean"] + avg["Private_Dirty"]
+
+    if format == "csv":
+        print("%d,%d,%d,%d,%.1f,%.1f,%.1f,%.4f" % (nr, int(lean), ballast,
+            int(churn), avg["Rss"], avg["Pss"], private, elapsed / nr))
+    elif format == "brief":
+        print("%d %.1f" % (nr, avg["Pss"]))
+    else:
+        print("Nodes: %d, slave: %s, controller ballast: %d MB%s" % (nr,
+            "lean" if lean else "fork", ballast, " (churned)" if churn else ""))
+        print("Per-node slave memory (kB): rss %.1f, pss %.1f, "
+                "private %.1f" % (avg["Rss"], avg["Pss"], private))
+        print("Node creation time: %.4f s per node" % (elapsed / nr))
+
+    del heap
+    for node in nodes:
+        node.destroy()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# vim:ts=4:sw=4:et:ai:sts=4
+# -*- coding: utf-8 -*-
+
+# Copyright 2010, 2011 INRIA
+# Copyright 2011 Martina Ferrari <tina@tina.pm>
+#
+# This file is part of Nemu.
+#
+# Nemu is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 2, as published by the Free
+# Software Foundation.
+#
+# Nemu is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nemu.  If not, see <http://www.gnu.org/licenses/>.
+
+"""asyncio interface to processes running inside nemu nodes.
+
+Mirrors asyncio.subprocess: create_subprocess_exec() and
+create_subprocess_shell() start a program through nemu.subprocess_.Popen, and
+return a Process whose pipes are asyncio streams. Exit is detected on the
+process descriptor, so a single event loop can wait for any number of
+processes without threads or polling."""
+
+import asyncio
+import os
+import signal
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from nemu import Node
+from nemu.subprocess_ import PIPE, STDOUT, DEVNULL, Popen
+
+__all__ = ['PIPE', 'STDOUT', 'DEVNULL', 'Process', 'create_subprocess_exec',
+           'create_subprocess_shell']
+
+# Same as asyncio's default buffer limit for stream readers.
+_DEFAULT_LIMIT = 2 ** 16
+
+
+class Process(object):
+    """A process started by create_subprocess_exec() or
+    create_subprocess_shell(); see asyncio.subprocess.Process. The stdin,
+    stdout, and stderr attributes are StreamWriter/StreamReader objects for
+    the PIPE'd descriptors, or None."""
+
+    def __init__(self, popen: Popen, loop: asyncio.AbstractEventLoop):
+        self._popen = popen
+        self._loop = loop
+        self._exited = None
+        self.stdin = self.stdout = self.stderr = None
+
+    async def _connect(self, limit: int):
+        popen, loop = self._popen, self._loop
+        if popen.stdin is not None:
+            # Only for its flow control: the reader is never used
+            transport, protocol = await loop.connect_write_pipe(
+                lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()),
+                popen.stdin)
+            self.stdin = asyncio.StreamWriter(transport, protocol, None, loop)
+        for k in ("stdout", "stderr"):
+            pipe = getattr(popen, k)
+            if pipe is None:
+                continue
+            reader = asyncio.StreamReader(limit=limit)
+            await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), pipe)
+            setattr(self, k, reader)
+        # The transports own the pipes now
+        popen.stdin = popen.stdout = popen.stderr = None
+
+    @property
+    def pid(self) -> int:
+        return self._popen.pid
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._popen.returncode
+
+    def send_signal(self, sig):
+        self._popen.signal(sig)
+
+    def terminate(self):
+        self._popen.signal(signal.SIGTERM)
+
+    def kill(self):
+        self._popen.signal(signal.SIGKILL)
+
+    async def wait(self) -> int:
+        """Waits for the process to finish and returns the exit code."""
+        popen = self._popen
+        if popen.poll() is not None:
+            return popen.returncode
+        try:
+            fd = popen.fileno()
+        except RuntimeError:
+            # No process descriptor, nothing to wait on
+            while popen.poll() is None:
+                await asyncio.sleep(0.1)
+            return popen.returncode
+        if self._exited is None:
+            # Shared by all waiters: there can only be one reader per fd.
+            # Our own copy, as the Popen closes its own once it reaps the
+            # process, which might happen before we are notified.
+            fd = os.dup(fd)
+            self._exited = self._loop.create_future()
+            self._loop.add_reader(fd, self._on_exit, fd)
+        await asyncio.shield(self._exited)
+        return popen.wait()
+
+    def _on_exit(self, fd: int):
+        self._loop.remove_reader(fd)
+        os.close(fd)
+        if not self._exited.done():
+            self._exited.set_result(None)
+
+    async def _feed_stdin(self, input: Optional[bytes]):
+        if input:
+            self.stdin.write(input)
+            try:
+                await self.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # The program does not want more input
+                pass
+        self.stdin.close()
+
+    async def _noop(self):
+        return None
+
+    async def communicate(self, input: Optional[bytes] = None
+                          ) -> tuple[Optional[bytes], Optional[bytes]]:
+        """See asyncio.subprocess.Process.communicate."""
+        if isinstance(input, str):
+            input = input.encode("utf-8")
+        stdin = self._feed_stdin(input) if self.stdin else self._noop()
+        stdout = self.stdout.read() if self.stdout else self._noop()
+        stderr = self.stderr.read() if self.stderr else self._noop()
+        stdin, stdout, stderr = await asyncio.gather(stdin, stdout, stderr)
+        await self.wait()
+        return (stdout, stderr)
+
+
+async def create_subprocess_exec(node: "Node", program: str, *args,
+                                 stdin=None, stdout=None, stderr=None,
+                                 limit: int = _DEFAULT_LIMIT,
+                                 **kwargs) -> Process:
+    """Starts `program' inside `node', with arguments `args'. Other keyword
+    arguments are passed to nemu.subprocess_.Popen. Note that the program is
+    started synchronously: that takes a short exchange with the node."""
+    loop = asyncio.get_running_loop()
+    popen = Popen(node, [program] + list(args), stdin=stdin, stdout=stdout,
+                  stderr=stderr, **kwargs)
+    process = Process(popen, loop)
+    await process._connect(limit)
+    return process
+
+
+async def create_subprocess_shell(node: "Node", cmd: str,
+                                  stdin=None, stdout=None, stderr=None,
+                                  limit: int = _DEFAULT_LIMIT,
+                                  **kwargs) -> Process:
+    """Like create_subprocess_exec, running `cmd' with `/bin/sh'."""
+    loop = asyncio.get_running_loop()
+    popen = Popen(node, cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                  shell=True, **kwargs)
+    process = Process(popen, loop)
+    await process._connect(limit)
+    return process
@@ -0,0 +1,192 @@
+# vim:ts=4:sw=4:et:ai:sts=4
+# -*- coding: utf-8 -*-
+
+# Copyright 2010, 2011 INRIA
+# Copyright 2011 Martina Ferrari <tina@tina.pm>
+#
+# This file is part of Nemu.
+#
+# Nemu is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 2, as published by the Free
+# Software Foundation.
+#
+# Nemu is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nemu.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Control groups (cgroup v2) for nodes.
+
+Each Cgroup is created under a common `nemu' group, below the root of the
+cgroup2 hierarchy, so resource controllers can be enabled for it. Processes
+are placed in it by nemu.subprocess_.spawn, before executing the program."""
+
+import errno
+import os
+import signal
+import time
+from typing import Optional
+
+from nemu.environ import *
+
+__all__ = ['Cgroup', 'find_mount']
+
+# Group that holds the ones created by nemu, under the root of the hierarchy.
+BASE = "nemu"
+
+# Controllers used, when available.
+CONTROLLERS = ("cpu", "cpuset", "memory")
+
+# Period for CPU quotas, in microseconds (the kernel default).
+CPU_PERIOD = 100000
+
+
+def find_mount() -> Optional[str]:
+    """Returns where the cgroup2 hierarchy is mounted, or None."""
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            # Optional fields end with a single dash
+            fields = line.split()
+            sep = fields.index("-")
+            if fields[sep + 1] == "cgroup2":
+                return fields[4]
+    return None
+
+
+def _read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def _write(path: str, value: str):
+    with open(path, "w") as f:
+        f.write(value)
+
+
+def _enable_controllers(path: str):
+    # Controllers can only be enabled for children if available here
+    available = set(_read(os.path.join(path, "cgroup.controllers")).split())
+    enabled = set(_read(os.path.join(path, "cgroup.subtree_control")).split())
+    for c in CONTROLLERS:
+        if c in available and c not in enabled:
+            try:
+                _write(os.path.join(path, "cgroup.subtree_control"), "+" + c)
+            except OSError as e:
+                warning("Cannot enable the %s controller in %s: %s" %
+                        (c, path, e))
+
+
+class Cgroup(object):
+    """A cgroup v2 group for the processes of a node, with their resource
+    limits and usage. Requires root privileges."""
+
+    def __init__(self, name: str):
+        mount = find_mount()
+        if mount is None:
+            raise RuntimeError("The cgroup2 hierarchy is not mounted")
+        base = os.path.join(mount, BASE)
+        _enable_controllers(mount)
+        os.makedirs(base, exist_ok = True)
+        _enable_controllers(base)
+        self._path = os.path.join(base, name)
+        # Might be left over by a process that crashed
+        os.makedirs(self._path, exist_ok = True)
+        debug("Cgroup(%s) created" % self._path)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self._path, name)
+
+    def controllers(self) -> list[str]:
+        """Resource controllers available to this group."""
+        return _read(self._file("cgroup.controllers")).split()
+
+    def set_parameters(self, cpu_weight: Optional[int] = None,
+            cpu_quota: Optional[float] = None, cpus = None,
+            memory_max: Optional[int] = None):
+        """Sets the resource limits; the ones not given are removed.
+
+        `cpu_weight' is the relative share of CPU time (1 to 10000, 100 by
+        default); `cpu_quota' the number of CPUs' worth of time that can be
+        used (e.g. 0.5 or 2); `cpus' the list of CPUs the processes can run
+        on; `memory_max' the memory limit, in bytes, past which processes
+        are killed."""
+        if cpus is not None and not isinstance(cpus, str):
+            cpus = ",".join(str(c) for c in cpus)
+        if cpu_quota is not None:
+            cpu_quota = "%d %d" % (max(int(cpu_quota * CPU_PERIOD), 1000),
+                    CPU_PERIOD)
+        changes = [("cpu", "cpu.weight", cpu_weight, "100"),
+                ("cpu", "cpu.max", cpu_quota, "max"),
+                ("cpuset", "cpuset.cpus", cpus, ""),
+                ("memory", "memory.max", memory_max, "max")]
+        available = self.controllers()
+        for controller, name, value, default in changes:
+            if controller not in available:
+                if value is None:
+                    continue
+                raise RuntimeError("The %s controller is not available" %
+                        controller)
+            _write(self._file(name), default if value is None else str(value))
+
+    def usage(self) -> dict[str, int]:
+        """Returns the contents of cpu.stat (CPU time used, in microseconds,
+        and throttling statistics) and, if the memory controller is
+        available, the current and peak memory usage, in bytes, as
+        memory_current and memory_peak."""
+        usage = {}
+        for line in _read(self._file("cpu.stat")).splitlines():
+            k, v = line.split()
+            usage[k] = int(v)
+        for name in ("memory.current", "memory.peak"):
+            try:
+                usage[name.replace(".", "_")] = int(_read(self._file(name)))
+            except FileNotFoundError:
+                pass
+        return usage
+
+    def pids(self) -> list[int]:
+        return [int(x) for x in _read(self._file("cgroup.procs")).split()]
+
+    def _populated(self) -> bool:
+        for line in _read(self._file("cgroup.events")).splitlines():
+            k, v = line.split()
+            if k == "populated":
+                return v == "1"
+        return False
+
+    def kill(self, timeout: float = 1):
+        """Kills every process in the group, including those started by the
+        processes themselves, and waits up to `timeout' seconds for them to
+        be gone."""
+        deadline = time.time() + timeout
+        try:
+            # Linux >= 5.14: all at once, processes forking meanwhile included
+            _write(self._file("cgroup.kill"), "1")
+        except FileNotFoundError:
+            # One by one, until no more are started
+            while self.pids() and time.time() < deadline:
+                for pid in self.pids():
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+        while self._populated() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def destroy(self):
+        """Kills the remaining processes and removes the group."""
+        if not self._path:
+            return
+        self.kill()
+        try:
+            os.rmdir(self._path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                warning("Cannot remove cgroup %s: %s" % (self._path, e))
+        self._path = None
@@ -1,6 +1,11 @@
+import ctypes
 import os
 import socket as pysocket
 
+_libc = ctypes.CDLL(None, use_errno=True)
+
+CLONE_NEWNET = 0x40000000
+
 
 def pipe() -> tuple[int, int]:
     a, b = os.pipe2(0)
@@ -26,3 +31,41 @@ def fromfd(*args, **kwargs) -> pysocket.socket:
     s = pysocket.fromfd(*args, **kwargs)
     s.set_inheritable(True)
     return s
+
+
+def close_fds(keep=()):
+    """Close every file descriptor not listed in `keep'."""
+    lo = 0
+    for fd in sorted(set(keep)):
+        if fd > lo:
+            os.closerange(lo, fd)
+        lo = max(lo, fd + 1)
+    os.closerange(lo, os.sysconf("SC_OPEN_MAX"))
+
+
+def inheritable_fds(first: int = 3) -> list[int]:
+    """Returns the open file descriptors from `first' on that are not
+    close-on-exec."""
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(first, os.sysconf("SC_OPEN_MAX"))
+    inheritable = []
+    for fd in fds:
+        if fd >= first:
+            try:
+                if os.get_inheritable(fd):
+                    inheritable.append(fd)
+            except OSError:
+                pass  # e.g. the descriptor used to read the directory
+    return inheritable
+
+
+def setns(fd: int, nstype: int = 0):
+    """Move the calling thread into the name space referred by `fd'."""
+    if hasattr(os, "setns"):
+        os.setns(fd, nstype)
+        return
+    if _libc.setns(fd, nstype) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
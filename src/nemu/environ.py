@@ -87,15 +87,17 @@ except:
                        "continue.")
 
 
-def execute(cmd: list[str]):
+def execute(cmd: list[str], input: bytes = None):
     """Execute a command, if the return value is non-zero, raise an exception.
+    If `input' is given, it is written to the command's standard input.
     
     Raises:
         RuntimeError: the command was unsuccessful (return code != 0).
     """
     debug("execute(%s)" % cmd)
-    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-    _, err = proc.communicate()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            stdin=None if input is None else subprocess.PIPE)
+    _, err = proc.communicate(input)
     if proc.returncode != 0:
         raise RuntimeError("Error executing `%s': %s" % (" ".join(cmd), err))
 
@@ -17,39 +17,79 @@
 # You should have received a copy of the GNU General Public License along with
 # Nemu.  If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
+import errno
 import os
 import weakref
 from typing import TypedDict
 
 import nemu.iproute
+import nemu.netlink
 from nemu.environ import *
 
 __all__ = ['NodeInterface', 'P2PInterface', 'ImportedInterface',
-           'ImportedNodeInterface', 'Switch']
+           'ImportedNodeInterface', 'Switch', 'link_update',
+           'set_fabric_netns', 'find_interface']
+
+# Generated names are "NETNS" + kind + 8 base-36 digits (15 chars, the
+# kernel's limit), encoding the whole PID of the controller (pid_max is at
+# most 2**22) and an ID: 41 bits.
+_ID_BITS = 19
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# Accepted by configure() but set apart from the interface attributes, see
+# nemu.netlink.set_link_options().
+_LINK_OPTIONS = ("txqueuelen",) + tuple(nemu.netlink.OFFLOADS)
+
+
+def _link_options(kwargs: dict) -> dict:
+    """Remove the link options from `kwargs', and return them."""
+    return dict((k, kwargs.pop(k)) for k in _LINK_OPTIONS if k in kwargs)
 
 
 class Interface(object):
     """Just a base class for the *Interface classes: assign names and handle
     destruction."""
     _nextid = 0
+    # Generated name -> live interface object
+    _names: "weakref.WeakValueDictionary[str, Interface]" = \
+        weakref.WeakValueDictionary()
+    _name = None
 
     @staticmethod
-    def _gen_next_id() -> int:
-        n = Interface._nextid
-        Interface._nextid += 1
-        return n
+    def _gen_name(kind: str) -> str:
+        # IDs wrap around after 2**_ID_BITS names, skipping those still in use
+        for i in range(1 << _ID_BITS):
+            n = Interface._nextid
+            Interface._nextid = (n + 1) & ((1 << _ID_BITS) - 1)
+            v = os.getpid() << _ID_BITS | n
+            digits = ""
+            for j in range(8):
+                v, d = divmod(v, 36)
+                digits = _DIGITS[d] + digits
+            name = "NETNS%s%s" % (kind, digits)
+            if name not in Interface._names:
+                return name
+        raise RuntimeError("Too many interfaces: out of names")
 
     @staticmethod
     def _gen_if_name() -> str:
-        n = Interface._gen_next_id()
-        # Max 15 chars
-        return "NETNSif-%.4x%.3x" % (os.getpid() & 0xffff, n)
+        return Interface._gen_name("if")
 
-    def __init__(self, index: int):
+    def __init__(self, index: int, name: str | None = None):
         self._idx = index
+        if name:
+            self._name = name
+            Interface._names[name] = self
         debug("%s(0x%x).__init__(), index = %d" % (self.__class__.__name__,
                                                    id(self), index))
 
+    def _renamed(self):
+        # The generated name is gone; forget it.
+        if self._name and Interface._names.get(self._name) is self:
+            del Interface._names[self._name]
+        self._name = None
+
     def __del__(self):
         debug("%s(0x%x).__del__()" % (self.__class__.__name__, id(self)))
         self.destroy()
@@ -85,9 +125,14 @@ class Ipv6Dict(TypedDict):
 class NSInterface(Interface):
     """Add user-facing methods for interfaces that go into a netns."""
 
-    def __init__(self, node: "nemu.Node", index):
-        super(NSInterface, self).__init__(index)
+    # Cached view of the attributes, and whether reads are served from it
+    _state = None
+    _snapshot = False
+
+    def __init__(self, node: "nemu.Node", index, name: str | None = None):
+        super(NSInterface, self).__init__(index, name)
         self._slave = node._slave
+        self._node = weakref.ref(node)
         # Disable auto-configuration
         # you wish: need to take into account the nonetns mode; plus not
         # touching some pre-existing ifaces
@@ -107,6 +152,8 @@ class NSInterface(Interface):
             # Not initialised yet
             return super(Interface, self).__getattribute__(name)
 
+        if self._snapshot:
+            return getattr(self.state(), name)
         iface = slave.get_if_data(self.index)
         return getattr(iface, name)
 
@@ -114,9 +161,59 @@ class NSInterface(Interface):
         if name[0] == '_':  # forbid anything that doesn't start with a _
             super(Interface, self).__setattr__(name, value)
             return
+        self.configure(**{name: value})
+
+    def configure(self, **kwargs):
+        """Change several attributes at once (e.g. `up', `mtu', `lladdr' or
+        `name'), with a single request. The transmit queue length
+        (`txqueuelen') and the `gso', `gro' and `tso' offloads can be set
+        here too."""
+        options = _link_options(kwargs)
+        if options:
+            self._slave.set_link_options(self.index, **options)
+            if not kwargs:
+                return
         iface = nemu.iproute.interface(index=self.index)
-        setattr(iface, name, value)
-        return self._slave.set_if(iface)
+        for k, v in kwargs.items():
+            setattr(iface, k, v)
+        self._slave.set_if(iface)
+        if 'name' in kwargs:
+            self._renamed()
+        if self._state is not None:
+            self.refresh()
+
+    def state(self) -> nemu.iproute.interface_state:
+        """Return an immutable view of the interface attributes. The view is
+        cached: it is only updated by refresh(), and when the node processes
+        link change notifications (for example, in Node.get_interface())."""
+        if self._state is None:
+            return self.refresh()
+        return self._state
+
+    def refresh(self) -> nemu.iproute.interface_state:
+        """Update the cached view of the interface attributes, and return it.
+        This does not involve the slave: the node keeps track of link
+        changes."""
+        node = self._node()
+        if node is None or not self._slave:
+            raise RuntimeError("Interface already destroyed.")
+        node._update_interfaces()
+        try:
+            iface = node._links.links[self.index]
+        except KeyError:
+            raise RuntimeError("Interface %d no longer exists." % self.index)
+        self._state = nemu.iproute.interface_state.from_interface(iface)
+        return self._state
+
+    def set_snapshot(self, enabled: bool = True):
+        """In snapshot mode, reading attributes returns the values from
+        state(), instead of querying the interface every time."""
+        self._snapshot = bool(enabled)
+
+    def _update_state(self, iface: nemu.iproute.interface):
+        # Called by the node on link notifications
+        if self._state is not None:
+            self._state = nemu.iproute.interface_state.from_interface(iface)
 
     def add_v4_address(self, address: str, prefix_len: int, broadcast=None):
         addr = nemu.iproute.ipv4address(address, prefix_len, broadcast)
@@ -152,33 +249,191 @@ class NSInterface(Interface):
         return ret
 
 
+_main_netlink = (None, None)
+
+
+def _netlink() -> nemu.netlink.Netlink:
+    """Netlink socket for the main name space, opened on first use (and again
+    after a fork, as replies could be read by the wrong process)."""
+    global _main_netlink
+    pid, nl = _main_netlink
+    if pid != os.getpid():
+        nl = nemu.netlink.Netlink()
+        _main_netlink = (os.getpid(), nl)
+    return nl
+
+
+class _MainFabric(object):
+    """Where bridges and the control ends of NodeInterfaces live by default:
+    the main name space. `ipr' is the module or object used to manage them,
+    with the API of nemu.iproute."""
+    pid = None
+    ipr = nemu.iproute
+    alive = True
+
+    @property
+    def netlink(self) -> nemu.netlink.Netlink:
+        return _netlink()
+
+    def set_tc_many(self, changes):
+        nemu.iproute.set_tc_many(changes)
+
+    def set_link_options(self, index, **options):
+        nemu.netlink.set_link_options(index, **options)
+
+
+class _NetnsFabric(object):
+    """Bridges and control interfaces kept in a hidden name space, managed
+    by its own slave, so they neither clutter the main name space nor slow
+    down the queries made there. Everything in it goes away with it."""
+
+    def __init__(self):
+        import nemu.node
+        self._node = nemu.node.Node._create_hidden()
+        self.pid = self._node.pid
+        fd = os.open("/proc/%d/ns/net" % self.pid, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            self.netlink = nemu.netlink.Netlink(fd)
+        finally:
+            os.close(fd)
+        # Sysfs shows the main name space, so bridges are handled with
+        # netlink too.
+        self.ipr = self.netlink
+
+    @property
+    def alive(self) -> bool:
+        return bool(self._node.pid)
+
+    def set_tc_many(self, changes):
+        self._node._slave.set_tc_many(changes)
+
+    def set_link_options(self, index, **options):
+        self._node._slave.set_link_options(index, **options)
+
+
+_MAIN_FABRIC = _MainFabric()
+# Whether new switches and interfaces go into a _NetnsFabric, and the one in
+# use. Each object keeps a reference to its own fabric.
+_fabric_netns = False
+_netns_fabric = None
+
+
+def _fabric():
+    global _netns_fabric
+    if not _fabric_netns:
+        return _MAIN_FABRIC
+    if _netns_fabric is None or not _netns_fabric.alive:
+        _netns_fabric = _NetnsFabric()
+    return _netns_fabric
+
+
+def set_fabric_netns(enabled: bool = True):
+    """Choose where new Switch objects, and the control ends of new
+    NodeInterfaces, are created: in the main name space (the default), or in
+    a hidden name space of their own. Interfaces can only be connected to
+    switches of the same kind; existing objects are not affected."""
+    global _fabric_netns
+    _fabric_netns = bool(enabled)
+
+
+def find_interface(name: str) -> Interface | None:
+    """Return the interface object that owns the device named `name', as
+    generated by nemu when the object was created, or None. Objects whose
+    devices were renamed are not found."""
+    return Interface._names.get(name)
+
+
+def _create_veths(ends: list[tuple["nemu.Node | None", "nemu.Node"]],
+                  fabric: _MainFabric | _NetnsFabric = _MAIN_FABRIC,
+                  numtxqueues: int | None = None,
+                  numrxqueues: int | None = None
+                  ) -> list[tuple[tuple[int, str], tuple[int, str]]]:
+    """Create a veth pair for each (node1, node2) tuple, with an end inside
+    each of the nodes (None standing for the `fabric' name space), and
+    return their (index, name) tuples. All the pairs are created with a batch of
+    requests; if any of them fails, the rest are removed and the error is
+    raised."""
+    nl = fabric.netlink
+    names = [(Interface._gen_if_name(), Interface._gen_if_name())
+             for e in ends]
+    errors = nl.create_veths([
+        (n1, node1.pid if node1 else None, n2, node2.pid)
+        for (node1, node2), (n1, n2) in zip(ends, names)],
+        numtxqueues, numrxqueues)
+
+    def index(node, name, host):
+        if node is None:
+            return host[name].index
+        return node._links.indices[name]
+
+    # The nodes learn about the new interfaces from their link monitors.
+    host = {}
+    if any(node1 is None for node1, node2 in ends):
+        host = nl.get_if_data()[1]
+    for node in set(n for e in ends for n in e if n is not None):
+        node._update_interfaces()
+
+    failed = [e for e in errors if e]
+    if failed:
+        for (node1, node2), (n1, n2), err in zip(ends, names, errors):
+            if err:
+                continue
+            # the other end should go away automatically
+            try:
+                if node1 is None:
+                    nl.del_if(host[n1].index)
+                else:
+                    node1._slave.del_if(index(node1, n1, host))
+            except BaseException:
+                pass
+        raise failed[0]
+
+    return [((index(node1, n1, host), n1), (index(node2, n2, host), n2))
+            for (node1, node2), (n1, n2) in zip(ends, names)]
+
+
 class NodeInterface(NSInterface):
     """Class to create and handle a virtual interface inside a name space, it
     can be connected to a Switch object with emulation of link
     characteristics."""
 
-    def __init__(self, node: "nemu.Node"):
+    def __init__(self, node: "nemu.Node", numtxqueues: int | None = None,
+                 numrxqueues: int | None = None):
         """Create a new interface. `node' is the name space in which this
-        interface should be put."""
+        interface should be put. The number of transmit and receive queues
+        can only be chosen here; more than one lets traffic be spread across
+        CPUs."""
         self._slave = None
-        if1 = nemu.iproute.interface(name=self._gen_if_name())
-        if2 = nemu.iproute.interface(name=self._gen_if_name())
-        ctl, ns = nemu.iproute.create_if_pair(if1, if2)
-        try:
-            nemu.iproute.change_netns(ns, node.pid)
-        except:
-            nemu.iproute.del_if(ctl)
-            # the other interface should go away automatically
-            raise
-        self._control = SlaveInterface(ctl.index)
-        super(NodeInterface, self).__init__(node, ns.index)
+        fabric = _fabric()
+        ((ctl, ns),) = _create_veths([(None, node)], fabric, numtxqueues,
+                                     numrxqueues)
+        self._control = SlaveInterface(*ctl, fabric=fabric)
+        super(NodeInterface, self).__init__(node, *ns)
+
+    @staticmethod
+    def _create_many(node: "nemu.Node", count: int,
+                     numtxqueues: int | None = None,
+                     numrxqueues: int | None = None) -> list["NodeInterface"]:
+        # Use Node.add_ifs()
+        res = []
+        fabric = _fabric()
+        for ctl, ns in _create_veths([(None, node)] * count, fabric,
+                                     numtxqueues, numrxqueues):
+            o = NodeInterface.__new__(NodeInterface)
+            o._slave = None
+            o._control = SlaveInterface(*ctl, fabric=fabric)
+            super(NodeInterface, o).__init__(node, *ns)
+            res.append(o)
+        return res
 
     @property
     def control(self):
         return self._control
 
     def destroy(self):
-        if not self._slave:
+        if not self._slave or self._slave.closed:
+            # Gone with the node's name space
+            self._slave = None
             return
         debug("NodeInterface(0x%x).destroy()" % id(self))
         if self.index in self._slave.get_if_data():
@@ -191,37 +446,72 @@ class P2PInterface(NSInterface):
     spaces, without using Switch objects. Those do not allow any kind of
     traffic shaping.
     As two interfaces need to be created, instead of using the class
-    constructor, use the P2PInterface.create_pair() static method."""
+    constructor, use the P2PInterface.create_pair() static method, or
+    P2PInterface.create_pairs() to create many of them."""
 
     @staticmethod
-    def create_pair(node1: "nemu.Node", node2: "nemu.Node"):
+    def create_pair(node1: "nemu.Node", node2: "nemu.Node", **parameters):
         """Create and return a pair of connected P2PInterface objects,
-        assigned to name spaces represented by `node1' and `node2'."""
-        if1 = nemu.iproute.interface(name=P2PInterface._gen_if_name())
-        if2 = nemu.iproute.interface(name=P2PInterface._gen_if_name())
-        pair = nemu.iproute.create_if_pair(if1, if2)
-        try:
-            nemu.iproute.change_netns(pair[0], node1.pid)
-            nemu.iproute.change_netns(pair[1], node2.pid)
-        except:
-            nemu.iproute.del_if(pair[0])
-            # the other interface should go away automatically
-            raise
+        assigned to name spaces represented by `node1' and `node2'. Link
+        emulation parameters, if given, are applied to both ends; see
+        set_parameters(). So are the number of queues (`numtxqueues',
+        `numrxqueues') and the link options of configure()."""
+        return P2PInterface.create_pairs([(node1, node2)], **parameters)[0]
 
-        o1 = P2PInterface.__new__(P2PInterface)
-        super(P2PInterface, o1).__init__(node1, pair[0].index)
-
-        o2 = P2PInterface.__new__(P2PInterface)
-        super(P2PInterface, o2).__init__(node2, pair[1].index)
-
-        return o1, o2
+    @staticmethod
+    def create_pairs(edges: list[tuple["nemu.Node", "nemu.Node"]],
+                     numtxqueues: int | None = None,
+                     numrxqueues: int | None = None, **parameters):
+        """Create many pairs of connected P2PInterface objects at once, one
+        for each (node1, node2) tuple in `edges'. Returns a list with the
+        pairs, in the same order."""
+        options = _link_options(parameters)
+        res = []
+        for (node1, node2), (end1, end2) in zip(edges, _create_veths(
+                edges, _MAIN_FABRIC, numtxqueues, numrxqueues)):
+            o1 = P2PInterface.__new__(P2PInterface)
+            super(P2PInterface, o1).__init__(node1, *end1)
+
+            o2 = P2PInterface.__new__(P2PInterface)
+            super(P2PInterface, o2).__init__(node2, *end2)
+            res.append((o1, o2))
+        if options:
+            for pair in res:
+                for o in pair:
+                    o.configure(**options)
+        if any(v is not None for v in parameters.values()):
+            for pair in res:
+                for o in pair:
+                    o.set_parameters(**parameters)
+        return res
 
     def __init__(self):
         "Not to be called directly. Use P2PInterface.create_pair()"
         raise RuntimeError(P2PInterface.__init__.__doc__)
 
+    def set_parameters(self, bandwidth=None,
+                       delay=None, delay_jitter=None,
+                       delay_correlation=None, delay_distribution=None,
+                       loss=None, loss_correlation=None,
+                       dup=None, dup_correlation=None,
+                       corrupt=None, corrupt_correlation=None):
+        """Set the parameters that control the link characteristics, as in
+        Switch.set_parameters(), for the traffic sent through this end of the
+        link. Call it on both ends to emulate the link in both directions.
+        Parameters not given are disabled."""
+        self._slave.set_tc(self.index, bandwidth=bandwidth,
+                           delay=delay, delay_jitter=delay_jitter,
+                           delay_correlation=delay_correlation,
+                           delay_distribution=delay_distribution,
+                           loss=loss, loss_correlation=loss_correlation,
+                           dup=dup, dup_correlation=dup_correlation,
+                           corrupt=corrupt,
+                           corrupt_correlation=corrupt_correlation)
+
     def destroy(self):
-        if not self._slave:
+        if not self._slave or self._slave.closed:
+            # Gone with the node's name space
+            self._slave = None
             return
         debug("P2PInterface(0x%x).destroy()" % id(self))
         if self.index in self._slave.get_if_data():
@@ -240,11 +530,12 @@ class ImportedNodeInterface(NSInterface):
     def __init__(self, node: "nemu.Node", iface: nemu.iproute.interface, migrate=True):
         self._slave = None
         self._migrate = migrate
+        name = None
         if self._migrate:
             iface = nemu.iproute.get_if(iface)
             self._original_state = iface.copy()
             # Change the name to avoid clashes
-            iface.name = self._gen_if_name()
+            iface.name = name = self._gen_if_name()
             nemu.iproute.set_if(iface)
             # Migrate it
             nemu.iproute.change_netns(iface, node.pid)
@@ -252,10 +543,11 @@ class ImportedNodeInterface(NSInterface):
             iface = node._slave.get_if_data(iface)
             self._original_state = iface.copy()
 
-        super(ImportedNodeInterface, self).__init__(node, iface.index)
+        super(ImportedNodeInterface, self).__init__(node, iface.index, name)
 
     def destroy(self):  # override: restore as much as possible
-        if not self._slave:
+        if not self._slave or self._slave.closed:
+            self._slave = None
             return
         debug("ImportedNodeInterface(0x%x).destroy()" % id(self))
         if self.index in self._slave.get_if_data():
@@ -282,7 +574,7 @@ class TapNodeInterface(NSInterface):
         iface = nemu.iproute.interface(name=self._gen_if_name())
         iface, self._fd = nemu.iproute.create_tap(iface, use_pi=use_pi)
         nemu.iproute.change_netns(iface.name, node.pid)
-        super(TapNodeInterface, self).__init__(node, iface.index)
+        super(TapNodeInterface, self).__init__(node, iface.index, iface.name)
 
     @property
     def fd(self):
@@ -312,7 +604,7 @@ class TunNodeInterface(NSInterface):
         iface, self._fd = nemu.iproute.create_tap(iface, use_pi=use_pi,
                                                   tun=True)
         nemu.iproute.change_netns(iface.name, node.pid)
-        super(TunNodeInterface, self).__init__(node, iface.index)
+        super(TunNodeInterface, self).__init__(node, iface.index, iface.name)
 
     @property
     def fd(self):
@@ -332,6 +624,9 @@ class ExternalInterface(Interface):
     """Add user-facing methods for interfaces that run in the main
     namespace."""
 
+    # Where the interface lives
+    _fabric = _MAIN_FABRIC
+
     @property
     def control(self):
         # This is *the* control interface
@@ -339,35 +634,48 @@ class ExternalInterface(Interface):
 
     # some black magic to automatically get/set interface attributes
     def __getattr__(self, name):
-        iface = nemu.iproute.get_if(self.index)
+        iface = self._fabric.ipr.get_if(self.index)
         return getattr(iface, name)
 
     def __setattr__(self, name, value):
         if name[0] == '_':  # forbid anything that doesn't start with a _
             super(ExternalInterface, self).__setattr__(name, value)
             return
+        self.configure(**{name: value})
+
+    def configure(self, **kwargs):
+        """Change several attributes at once, with a single request. Link
+        options are accepted too, as in NSInterface.configure()."""
+        options = _link_options(kwargs)
+        if options:
+            self._fabric.set_link_options(self.index, **options)
+            if not kwargs:
+                return
         iface = nemu.iproute.interface(index=self.index)
-        setattr(iface, name, value)
-        return nemu.iproute.set_if(iface)
+        for k, v in kwargs.items():
+            setattr(iface, k, v)
+        self._fabric.ipr.set_if(iface)
+        if 'name' in kwargs:
+            self._renamed()
 
     def add_v4_address(self, address, prefix_len, broadcast=None):
         addr = nemu.iproute.ipv4address(address, prefix_len, broadcast)
-        nemu.iproute.add_addr(self.index, addr)
+        self._fabric.ipr.add_addr(self.index, addr)
 
     def add_v6_address(self, address, prefix_len):
         addr = nemu.iproute.ipv6address(address, prefix_len)
-        nemu.iproute.add_addr(self.index, addr)
+        self._fabric.ipr.add_addr(self.index, addr)
 
     def del_v4_address(self, address, prefix_len, broadcast=None):
         addr = nemu.iproute.ipv4address(address, prefix_len, broadcast)
-        nemu.iproute.del_addr(self.index, addr)
+        self._fabric.ipr.del_addr(self.index, addr)
 
     def del_v6_address(self, address, prefix_len):
         addr = nemu.iproute.ipv6address(address, prefix_len)
-        nemu.iproute.del_addr(self.index, addr)
+        self._fabric.ipr.del_addr(self.index, addr)
 
     def get_addresses(self):
-        addresses = nemu.iproute.get_addr_data()
+        addresses = self._fabric.ipr.get_addr(self.index)
         ret = []
         for a in addresses:
             if hasattr(a, 'broadcast'):
@@ -388,6 +696,11 @@ class SlaveInterface(ExternalInterface):
     """Class to handle the main-name-space-facing half of NodeInterface.
     Does nothing, just avoids any destroy code."""
 
+    def __init__(self, index: int, name: str | None = None,
+                 fabric=_MAIN_FABRIC):
+        self._fabric = fabric
+        super(SlaveInterface, self).__init__(index, name)
+
     def destroy(self):
         pass
 
@@ -419,9 +732,7 @@ class ImportedInterface(ExternalInterface):
 class Switch(ExternalInterface):
     @staticmethod
     def _gen_br_name():
-        n = Switch._gen_next_id()
-        # Max 15 chars
-        return "NETNSbr-%.4x%.3x" % (os.getpid() & 0xffff, n)
+        return Interface._gen_name("br")
 
     def __init__(self, **args):
         """Creates a new Switch object, which models a linux bridge device.
@@ -431,79 +742,109 @@ class Switch(ExternalInterface):
         self._idx = None
         self._parameters = {}
         self._ports = weakref.WeakValueDictionary()
+        self._fabric = _fabric()
 
-        iface = nemu.iproute.create_bridge(self._gen_br_name())
-        super(Switch, self).__init__(iface.index)
+        iface = self._fabric.ipr.create_bridge(self._gen_br_name())
+        super(Switch, self).__init__(iface.index, iface.name)
 
         # FIXME: is this correct/desirable/etc?
-        self.stp = False
-        self.forward_delay = 0
+        self.configure(stp=False, forward_delay=0)
         # FIXME: register somewhere
         if args:
             self.set_parameters(**args)
 
     def __getattr__(self, name):
-        iface = nemu.iproute.get_bridge(self.index)
+        iface = self._fabric.ipr.get_bridge(self.index)
         return getattr(iface, name)
 
     def __setattr__(self, name, value):
         if name[0] == '_':  # forbid anything that doesn't start with a _
             super(Switch, self).__setattr__(name, value)
             return
+        self.configure(**{name: value})
+
+    def configure(self, **kwargs):
+        """Change several attributes of the bridge at once. `up' and `mtu'
+        are applied to the ports too."""
+        iface = nemu.iproute.bridge(index=self.index)
+        for k, v in kwargs.items():
+            setattr(iface, k, v)
         # Set ports
-        if name in ('up', 'mtu'):
-            for i in self._ports.values():
-                if self._check_port(i.index):
-                    setattr(i, name, value)
+        portcfg = dict((k, v) for k, v in kwargs.items() if k in ('up', 'mtu'))
+        if portcfg:
+            self._live_ports()
+            for i in list(self._ports.values()):
+                i.configure(**portcfg)
         # Set bridge
-        iface = nemu.iproute.bridge(index=self.index)
-        setattr(iface, name, value)
-        nemu.iproute.set_bridge(iface)
+        self._fabric.ipr.set_bridge(iface)
+        if 'name' in kwargs:
+            self._renamed()
 
     def destroy(self):
         if not self.index:
             return
         debug("Switch(0x%x).destroy()" % id(self))
+        if not self._fabric.alive:
+            # Gone together with its name space
+            self._ports.clear()
+            self._idx = None
+            return
 
         # Verify they are still there
-        for p in self._ports.keys():
-            self._check_port(p)
-
-        self.up = False
-        for p in list(self._ports.values()):
-            self.disconnect(p)
-
+        self._live_ports()
+        ports = list(self._ports.keys())
+        nl = self._fabric.netlink
+        # Detach, bring down, and reset the ports with a few batched requests
+        errors = nl.release_ports(ports)
+        if any(v is not None for v in self._parameters.values()):
+            errors += [e for e in nl.clear_qdiscs(ports)
+                       if e and e.errno not in (errno.ENOENT, errno.EINVAL)]
         self._ports.clear()
-        nemu.iproute.del_bridge(self.index)
+        nl.del_if(self.index)
         self._idx = None
-
-    def connect(self, iface):
+        errors = [e for e in errors if e and e.errno != errno.ENODEV]
+        if errors:
+            raise errors[0]
+
+    def connect(self, iface, **options):
+        """Attach `iface' to the switch. Link options (see
+        NSInterface.configure()) are applied to its port, the control
+        interface."""
         assert iface.control.index not in self._ports
+        if iface.control._fabric is not self._fabric:
+            raise RuntimeError("The interface and the switch are not in the "
+                               "same name space; see set_fabric_netns().")
         try:
             self._apply_parameters(self._parameters, iface.control)
-            nemu.iproute.add_bridge_port(self.index, iface.control.index)
+            self._fabric.ipr.add_bridge_port(self.index, iface.control.index)
         except:
             self._apply_parameters({}, iface.control)
             raise
-        iface.control.up = self.up
-        iface.control.mtu = self.mtu
+        br = self._fabric.netlink.get_if(self.index)
+        iface.control.configure(up=br.up, mtu=br.mtu)
+        if options:
+            iface.control.configure(**options)
         self._ports[iface.control.index] = iface.control
 
+    def _live_ports(self) -> set[int]:
+        """Query the ports attached to the bridge, with a single request, and
+        forget the ones that went away. Returns their indices."""
+        live = set(self._fabric.netlink.get_bridge_ports(self.index))
+        for idx in list(self._ports.keys()):
+            if idx not in live:
+                warning("Switch(0x%x): Port (index = %d) went away." % (
+                    id(self), idx))
+                self._ports.pop(idx, None)
+        return live
+
     def _check_port(self, port_index):
-        ports = nemu.iproute.get_bridge_data()[2]
-        if self.index in ports and port_index in ports[self.index]:
-            return True
-        # else
-        warning("Switch(0x%x): Port (index = %d) went away." % (id(self),
-                                                                port_index))
-        del self._ports[port_index]
-        return False
+        return port_index in self._live_ports()
 
     def disconnect(self, iface):
         assert iface.control.index in self._ports
         if not self._check_port(iface.control.index):
             return
-        nemu.iproute.del_bridge_port(self.index, iface.control.index)
+        self._fabric.ipr.del_bridge_port(self.index, iface.control.index)
         self._apply_parameters({}, iface.control)
         del self._ports[iface.control.index]
 
@@ -534,13 +875,55 @@ class Switch(ExternalInterface):
                           loss=loss, loss_correlation=loss_correlation,
                           dup=dup, dup_correlation=dup_correlation,
                           corrupt=corrupt, corrupt_correlation=corrupt_correlation)
-        try:
-            self._apply_parameters(parameters)
-        except:
-            self._apply_parameters(self._parameters)
-            raise
-        self._parameters = parameters
+        if _link_updates is not None:
+            # Applied when the link_update() block ends
+            _link_updates[id(self)] = (self, parameters)
+            return
+        _commit_parameters([(self, parameters)])
 
     def _apply_parameters(self, parameters, port=None):
-        for i in [port] if port else list(self._ports.values()):
-            nemu.iproute.set_tc(i.index, **parameters)
+        self._fabric.set_tc_many([
+            (i.index, parameters)
+            for i in ([port] if port else list(self._ports.values()))])
+
+
+# Parameter changes recorded inside a link_update() block
+_link_updates = None
+
+
+@contextlib.contextmanager
+def link_update():
+    """Context manager to change the parameters of many switches at once.
+    Inside the block, Switch.set_parameters() calls only take note of the
+    changes; when it ends, they are applied to all the ports together, so
+    the links change almost simultaneously. If that fails, the previous
+    parameters are restored. Nested blocks are merged into the outermost."""
+    global _link_updates
+    if _link_updates is not None:
+        yield
+        return
+    _link_updates = pending = {}
+    try:
+        yield
+    finally:
+        _link_updates = None
+    _commit_parameters(list(pending.values()))
+
+
+def _commit_parameters(updates: list[tuple[Switch, dict]]):
+    def apply(new):
+        # One batch for each name space
+        changes = {}
+        for switch, parameters in updates:
+            changes.setdefault(switch._fabric, []).extend(
+                (i.index, parameters if new else switch._parameters)
+                for i in list(switch._ports.values()))
+        for fabric, c in changes.items():
+            fabric.set_tc_many(c)
+    try:
+        apply(True)
+    except:
+        apply(False)  # rollback
+        raise
+    for switch, parameters in updates:
+        switch._parameters = parameters
@@ -27,7 +27,7 @@ import sys
 from typing import TypeVar, Callable, Literal
 
 from attr import evolve
-from attrs import define, setters, field
+from attrs import define, frozen, setters, field
 import six
 
 from nemu.environ import *
@@ -161,6 +161,26 @@ class interface:
         return copy.copy(self)
 
 
+@frozen
+class interface_state:
+    """Immutable snapshot of the attributes of an interface, as returned by
+    NSInterface.state()."""
+
+    index: int
+    name: str
+    up: bool
+    mtu: int
+    lladdr: str
+    broadcast: str
+    multicast: bool
+    arp: bool
+
+    @classmethod
+    def from_interface(cls, iface: interface):
+        return cls(iface.index, iface.name, iface.up, iface.mtu, iface.lladdr,
+                   iface.broadcast, iface.multicast, iface.arp)
+
+
 @define(repr=False)
 class bridge(interface):
     changeable_attributes = interface.changeable_attributes + ["stp",
@@ -403,37 +423,33 @@ def set_if(iface: interface, recover=True):
     orig_iface = get_if(iface)
     diff = iface - orig_iface  # Only set what's needed
 
-    # Name goes first
-    if diff.name:
-        _ils = [IP_PATH, "link", "set", "dev"]
-        cmds = [_ils + [orig_iface.name, "name", diff.name]]
-        if orig_iface.up:
-            # iface needs to be down
-            cmds = [_ils + [orig_iface.name, "down"], cmds[0],
-                    _ils + [diff.name, "up"]]
-        do_cmds(cmds, orig_iface)
-
-    # I need to use the new name after a name change, duh!
-    _ils = [IP_PATH, "link", "set", "dev", diff.name or orig_iface.name]
+    # Everything goes in a single command (and a single netlink request), but
+    # the interface needs to be down to change its name or address.
+    _ils = [IP_PATH, "link", "set", "dev", orig_iface.name]
     cmds = []
+    down = orig_iface.up and (diff.name or diff.lladdr)
+    if down:
+        cmds.append(_ils + ["down"])
+    args = []
+    if diff.name:
+        args += ["name", diff.name]
     if diff.lladdr:
-        if orig_iface.up:
-            # iface needs to be down
-            cmds.append(_ils + ["down"])
-        cmds.append(_ils + ["address", diff.lladdr])
-        if orig_iface.up and diff.up is None:
-            # restore if it was up and it's not going to be set later
-            cmds.append(_ils + ["up"])
+        args += ["address", diff.lladdr]
     if diff.mtu:
-        cmds.append(_ils + ["mtu", str(diff.mtu)])
+        args += ["mtu", str(diff.mtu)]
     if diff.broadcast:
-        cmds.append(_ils + ["broadcast", diff.broadcast])
+        args += ["broadcast", diff.broadcast]
     if diff.multicast is not None:
-        cmds.append(_ils + ["multicast", "on" if diff.multicast else "off"])
+        args += ["multicast", "on" if diff.multicast else "off"]
     if diff.arp is not None:
-        cmds.append(_ils + ["arp", "on" if diff.arp else "off"])
+        args += ["arp", "on" if diff.arp else "off"]
     if diff.up is not None:
-        cmds.append(_ils + ["up" if diff.up else "down"])
+        args += ["up" if diff.up else "down"]
+    elif down:
+        # restore, as it is not going to be set otherwise
+        args += ["up"]
+    if args:
+        cmds.append(_ils + args)
 
     do_cmds(cmds, orig_iface)
 
@@ -446,8 +462,19 @@ def change_netns(iface, netns):
 # Address handling
 
 def get_addr_data():
-    ipdata = backticks([IP_PATH, "addr", "list"])
+    return _parse_addr_data(backticks([IP_PATH, "addr", "list"]))
+
 
+def get_addr(iface) -> list[address]:
+    """Return the addresses of a single interface; `ip' asks the kernel for
+    just those."""
+    ifname = _get_if_name(iface)
+    bynam = _parse_addr_data(backticks([IP_PATH, "addr", "list", "dev",
+                                        ifname]))[1]
+    return bynam[ifname]
+
+
+def _parse_addr_data(ipdata: str):
     byidx = {}
     bynam = {}
 
@@ -492,7 +519,7 @@ def get_addr_data():
 
 def add_addr(iface, address):
     ifname = _get_if_name(iface)
-    addresses = get_addr_data()[1][ifname]
+    addresses = get_addr(ifname)
     assert address not in addresses
 
     cmd = [IP_PATH, "addr", "add", "dev", ifname, "local",
@@ -504,7 +531,7 @@ def add_addr(iface, address):
 
 def del_addr(iface, address):
     ifname = _get_if_name(iface)
-    addresses = get_addr_data()[1][ifname]
+    addresses = get_addr(ifname)
     assert address in addresses
 
     cmd = [IP_PATH, "addr", "del", "dev", ifname, "local",
@@ -876,44 +903,79 @@ def set_tc(iface, bandwidth=None, delay=None, delay_jitter=None,
            loss=None, loss_correlation=None,
            dup=None, dup_correlation=None,
            corrupt=None, corrupt_correlation=None):
+    set_tc_many([(iface, dict(
+        bandwidth=bandwidth, delay=delay, delay_jitter=delay_jitter,
+        delay_correlation=delay_correlation,
+        delay_distribution=delay_distribution, loss=loss,
+        loss_correlation=loss_correlation, dup=dup,
+        dup_correlation=dup_correlation, corrupt=corrupt,
+        corrupt_correlation=corrupt_correlation))])
+
+
+def set_tc_many(changes: list[tuple[interface | int | str, dict]]):
+    """Apply link parameters to many interfaces at once. `changes' is a list
+    of (iface, parameters) tuples, where `parameters' holds keyword arguments
+    for set_tc(). The current state is read only once, and all the commands
+    are run by a single tc process, so the changes take effect almost
+    simultaneously. On error, the remaining commands are not executed."""
+    if not changes:
+        return
+    tcdata, byidx, bynam = get_tc_data()
+    commands = []
+    for iface, parameters in changes:
+        if isinstance(iface, interface):
+            iface = iface.index if iface.index is not None else iface.name
+        iface = byidx[iface] if isinstance(iface, int) else bynam[iface]
+        commands += _tc_commands(iface, tcdata[iface.index], **parameters)
+    if len(commands) == 1:
+        execute([TC_PATH] + commands[0])
+    elif commands:
+        execute([TC_PATH, "-batch", "-"],
+                "".join(" ".join(c) + "\n" for c in commands).encode())
+
+
+def _tc_commands(iface, tcdata, bandwidth=None, delay=None, delay_jitter=None,
+                 delay_correlation=None, delay_distribution=None,
+                 loss=None, loss_correlation=None,
+                 dup=None, dup_correlation=None,
+                 corrupt=None, corrupt_correlation=None):
+    # Return the tc arguments that take `iface' from the qdiscs described by
+    # `tcdata' (as returned by get_tc_data()) to the given parameters.
     use_netem = bool(delay or delay_jitter or delay_correlation or
                      delay_distribution or loss or loss_correlation or dup or
                      dup_correlation or corrupt or corrupt_correlation)
 
-    iface = get_if(iface)
-    tcdata, ifdata = get_tc_data()[0:2]
     commands = []
-    if tcdata[iface.index] == 'foreign':
+    if tcdata == 'foreign':
         # Avoid the overhead of calling tc+ip again
-        commands.append([TC_PATH, "qdisc", "del", "dev", iface.name, "root"])
-        tcdata[iface.index] = {'qdiscs': []}
+        commands.append(["qdisc", "del", "dev", iface.name, "root"])
+        tcdata = {'qdiscs': []}
 
-    has_netem = 'netem' in tcdata[iface.index]['qdiscs']
-    has_tbf = 'tbf' in tcdata[iface.index]['qdiscs']
+    has_netem = 'netem' in tcdata['qdiscs']
+    has_tbf = 'tbf' in tcdata['qdiscs']
 
     if not bandwidth and not use_netem:
         if has_netem or has_tbf:
-            clear_tc(iface)
-        return
+            commands.append(["qdisc", "del", "dev", iface.name, "root"])
+        return commands
 
     if has_netem == use_netem and has_tbf == bool(bandwidth):
         cmd = "change"
     else:
         # Too much work to do better :)
         if has_netem or has_tbf:
-            commands.append([TC_PATH, "qdisc", "del", "dev", iface.name,
-                             "root"])
+            commands.append(["qdisc", "del", "dev", iface.name, "root"])
         cmd = "add"
 
     if bandwidth:
         rate = "%dbit" % int(bandwidth)
-        mtu = ifdata[iface.index].mtu
+        mtu = iface.mtu
         burst = max(mtu, int(bandwidth) // HZ)
         limit = burst * 2  # FIXME?
         handle = "1:"
         if cmd == "change":
-            handle = "%d:" % int(tcdata[iface.index]["qdiscs"]["tbf"])
-        command = [TC_PATH, "qdisc", cmd, "dev", iface.name, "root", "handle",
+            handle = "%d:" % int(tcdata["qdiscs"]["tbf"])
+        command = ["qdisc", cmd, "dev", iface.name, "root", "handle",
                    handle, "tbf", "rate", rate, "limit", str(limit), "burst",
                    str(burst)]
         commands.append(command)
@@ -921,12 +983,12 @@ def set_tc(iface, bandwidth=None, delay=None, delay_jitter=None,
     if use_netem:
         handle = "2:"
         if cmd == "change":
-            handle = "%d:" % int(tcdata[iface.index]["qdiscs"]["netem"])
-        command = [TC_PATH, "qdisc", cmd, "dev", iface.name, "handle", handle]
+            handle = "%d:" % int(tcdata["qdiscs"]["netem"])
+        command = ["qdisc", cmd, "dev", iface.name, "handle", handle]
         if bandwidth:
             parent = "1:"
             if cmd == "change":
-                parent = "%d:" % int(tcdata[iface.index]["qdiscs"]["tbf"])
+                parent = "%d:" % int(tcdata["qdiscs"]["tbf"])
             command += ["parent", parent]
         else:
             command += ["root"]
@@ -956,9 +1018,7 @@ def set_tc(iface, bandwidth=None, delay=None, delay_jitter=None,
             if corrupt_correlation:
                 command += ["%f%%" % (corrupt_correlation * 100)]
         commands.append(command)
-
-    for c in commands:
-        execute(c)
+    return commands
 
 
 def create_tap(iface, use_pi=False, tun=False):
@@ -0,0 +1,979 @@
+# vim:ts=4:sw=4:et:ai:sts=4
+# -*- coding: utf-8 -*-
+
+# Copyright 2010, 2011 INRIA
+# Copyright 2011 Martina Ferrari <tina@tina.pm>
+#
+# This file is part of Nemu.
+#
+# Nemu is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 2, as published by the Free
+# Software Foundation.
+#
+# Nemu is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nemu.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Minimal rtnetlink client.
+
+Talks directly to the kernel instead of executing `ip', and can do so inside
+any network name space: the socket is opened by a helper thread that has
+joined the name space, and it stays bound to it afterwards. The methods mirror
+the functions in nemu.iproute and use the same data classes."""
+
+import errno
+import os
+import socket
+import struct
+import threading
+
+import nemu.iproute
+from nemu import compat
+from nemu.environ import *
+
+# netlink(7) and rtnetlink(7) constants
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+SOL_NETLINK = 270
+NETLINK_GET_STRICT_CHK = 12
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_DELQDISC = 37
+
+RTMGRP_LINK = 0x1
+
+IFLA_ADDRESS = 1
+IFLA_BROADCAST = 2
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_MASTER = 10
+IFLA_TXQLEN = 13
+IFLA_LINKINFO = 18
+IFLA_NET_NS_PID = 19
+IFLA_NUM_TX_QUEUES = 31
+IFLA_NUM_RX_QUEUES = 32
+
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+
+IFLA_BR_FORWARD_DELAY = 1
+IFLA_BR_HELLO_TIME = 2
+IFLA_BR_MAX_AGE = 3
+IFLA_BR_AGEING_TIME = 4
+IFLA_BR_STP_STATE = 5
+
+# Unit of the bridge timers, as in sysfs
+USER_HZ = 100
+
+IFF_UP = 0x1
+IFF_NOARP = 0x80
+IFF_MULTICAST = 0x1000
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_BROADCAST = 4
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_HOST = 254
+RT_SCOPE_NOWHERE = 255
+RTM_F_CLONED = 0x200
+
+TC_H_ROOT = 0xffffffff
+
+# genetlink(7) and ethtool-netlink constants
+NETLINK_GENERIC = 16
+NLA_F_NESTED = 0x8000
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+ETHTOOL_MSG_FEATURES_GET = 11
+ETHTOOL_MSG_FEATURES_SET = 12
+ETHTOOL_A_HEADER_DEV_INDEX = 1
+ETHTOOL_A_FEATURES_HEADER = 1
+ETHTOOL_A_FEATURES_WANTED = 3
+ETHTOOL_A_FEATURES_ACTIVE = 4
+ETHTOOL_A_BITSET_NOMASK = 1
+ETHTOOL_A_BITSET_BITS = 3
+ETHTOOL_A_BITSET_BITS_BIT = 1
+ETHTOOL_A_BITSET_BIT_NAME = 2
+ETHTOOL_A_BITSET_BIT_VALUE = 3
+
+# Offload switches, as in `ethtool -K', and the features each one controls
+OFFLOADS = {
+    "gso": ("tx-generic-segmentation",),
+    "gro": ("rx-gro",),
+    "tso": ("tx-tcp-segmentation", "tx-tcp-ecn-segmentation",
+            "tx-tcp-mangleid-segmentation", "tx-tcp6-segmentation"),
+}
+
+_route_types = {1: "unicast", 2: "local", 3: "broadcast", 5: "multicast",
+                6: "blackhole", 7: "unreachable", 8: "prohibit", 9: "throw",
+                10: "nat"}
+
+_nlmsghdr = struct.Struct("=IHHII")
+_ifinfomsg = struct.Struct("=BxHiII")
+_ifaddrmsg = struct.Struct("=BBBBI")
+_rtmsg = struct.Struct("=BBBBBBBBI")
+_tcmsg = struct.Struct("=BxxxiIII")
+_rtattr = struct.Struct("=HH")
+_genlmsghdr = struct.Struct("=BBxx")
+
+
+class NetlinkError(RuntimeError):
+    """Error reported by the kernel; `errno' holds the error number."""
+
+    def __init__(self, err, what):
+        self.errno = err
+        super(NetlinkError, self).__init__("Error from netlink (%s): %s" %
+                                           (what, os.strerror(err)))
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+
+def _attr(tipe, data):
+    return _rtattr.pack(_rtattr.size + len(data), tipe) + data + \
+        b"\0" * (_align(len(data)) - len(data))
+
+
+def _attr_u32(tipe, val):
+    return _attr(tipe, struct.pack("=I", val))
+
+
+def _attr_str(tipe, val):
+    return _attr(tipe, val.encode("utf-8") + b"\0")
+
+
+def _attr_list(data, offset=0):
+    """Return the (type, payload) tuples of the attributes in `data', in
+    order; for lists of nested attributes sharing the same type."""
+    attrs = []
+    while offset + _rtattr.size <= len(data):
+        length, tipe = _rtattr.unpack_from(data, offset)
+        if length < _rtattr.size:
+            break
+        attrs.append((tipe & 0x3fff,
+                      data[offset + _rtattr.size:offset + length]))
+        offset += _align(length)
+    return attrs
+
+
+def _parse_attrs(data, offset=0):
+    return dict(_attr_list(data, offset))
+
+
+def _get_str(attrs, tipe):
+    if tipe not in attrs:
+        return None
+    return attrs[tipe].split(b"\0", 1)[0].decode("utf-8")
+
+
+def _get_u32(attrs, tipe):
+    if tipe not in attrs:
+        return None
+    return struct.unpack("=I", attrs[tipe][0:4])[0]
+
+
+def _lladdr_to_str(data):
+    # only ethernet-like addresses are meaningful for nemu.iproute.interface
+    if data is None or len(data) != 6:
+        return None
+    return ":".join("%02x" % x for x in data)
+
+
+def _str_to_lladdr(addr):
+    return bytes(int(x, 16) for x in nemu.iproute._fix_lladdr(addr).split(":"))
+
+
+def _family(addr):
+    return socket.AF_INET6 if ":" in addr else socket.AF_INET
+
+
+def _pton(addr):
+    return socket.inet_pton(_family(addr), addr)
+
+
+def _if_index(iface):
+    if isinstance(iface, nemu.iproute.interface):
+        return iface.index
+    if isinstance(iface, int):
+        return iface
+    return None
+
+
+def _messages(data):
+    """Split a buffer read from a netlink socket; yields (type, flags,
+    sequence number, payload) tuples."""
+    offset = 0
+    while offset + _nlmsghdr.size <= len(data):
+        length, tipe, flags, seq, _ = _nlmsghdr.unpack_from(data, offset)
+        if length < _nlmsghdr.size:
+            break
+        yield tipe, flags, seq, data[offset + _nlmsghdr.size:offset + length]
+        offset += _align(length)
+
+
+def run_in_netns(netns_fd, func, *args, **kwargs):
+    """Call `func' inside the name space referred by `netns_fd', and return
+    its result. The current thread is not affected: a short-lived helper
+    thread joins the name space and makes the call. Sockets created there
+    stay bound to it, and programs executed from there run in it."""
+    result = {}
+
+    def helper():
+        try:
+            compat.setns(netns_fd, compat.CLONE_NEWNET)
+            result["value"] = func(*args, **kwargs)
+        except BaseException as e:
+            result["error"] = e
+
+    t = threading.Thread(target=helper)
+    t.start()
+    t.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def socket_in_netns(netns_fd, proto=socket.NETLINK_ROUTE):
+    """Open a netlink socket inside the name space referred by `netns_fd'."""
+    return run_in_netns(netns_fd, socket.socket, socket.AF_NETLINK,
+                        socket.SOCK_RAW, proto)
+
+
+class Netlink(object):
+    """Route netlink socket, optionally bound to a different network name
+    space. If `netns_fd' is None, the current name space is used."""
+
+    def __init__(self, netns_fd=None, proto=socket.NETLINK_ROUTE):
+        self._sock = None
+        if netns_fd is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, proto)
+        else:
+            sock = socket_in_netns(netns_fd, proto)
+        try:
+            # Let the kernel filter dumps by the header fields (Linux 4.20+)
+            sock.setsockopt(SOL_NETLINK, NETLINK_GET_STRICT_CHK, 1)
+        except OSError:
+            pass
+        sock.bind((0, 0))
+        self._sock = sock
+        self._seq = 0
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    @property
+    def closed(self) -> bool:
+        return self._sock is None or self._sock.fileno() < 0
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    # Low level stuff
+
+    # Requests sent together by request_many(). Each acknowledgement takes
+    # far more receive buffer space than its size, so this is kept low
+    # enough for a full batch of them to fit in the default buffer.
+    _BATCH_SIZE = 64
+
+    def _pack(self, tipe, flags, payload):
+        self._seq += 1
+        return _nlmsghdr.pack(_nlmsghdr.size + len(payload), tipe,
+                              flags | NLM_F_REQUEST, self._seq, 0) + payload
+
+    def _send(self, tipe, flags, payload):
+        if not self._sock:
+            raise RuntimeError("Netlink socket already closed.")
+        self._sock.sendall(self._pack(tipe, flags, payload))
+        return self._seq
+
+    def _receive(self, seq, what):
+        """Read replies for sequence number `seq' until the request is
+        complete. Returns a list of (type, payload) tuples."""
+        msgs = []
+        while True:
+            data = eintr_wrapper(self._sock.recv, 1 << 16)
+            for tipe, flags, mseq, payload in _messages(data):
+                if mseq != seq:
+                    continue  # stale reply
+                if tipe == NLMSG_ERROR:
+                    err = -struct.unpack_from("=i", payload)[0]
+                    if err:
+                        raise NetlinkError(err, what)
+                    return msgs  # ACK
+                if tipe == NLMSG_DONE:
+                    return msgs
+                msgs.append((tipe, payload))
+                if not flags & NLM_F_MULTI:
+                    return msgs
+
+    def request(self, tipe, payload, flags=0, what=None):
+        """Send a request and wait for the acknowledgement or answer."""
+        seq = self._send(tipe, flags | NLM_F_ACK, payload)
+        return self._receive(seq, what or "request %d" % tipe)
+
+    def request_many(self, requests, what=None):
+        """Send several (type, payload, flags) requests, many of them in a
+        single write, and wait for all the acknowledgements. The requests are
+        independent: the kernel processes all of them even if some fail.
+        Returns a list with None, or the NetlinkError, for each request."""
+        if not self._sock:
+            raise RuntimeError("Netlink socket already closed.")
+        what = what or "request"
+        results = []
+        for start in range(0, len(requests), self._BATCH_SIZE):
+            batch = requests[start:start + self._BATCH_SIZE]
+            first = self._seq + 1
+            self._sock.sendall(b"".join(
+                self._pack(tipe, flags | NLM_F_ACK, payload)
+                for tipe, payload, flags in batch))
+            res = [None] * len(batch)
+            pending = set(range(first, first + len(batch)))
+            while pending:
+                data = eintr_wrapper(self._sock.recv, 1 << 16)
+                for tipe, flags, mseq, payload in _messages(data):
+                    if tipe != NLMSG_ERROR or mseq not in pending:
+                        continue  # stale reply
+                    pending.discard(mseq)
+                    err = -struct.unpack_from("=i", payload)[0]
+                    if err:
+                        res[mseq - first] = NetlinkError(err, what)
+            results.extend(res)
+        return results
+
+    def dump(self, tipe, payload, what=None):
+        """Send a dump request and return all the answers."""
+        seq = self._send(tipe, NLM_F_DUMP, payload)
+        return self._receive(seq, what or "dump %d" % tipe)
+
+    # Interface handling
+
+    @staticmethod
+    def _parse_link(payload):
+        _, _, index, flags, _ = _ifinfomsg.unpack_from(payload)
+        attrs = _parse_attrs(payload, _ifinfomsg.size)
+        return nemu.iproute.interface(
+            index=index,
+            name=_get_str(attrs, IFLA_IFNAME),
+            up=bool(flags & IFF_UP),
+            mtu=_get_u32(attrs, IFLA_MTU),
+            lladdr=_lladdr_to_str(attrs.get(IFLA_ADDRESS)),
+            broadcast=_lladdr_to_str(attrs.get(IFLA_BROADCAST)),
+            multicast=bool(flags & IFF_MULTICAST),
+            arp=not flags & IFF_NOARP)
+
+    def get_if_data(self):
+        """Same as nemu.iproute.get_if_data."""
+        byidx = {}
+        bynam = {}
+        for tipe, payload in self.dump(RTM_GETLINK, _ifinfomsg.pack(
+                socket.AF_UNSPEC, 0, 0, 0, 0), "link dump"):
+            i = self._parse_link(payload)
+            byidx[i.index] = bynam[i.name] = i
+        return byidx, bynam
+
+    def get_if(self, iface):
+        """Same as nemu.iproute.get_if; raises KeyError if the interface does
+        not exist."""
+        return self._parse_link(self._get_link(iface))
+
+    def _get_link(self, iface):
+        idx = _if_index(iface)
+        if idx is not None:
+            payload = _ifinfomsg.pack(socket.AF_UNSPEC, 0, idx, 0, 0)
+        else:
+            name = iface.name if isinstance(
+                iface, nemu.iproute.interface) else iface
+            payload = _ifinfomsg.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + \
+                _attr_str(IFLA_IFNAME, name)
+        try:
+            msgs = self.request(RTM_GETLINK, payload, what="get link")
+        except NetlinkError as e:
+            if e.errno == errno.ENODEV:
+                raise KeyError(iface)
+            raise
+        return msgs[0][1]
+
+    def _setlink(self, index, flags=0, change=0, attrs=b""):
+        self.request(RTM_NEWLINK, _ifinfomsg.pack(
+            socket.AF_UNSPEC, 0, index, flags, change) + attrs,
+                     what="set link")
+
+    def set_if(self, iface, recover=True):
+        """Same as nemu.iproute.set_if: only the attributes that differ from
+        the current state are changed, using at most two requests."""
+        orig = self.get_if(iface)
+        diff = iface - orig
+        # The kernel refuses to rename, or change the address of, an
+        # interface that is up.
+        down = bool(orig.up and (diff.name or diff.lladdr))
+
+        flags = change = 0
+        attrs = b""
+        if diff.name:
+            attrs += _attr_str(IFLA_IFNAME, diff.name)
+        if diff.lladdr:
+            attrs += _attr(IFLA_ADDRESS, _str_to_lladdr(diff.lladdr))
+        if diff.mtu:
+            attrs += _attr_u32(IFLA_MTU, diff.mtu)
+        if diff.broadcast:
+            attrs += _attr(IFLA_BROADCAST, _str_to_lladdr(diff.broadcast))
+        if diff.multicast is not None:
+            change |= IFF_MULTICAST
+            flags |= IFF_MULTICAST if diff.multicast else 0
+        if diff.arp is not None:
+            change |= IFF_NOARP
+            flags |= 0 if diff.arp else IFF_NOARP
+        up = diff.up
+        if down and up is None:
+            up = True  # restore
+        if up is not None:
+            change |= IFF_UP
+            flags |= IFF_UP if up else 0
+        if not change and not attrs:
+            return
+
+        try:
+            if down:
+                self._setlink(orig.index, 0, IFF_UP)
+            self._setlink(orig.index, flags, change, attrs)
+        except:
+            if recover:
+                self.set_if(orig, recover=False)  # rollback
+            raise
+
+    def create_veths(self, pairs, numtxqueues=None, numrxqueues=None):
+        """Create many veth pairs with batched requests. `pairs' is a list of
+        (name, netns, peer_name, peer_netns) tuples; each netns is the pid of
+        a process in the name space where that end is created, or None for
+        the name space of this socket. The number of queues, if given, is
+        used for both ends; it cannot be changed later. Returns the same as
+        request_many()."""
+        queues = b""
+        if numtxqueues:
+            queues += _attr_u32(IFLA_NUM_TX_QUEUES, int(numtxqueues))
+        if numrxqueues:
+            queues += _attr_u32(IFLA_NUM_RX_QUEUES, int(numrxqueues))
+        reqs = []
+        for name, netns, peer, peer_netns in pairs:
+            info = _ifinfomsg.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + \
+                _attr_str(IFLA_IFNAME, peer) + queues
+            if peer_netns is not None:
+                info += _attr_u32(IFLA_NET_NS_PID, int(peer_netns))
+            payload = _ifinfomsg.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + \
+                _attr_str(IFLA_IFNAME, name) + queues
+            if netns is not None:
+                payload += _attr_u32(IFLA_NET_NS_PID, int(netns))
+            payload += _attr(IFLA_LINKINFO,
+                             _attr_str(IFLA_INFO_KIND, "veth") +
+                             _attr(IFLA_INFO_DATA, _attr(VETH_INFO_PEER, info)))
+            reqs.append((RTM_NEWLINK, payload, NLM_F_CREATE | NLM_F_EXCL))
+        return self.request_many(reqs, "create veth")
+
+    def del_if(self, iface):
+        idx = _if_index(iface)
+        if idx is None:
+            idx = self.get_if(iface).index
+        self.request(RTM_DELLINK, _ifinfomsg.pack(socket.AF_UNSPEC, 0, idx,
+                                                  0, 0), what="delete link")
+
+    # Bridges
+
+    def create_bridge(self, br):
+        """Same as nemu.iproute.create_bridge."""
+        if isinstance(br, str):
+            br = nemu.iproute.interface(name=br)
+        assert br.name
+        self.request(RTM_NEWLINK, _ifinfomsg.pack(
+            socket.AF_UNSPEC, 0, 0, 0, 0) + _attr_str(IFLA_IFNAME, br.name) +
+                     _attr(IFLA_LINKINFO, _attr_str(IFLA_INFO_KIND, "bridge")),
+                     NLM_F_CREATE | NLM_F_EXCL, "create bridge")
+        try:
+            self.set_if(br)
+        except:
+            try:
+                self.del_if(br.name)
+            except:
+                pass
+            raise
+        return self.get_if(br.name)
+
+    def get_bridge(self, br):
+        """Same as nemu.iproute.get_bridge."""
+        payload = self._get_link(br)
+        attrs = _parse_attrs(payload, _ifinfomsg.size)
+        info = _parse_attrs(attrs.get(IFLA_LINKINFO, b""))
+        data = _parse_attrs(info.get(IFLA_INFO_DATA, b""))
+
+        def timer(tipe):
+            return float(_get_u32(data, tipe)) / USER_HZ
+        return nemu.iproute.bridge.upgrade(
+            self._parse_link(payload),
+            stp=_get_u32(data, IFLA_BR_STP_STATE),
+            forward_delay=timer(IFLA_BR_FORWARD_DELAY),
+            hello_time=timer(IFLA_BR_HELLO_TIME),
+            ageing_time=timer(IFLA_BR_AGEING_TIME),
+            max_age=timer(IFLA_BR_MAX_AGE))
+
+    def set_bridge(self, br, recover=True):
+        """Same as nemu.iproute.set_bridge, with all the bridge attributes
+        changed in a single request."""
+        orig = self.get_bridge(br)
+        diff = br - orig  # Only set what's needed
+
+        data = b""
+        if diff.stp is not None:
+            data += _attr_u32(IFLA_BR_STP_STATE, int(diff.stp))
+        for tipe, val in ((IFLA_BR_FORWARD_DELAY, diff.forward_delay),
+                          (IFLA_BR_HELLO_TIME, diff.hello_time),
+                          (IFLA_BR_AGEING_TIME, diff.ageing_time),
+                          (IFLA_BR_MAX_AGE, diff.max_age)):
+            if val is not None:
+                data += _attr_u32(tipe, int(round(val * USER_HZ)))
+
+        self.set_if(diff)
+        if not data:
+            return
+        try:
+            self._setlink(orig.index, attrs=_attr(IFLA_LINKINFO, _attr_str(
+                IFLA_INFO_KIND, "bridge") + _attr(IFLA_INFO_DATA, data)))
+        except:
+            if recover:
+                self.set_bridge(orig, recover=False)  # rollback
+            raise
+
+    def del_bridge(self, br):
+        """Same as nemu.iproute.del_bridge."""
+        self.del_if(br)
+
+    def add_bridge_port(self, br, iface):
+        """Same as nemu.iproute.add_bridge_port."""
+        br = _if_index(br) or self.get_if(br).index
+        iface = _if_index(iface) or self.get_if(iface).index
+        self._setlink(iface, attrs=_attr_u32(IFLA_MASTER, br))
+
+    def del_bridge_port(self, br, iface):
+        """Same as nemu.iproute.del_bridge_port."""
+        iface = _if_index(iface) or self.get_if(iface).index
+        self._setlink(iface, attrs=_attr_u32(IFLA_MASTER, 0))
+
+    def get_bridge_ports(self, br):
+        """Return the indices of the interfaces attached to the bridge with
+        index `br', using a single dump filtered by the kernel."""
+        ports = []
+        for tipe, payload in self.dump(RTM_GETLINK, _ifinfomsg.pack(
+                socket.AF_UNSPEC, 0, 0, 0, 0) + _attr_u32(IFLA_MASTER, br),
+                                       "bridge ports dump"):
+            # Old kernels ignore the filter
+            attrs = _parse_attrs(payload, _ifinfomsg.size)
+            if _get_u32(attrs, IFLA_MASTER) == br:
+                ports.append(_ifinfomsg.unpack_from(payload)[2])
+        return ports
+
+    def release_ports(self, ports):
+        """Detach each interface index in `ports' from its bridge, and bring
+        it down. Returns the same as request_many()."""
+        return self.request_many([
+            (RTM_NEWLINK, _ifinfomsg.pack(socket.AF_UNSPEC, 0, idx, 0, IFF_UP) +
+             _attr_u32(IFLA_MASTER, 0), 0) for idx in ports], "release port")
+
+    def clear_qdiscs(self, ports):
+        """Remove the root qdisc of each interface index in `ports', falling
+        back to the default one. Returns the same as request_many()."""
+        return self.request_many([
+            (RTM_DELQDISC, _tcmsg.pack(socket.AF_UNSPEC, idx, 0, TC_H_ROOT, 0),
+             0) for idx in ports], "delete qdisc")
+
+    def change_netns(self, iface, netns):
+        """Move the interface to the name space of process `netns'."""
+        idx = _if_index(iface)
+        if idx is None:
+            idx = self.get_if(iface).index
+        self._setlink(idx, attrs=_attr_u32(IFLA_NET_NS_PID, int(netns)))
+
+    # Address handling
+
+    def get_addr_data(self):
+        """Same as nemu.iproute.get_addr_data."""
+        byidx = {}
+        bynam = {}
+        for i in self.get_if_data()[0].values():
+            bynam[i.name] = byidx[i.index] = []
+        for tipe, payload in self.dump(RTM_GETADDR, _ifaddrmsg.pack(
+                socket.AF_UNSPEC, 0, 0, 0, 0), "address dump"):
+            addr = self._parse_addr(payload)
+            if addr[0] in byidx:
+                byidx[addr[0]].append(addr[1])
+        return byidx, bynam
+
+    def get_addr(self, iface):
+        """Same as nemu.iproute.get_addr: the addresses of a single interface,
+        using a dump filtered by the kernel."""
+        idx = _if_index(iface)
+        if idx is None:
+            idx = self.get_if(iface).index
+        ret = []
+        for tipe, payload in self.dump(RTM_GETADDR, _ifaddrmsg.pack(
+                socket.AF_UNSPEC, 0, 0, 0, idx), "address dump"):
+            addr = self._parse_addr(payload)
+            # Old kernels ignore the filter
+            if addr[0] == idx:
+                ret.append(addr[1])
+        return ret
+
+    @staticmethod
+    def _parse_addr(payload):
+        family, plen, _, _, index = _ifaddrmsg.unpack_from(payload)
+        attrs = _parse_attrs(payload, _ifaddrmsg.size)
+        if family == socket.AF_INET:
+            local = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            brd = attrs.get(IFA_BROADCAST)
+            return index, nemu.iproute.ipv4address(
+                address=socket.inet_ntop(family, local), prefix_len=plen,
+                broadcast=socket.inet_ntop(family, brd) if brd else None)
+        return index, nemu.iproute.ipv6address(
+            address=socket.inet_ntop(family, attrs[IFA_ADDRESS]),
+            prefix_len=plen)
+
+    def _addr_msg(self, iface, address):
+        idx = _if_index(iface)
+        if idx is None:
+            idx = self.get_if(iface).index
+        local = _pton(address.address)
+        scope = RT_SCOPE_UNIVERSE
+        if address.family == socket.AF_INET and local[0] == 127:
+            scope = RT_SCOPE_HOST
+        return idx, local, _ifaddrmsg.pack(address.family,
+                                           int(address.prefix_len), 0,
+                                           scope, idx)
+
+    def add_addr(self, iface, address):
+        idx, local, msg = self._addr_msg(iface, address)
+        msg += _attr(IFA_LOCAL, local) + _attr(IFA_ADDRESS, local)
+        if address.family == socket.AF_INET:
+            plen = int(address.prefix_len)
+            if address.broadcast:
+                msg += _attr(IFA_BROADCAST, _pton(address.broadcast))
+            elif plen < 31:  # same as `brd +'
+                host = (1 << (32 - plen)) - 1
+                brd = struct.unpack("!I", local)[0] | host
+                msg += _attr(IFA_BROADCAST, struct.pack("!I", brd))
+        self.request(RTM_NEWADDR, msg, NLM_F_CREATE | NLM_F_EXCL,
+                     "add address")
+
+    def del_addr(self, iface, address):
+        idx, local, msg = self._addr_msg(iface, address)
+        msg += _attr(IFA_LOCAL, local)
+        self.request(RTM_DELADDR, msg, what="delete address")
+
+    # Routing
+
+    def get_all_route_data(self):
+        """Same as nemu.iproute.get_all_route_data: routes in the main
+        table."""
+        ret = []
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for tipe, payload in self.dump(RTM_GETROUTE, _rtmsg.pack(
+                    family, 0, 0, 0, 0, 0, 0, 0, 0), "route dump"):
+                r = self._parse_route(payload)
+                if r:
+                    ret.append(r)
+        return ret
+
+    @staticmethod
+    def _parse_route(payload):
+        (family, dst_len, _, _, table, _, _, tipe,
+         flags) = _rtmsg.unpack_from(payload)
+        attrs = _parse_attrs(payload, _rtmsg.size)
+        table = _get_u32(attrs, RTA_TABLE) or table
+        if table != RT_TABLE_MAIN or flags & RTM_F_CLONED or \
+                tipe not in _route_types:
+            return None
+        prefix = None
+        if dst_len and RTA_DST in attrs:
+            prefix = socket.inet_ntop(family, attrs[RTA_DST])
+        nexthop = None
+        if RTA_GATEWAY in attrs:
+            nexthop = socket.inet_ntop(family, attrs[RTA_GATEWAY])
+        oif = _get_u32(attrs, RTA_OIF)
+        if not nexthop and not oif:
+            return None
+        return nemu.iproute.route(_route_types[tipe], prefix, dst_len,
+                                  nexthop, oif, _get_u32(attrs,
+                                                         RTA_PRIORITY) or 0)
+
+    def get_route_data(self):
+        # filter out non-unicast routes
+        return [x for x in self.get_all_route_data() if x.tipe == "unicast"]
+
+    def add_route(self, route):
+        self._add_del_route(RTM_NEWROUTE, route)
+
+    def del_route(self, route):
+        self._add_del_route(RTM_DELROUTE, route)
+
+    def _add_del_route(self, action, route):
+        # Mimic the defaults used by `ip route'
+        family = _family(route.prefix or route.nexthop or "0.0.0.0")
+        tipe = [k for k, v in _route_types.items() if v == route.tipe][0]
+        if action == RTM_NEWROUTE:
+            proto = RTPROT_BOOT
+            if route.tipe in ("local", "nat"):
+                scope = RT_SCOPE_HOST
+            elif route.tipe in ("broadcast", "multicast"):
+                scope = RT_SCOPE_LINK
+            elif route.tipe == "unicast" and not route.nexthop:
+                scope = RT_SCOPE_LINK
+            else:
+                scope = RT_SCOPE_UNIVERSE
+            flags = NLM_F_CREATE | NLM_F_EXCL
+        else:
+            proto = 0
+            scope = RT_SCOPE_NOWHERE
+            flags = 0
+        plen = route.prefix_len if route.prefix else 0
+        msg = _rtmsg.pack(family, plen, 0, 0, RT_TABLE_MAIN, proto, scope,
+                          tipe, 0)
+        if route.prefix:
+            msg += _attr(RTA_DST, _pton(route.prefix))
+        if route.nexthop:
+            msg += _attr(RTA_GATEWAY, _pton(route.nexthop))
+        if route.interface:
+            msg += _attr_u32(RTA_OIF, route.interface)
+        if route.metric:
+            msg += _attr_u32(RTA_PRIORITY, route.metric)
+        self.request(action, msg, flags, "%s route" % (
+            "add" if action == RTM_NEWROUTE else "delete"))
+
+
+class Ethtool(Netlink):
+    """Generic netlink socket talking to the kernel's ethtool interface, in
+    the current name space or the one referred by `netns_fd'."""
+
+    def __init__(self, netns_fd=None):
+        super(Ethtool, self).__init__(netns_fd, NETLINK_GENERIC)
+        try:
+            ((tipe, payload),) = self.request(
+                GENL_ID_CTRL, _genlmsghdr.pack(CTRL_CMD_GETFAMILY, 1) +
+                _attr_str(CTRL_ATTR_FAMILY_NAME, "ethtool"),
+                what="resolve ethtool family")
+        except BaseException:
+            self.close()
+            raise
+        attrs = _parse_attrs(payload, _genlmsghdr.size)
+        self._family = struct.unpack("=H", attrs[CTRL_ATTR_FAMILY_ID][:2])[0]
+
+    @staticmethod
+    def _header(index):
+        return _attr(ETHTOOL_A_FEATURES_HEADER | NLA_F_NESTED,
+                     _attr_u32(ETHTOOL_A_HEADER_DEV_INDEX, index))
+
+    def get_features(self, index):
+        """Return a set with the names of the features active in the
+        interface with index `index'."""
+        ((tipe, payload),) = self.request(
+            self._family, _genlmsghdr.pack(ETHTOOL_MSG_FEATURES_GET, 1) +
+            self._header(index), what="get features")
+        attrs = _parse_attrs(payload, _genlmsghdr.size)
+        bitset = _parse_attrs(attrs[ETHTOOL_A_FEATURES_ACTIVE])
+        # Without a mask, only the bits that are set get listed.
+        nomask = ETHTOOL_A_BITSET_NOMASK in bitset
+        active = set()
+        for tipe, bit in _attr_list(bitset.get(ETHTOOL_A_BITSET_BITS, b"")):
+            bit = _parse_attrs(bit)
+            if nomask or ETHTOOL_A_BITSET_BIT_VALUE in bit:
+                active.add(_get_str(bit, ETHTOOL_A_BITSET_BIT_NAME))
+        return active
+
+    def set_features(self, index, features):
+        """Turn on or off the features of the interface with index `index'
+        named in the `features' dictionary, like `ethtool -K'."""
+        bits = b""
+        for name, value in features.items():
+            bit = _attr_str(ETHTOOL_A_BITSET_BIT_NAME, name)
+            if value:
+                bit += _attr(ETHTOOL_A_BITSET_BIT_VALUE, b"")
+            bits += _attr(ETHTOOL_A_BITSET_BITS_BIT | NLA_F_NESTED, bit)
+        self.request(
+            self._family, _genlmsghdr.pack(ETHTOOL_MSG_FEATURES_SET, 1) +
+            self._header(index) +
+            _attr(ETHTOOL_A_FEATURES_WANTED | NLA_F_NESTED,
+                  _attr(ETHTOOL_A_BITSET_BITS | NLA_F_NESTED, bits)),
+            what="set features")
+
+
+def set_link_options(index, txqueuelen=None, gso=None, gro=None, tso=None,
+                     netlink=None, ethtool=None):
+    """Set the transmit queue length, and turn on or off the offloads named
+    in OFFLOADS, for the interface with index `index' in the current name
+    space. Options that are None are left alone. The Netlink and Ethtool
+    sockets to use can be given, otherwise they are opened for the call;
+    `ethtool' can be a function returning it, to open it only if needed."""
+    if txqueuelen is not None:
+        nl = netlink or Netlink()
+        try:
+            nl._setlink(index, attrs=_attr_u32(IFLA_TXQLEN, int(txqueuelen)))
+        finally:
+            if nl is not netlink:
+                nl.close()
+    features = {}
+    for key, value in (("gso", gso), ("gro", gro), ("tso", tso)):
+        if value is not None:
+            for name in OFFLOADS[key]:
+                features[name] = bool(value)
+    if features:
+        if callable(ethtool):
+            ethtool = ethtool()
+        et = ethtool or Ethtool()
+        try:
+            et.set_features(index, features)
+        finally:
+            if et is not ethtool:
+                et.close()
+
+
+class LinkMonitor(object):
+    """Keeps track of the interfaces in a name space using the kernel's link
+    notifications, so looking them up does not need a dump. `links' maps
+    interface indices to nemu.iproute.interface objects, and `indices' names
+    to indices; call update() to bring both up to date."""
+
+    def __init__(self, netns_fd=None):
+        self._sock = None
+        if netns_fd is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 socket.NETLINK_ROUTE)
+        else:
+            sock = socket_in_netns(netns_fd)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.bind((0, RTMGRP_LINK))
+        self._sock = sock
+        self._seq = 0
+        self.links = {}
+        self.indices = {}
+        self._changed = set()
+        self._gone = set()
+        self._resync()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def _apply(self, tipe, payload):
+        index = _ifinfomsg.unpack_from(payload)[2]
+        old = self.links.pop(index, None)
+        if old is not None and self.indices.get(old.name) == index:
+            del self.indices[old.name]
+        if tipe == RTM_NEWLINK:
+            link = Netlink._parse_link(payload)
+            self.links[index] = link
+            self.indices[link.name] = index
+            self._changed.add(index)
+        elif tipe == RTM_DELLINK:
+            self._gone.add(index)
+
+    def _resync(self):
+        """Rebuild the maps from scratch with a dump. Notifications received
+        in the middle are applied in order, so nothing gets lost."""
+        old = set(self.links)
+        while True:
+            self.links = {}
+            self.indices = {}
+            self._seq += 1
+            self._sock.sendall(_nlmsghdr.pack(
+                _nlmsghdr.size + _ifinfomsg.size, RTM_GETLINK,
+                NLM_F_REQUEST | NLM_F_DUMP, self._seq, 0) +
+                _ifinfomsg.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+            try:
+                if self._read_dump():
+                    break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # notifications were lost; start over
+        self._gone |= old - set(self.links)
+
+    def _read_dump(self):
+        while True:
+            data = eintr_wrapper(self._sock.recv, 1 << 16)
+            for tipe, flags, seq, payload in _messages(data):
+                if seq == self._seq:
+                    if tipe == NLMSG_DONE:
+                        return True
+                    if tipe == NLMSG_ERROR:
+                        err = -struct.unpack_from("=i", payload)[0]
+                        raise NetlinkError(err, "link dump")
+                elif seq != 0:
+                    continue  # stale reply
+                self._apply(tipe, payload)
+
+    def update(self):
+        """Process pending notifications without blocking. Returns a tuple
+        with the sets of indices of the interfaces that changed (or
+        appeared), and of those that went away, since the last call."""
+        if not self._sock:
+            raise RuntimeError("Netlink socket already closed.")
+        try:
+            while True:
+                try:
+                    data = self._sock.recv(1 << 16, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                for tipe, flags, seq, payload in _messages(data):
+                    if seq == 0:
+                        self._apply(tipe, payload)
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            # The socket overflowed, the state has to be read again.
+            self._resync()
+        changed = set(i for i in self._changed if i in self.links)
+        gone = set(i for i in self._gone if i not in self.links)
+        self._changed = set()
+        self._gone = set()
+        return changed, gone
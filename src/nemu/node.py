@@ -17,24 +17,31 @@
 # You should have received a copy of the GNU General Public License along with
 # Nemu.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import os
+import signal
 import socket
 import sys
-import traceback
 from typing import MutableMapping
 
-import unshare
 import weakref
 
+import nemu.asyncio_
+import nemu.cgroup
 import nemu.interface
 import nemu.iproute
+import nemu.netlink
 import nemu.protocol
+import nemu.slave
 import nemu.subprocess_
 from nemu import compat
 from nemu.environ import *
 
 __all__ = ['Node', 'get_nodes', 'import_if']
 
+# Where iproute2 keeps persistent network name spaces
+NETNS_RUN_DIR = "/run/netns"
+
 class Node(object):
     _nodes: MutableMapping[int, "Node"] = weakref.WeakValueDictionary()
     _nextnode = 0
@@ -45,31 +52,122 @@ class Node(object):
         s = sorted(list(Node._nodes.items()), key = lambda x: x[0])
         return [x[1] for x in s]
 
-    def __init__(self, nonetns = False, forward_X11 = False):
+    def __init__(self, nonetns = False, forward_X11 = False, name = None,
+            direct = True, lean = False, direct_spawn = False, cgroup = False):
         """Create a new node in the emulation. Implemented as a separate
         process in a new network name space. Requires root privileges to run.
 
         If nonetns is true, the network name space is not created and can be
-        run as a normal user, for testing."""
-
+        run as a normal user, for testing.
+
+        If name is given, the name space is bind-mounted under /run/netns
+        (like `ip netns add' does), so it survives the destruction of this
+        object and can be reused later with Node.attach() or iproute2.
+
+        If direct is true (the default), interfaces, addresses and routes are
+        configured from this process through a netlink socket opened inside
+        the node's name space, instead of asking the slave process.
+
+        If lean is true, the slave is a freshly executed, minimal Python
+        interpreter instead of a fork of this process. Its memory footprint
+        is then small and independent of the size of the controller, at the
+        cost of a slower start-up.
+
+        If direct_spawn is true, processes are started by a helper thread of
+        this process, which joins the node's name space with setns(2) and
+        uses posix_spawn(3) (or fork and exec, when a user, a working
+        directory or a cgroup is given), instead of asking the slave; so
+        they are children of this process. Spawning from many nodes at once
+        is then not limited by their slaves. It is ignored when X11 is
+        forwarded.
+
+        If cgroup is true, the processes of the node are placed in their own
+        cgroup (v2), so their resources can be limited with set_resources()
+        and accounted for with usage(); when the node is destroyed, they are
+        all killed at once."""
+        if nonetns and name:
+            raise ValueError("A named node needs its own name space")
+        self._setup(nonetns, forward_X11, name, direct, lean, attach = False,
+                direct_spawn = direct_spawn, cgroup = cgroup)
+
+    @classmethod
+    def attach(cls, name, forward_X11 = False, direct = True, lean = False,
+            direct_spawn = False, cgroup = False):
+        """Create a new node that runs inside the existing, persistent network
+        name space `name' (as found in /run/netns), instead of creating a new
+        one. Interfaces already present are available through
+        get_interfaces()."""
+        node = cls.__new__(cls)
+        node._setup(False, forward_X11, name, direct, lean, attach = True,
+                direct_spawn = direct_spawn, cgroup = cgroup)
+        return node
+
+    @classmethod
+    def _create_hidden(cls):
+        # A node for nemu's own use, not listed by get_nodes()
+        node = cls.__new__(cls)
+        node._setup(False, False, None, True, False, attach = False,
+                hidden = True)
+        return node
+
+    def _setup(self, nonetns, forward_X11, name, direct, lean, attach,
+            hidden = False, direct_spawn = False, cgroup = False):
         # Initialize attributes, in case something fails during __init__
-        self._pid = self._slave = None
+        self._pid = self._slave = self._spawner = self._links = None
+        self._cgroup = None
+        self._netns_fd = None
+        self._name = None
         self._processes = weakref.WeakValueDictionary()
         self._interfaces = weakref.WeakValueDictionary()
-        self._auto_interfaces = [] # just to keep them alive!
+        self._auto_interfaces = {} # just to keep them alive!
 
-        fd, pid = _start_child(nonetns)
+        netns_fd = None
+        if attach:
+            netns_fd = os.open(os.path.join(NETNS_RUN_DIR, name), os.O_RDONLY)
+        try:
+            fd, pid = _start_child(nonetns, netns_fd, lean)
+        finally:
+            if netns_fd is not None:
+                os.close(netns_fd)
         self._pid = pid
         debug("Node(0x%x).__init__(), pid = %s" % (id(self), pid))
-        self._slave = nemu.protocol.Client(fd, fd)
+        if direct:
+            self._slave = nemu.protocol.NetnsClient(fd, fd,
+                    None if nonetns else pid)
+        else:
+            self._slave = nemu.protocol.Client(fd, fd)
+        # Keep track of interface names and indices from link notifications
+        netns_fd = None
+        if not nonetns:
+            netns_fd = os.open("/proc/%d/ns/net" % pid,
+                    os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            self._links = nemu.netlink.LinkMonitor(netns_fd)
+        finally:
+            if direct_spawn and not forward_X11:
+                # Kept open for the children to join
+                self._netns_fd = netns_fd
+                self._spawner = _DirectSpawner(netns_fd)
+            elif netns_fd is not None:
+                os.close(netns_fd)
+        if not self._spawner:
+            self._spawner = self._slave
+        if cgroup:
+            self._cgroup = nemu.cgroup.Cgroup("node-%d" % pid)
+            self._spawner.set_cgroup(self._cgroup.path)
+        if name:
+            if not attach:
+                execute([IP_PATH, "netns", "attach", name, str(pid)])
+            self._name = name
         if forward_X11:
             self._slave.enable_x11_forwarding()
 
-        Node._nodes[Node._nextnode] = self
-        Node._nextnode += 1
+        if not hidden:
+            Node._nodes[Node._nextnode] = self
+            Node._nextnode += 1
 
         # Bring loopback up
-        if not nonetns:
+        if not nonetns and not attach:
             self.get_interface("lo").up = True
 
     def __del__(self):
@@ -80,28 +178,79 @@ class Node(object):
         if not self._pid:
             return
         debug("Node(0x%x).destroy()" % id(self))
-        for p in self._processes.values():
-            p.destroy()
+        if self._cgroup:
+            # All at once, including processes they started
+            self._cgroup.kill()
+            for p in list(self._processes.values()):
+                p.wait()
+        else:
+            nemu.subprocess_.terminate_all(list(self._processes.values()))
         self._processes.clear()
 
-        # Use get_interfaces to force a rescan
-        for i in self.get_interfaces():
-            i.destroy()
+        if self._name:
+            # Persistent name space: interfaces stay there, just forget them
+            for i in self._interfaces.values():
+                i._slave = None
+        else:
+            # Interfaces without a wrapper were never touched by us
+            self._update_interfaces()
+            for i in list(self._interfaces.values()):
+                i.destroy()
         self._interfaces.clear()
+        self._auto_interfaces.clear()
 
+        if self._links:
+            self._links.close()
         if self._slave:
             self._slave.shutdown()
 
+        if self._spawner is not self._slave:
+            self._spawner.close()
+        if self._netns_fd is not None:
+            os.close(self._netns_fd)
+        if self._cgroup:
+            self._cgroup.destroy()
+
         exitcode = eintr_wrapper(os.waitpid, self._pid, 0)[1]
         if exitcode != 0:
             error("Node(0x%x) process %d exited with non-zero status: %d" %
                     (id(self), self._pid, exitcode))
-        self._pid = self._slave = None
+        self._pid = self._slave = self._spawner = self._links = None
+        self._netns_fd = self._cgroup = None
 
     @property
     def pid(self) -> int:
         return self._pid
 
+    @property
+    def name(self) -> str:
+        """Name of the persistent name space, or None."""
+        return self._name
+
+    def delete_netns(self):
+        """Remove the /run/netns entry of a persistent node, so the name space
+        (and everything in it) goes away together with this node."""
+        if not self._name:
+            return
+        execute([IP_PATH, "netns", "delete", self._name])
+        self._name = None
+
+    # Resources
+    def _get_cgroup(self) -> nemu.cgroup.Cgroup:
+        if not self._cgroup:
+            raise RuntimeError("Node created without a cgroup")
+        return self._cgroup
+
+    def set_resources(self, *kargs, **kwargs):
+        """Limits the resources used by the processes of the node; see
+        nemu.cgroup.Cgroup.set_parameters()."""
+        self._get_cgroup().set_parameters(*kargs, **kwargs)
+
+    def usage(self) -> dict[str, int]:
+        """CPU time and memory used by the processes of the node; see
+        nemu.cgroup.Cgroup.usage()."""
+        return self._get_cgroup().usage()
+
     # Subprocesses
     def _add_subprocess(self, subprocess: nemu.subprocess_.Subprocess):
         self._processes[subprocess.pid] = subprocess
@@ -112,6 +261,18 @@ class Node(object):
     def Popen(self, *kargs, **kwargs):
         return nemu.subprocess_.Popen(self, *kargs, **kwargs)
 
+    def spawn_many(self, *kargs, **kwargs):
+        return nemu.subprocess_.spawn_many(self, *kargs, **kwargs)
+
+    def register_profile(self, user = None, env = None, cwd = None) -> int:
+        """Resolves the credentials of `user' and builds the environment of
+        new processes once, inside the node. Returns an id that can be passed
+        as `profile' to Subprocess, Popen and friends."""
+        return self._spawner.add_profile(user = user, env = env, cwd = cwd)
+
+    def unregister_profile(self, profile: int):
+        self._spawner.del_profile(profile)
+
     def system(self, *kargs, **kwargs):
         return nemu.subprocess_.system(self, *kargs, **kwargs)
 
@@ -121,26 +282,44 @@ class Node(object):
     def backticks_raise(self, *kargs, **kwargs):
         return nemu.subprocess_.backticks_raise(self, *kargs, **kwargs)
 
+    def create_subprocess_exec(self, *kargs, **kwargs):
+        return nemu.asyncio_.create_subprocess_exec(self, *kargs, **kwargs)
+
+    def create_subprocess_shell(self, *kargs, **kwargs):
+        return nemu.asyncio_.create_subprocess_shell(self, *kargs, **kwargs)
+
     # Interfaces
     def _add_interface(self, interface: nemu.interface.Interface):
         self._interfaces[interface.index] = interface
 
-    def add_if(self, **kwargs):
-        i = nemu.interface.NodeInterface(self)
-        for k, v in kwargs.items():
-            setattr(i, k, v)
+    def add_if(self, numtxqueues = None, numrxqueues = None, **kwargs):
+        i = nemu.interface.NodeInterface(self, numtxqueues, numrxqueues)
+        if kwargs:
+            i.configure(**kwargs)
         return i
 
+    def add_ifs(self, count: int, numtxqueues = None, numrxqueues = None,
+            **kwargs) -> list[nemu.interface.NodeInterface]:
+        """Create `count' interfaces at once, which is much faster than
+        calling add_if() repeatedly. Any keyword arguments are applied to
+        each of them."""
+        ifaces = nemu.interface.NodeInterface._create_many(self, count,
+                numtxqueues, numrxqueues)
+        if kwargs:
+            for i in ifaces:
+                i.configure(**kwargs)
+        return ifaces
+
     def add_tap(self, use_pi = False, **kwargs):
         i = nemu.interface.TapNodeInterface(self, use_pi)
-        for k, v in kwargs.items():
-            setattr(i, k, v)
+        if kwargs:
+            i.configure(**kwargs)
         return i
 
     def add_tun(self, use_pi = False, **kwargs):
         i = nemu.interface.TunNodeInterface(self, use_pi)
-        for k, v in kwargs.items():
-            setattr(i, k, v)
+        if kwargs:
+            i.configure(**kwargs)
         return i
 
     def import_if(self, interface: nemu.iproute.interface):
@@ -151,27 +330,46 @@ class Node(object):
         del self._interfaces[iface.index]
         iface.destroy()
 
-    def get_interface(self, name: str):
-        return [i for i in self.get_interfaces() if i.name == name][0]
+    def _update_interfaces(self):
+        """Process pending link notifications: update the cached state of
+        interface wrappers, and get rid of those that went away."""
+        changed, gone = self._links.update()
+        for idx in changed:
+            iface = self._interfaces.get(idx)
+            if iface is not None:
+                iface._update_state(self._links.links[idx])
+        for idx in gone:
+            iface = self._interfaces.pop(idx, None)
+            self._auto_interfaces.pop(idx, None)
+            if iface is not None:
+                notice("Node(0x%x): interface #%d went away." % (id(self),
+                    idx))
+                iface.destroy()
+
+    def _get_interface(self, idx: int) -> nemu.interface.Interface:
+        # Wrappers for interfaces not created by us are built on demand
+        iface = self._interfaces.get(idx)
+        if iface is None:
+            iface = nemu.interface.ImportedNodeInterface(self, idx,
+                    migrate = False)
+            self._auto_interfaces[idx] = iface # keep it referenced!
+        return iface
+
+    def get_interface(self, name: str) -> nemu.interface.Interface:
+        if not self._slave:
+            raise IndexError(name)
+        self._update_interfaces()
+        try:
+            idx = self._links.indices[name]
+        except KeyError:
+            raise IndexError(name)
+        return self._get_interface(idx)
 
     def get_interfaces(self) -> list[nemu.interface.Interface]:
         if not self._slave:
             return []
-        ifaces = self._slave.get_if_data()
-        for i in ifaces:
-            if i not in self._interfaces:
-                iface = nemu.interface.ImportedNodeInterface(self, i,
-                        migrate = False)
-                self._auto_interfaces.append(iface) # keep it referenced!
-                self._interfaces[i] = iface
-        # by the way, clean up _interfaces
-        for i in list(self._interfaces): # copy before deleting!
-            if i not in ifaces:
-                notice("Node(0x%x): interface #%d went away." % (id(self), i))
-                self._interfaces[i].destroy()
-                del self._interfaces[i]
-
-        return sorted(list(self._interfaces.values()), key = lambda x: x.index)
+        self._update_interfaces()
+        return [self._get_interface(i) for i in sorted(self._links.links)]
 
     def route(self, tipe = 'unicast', prefix = None, prefix_len = 0,
             nexthop = None, interface = None, metric = 0):
@@ -196,12 +394,118 @@ class Node(object):
     def get_routes(self) -> list[route]:
         return self._slave.get_route_data()
 
+class _DirectSpawner(object):
+    """Starts processes for a node from this process, instead of asking its
+    slave. Like the netlink sockets, this is done by a helper thread that has
+    joined the node's name space: children inherit it from there. They are
+    then children of this process, which also waits for and signals them.
+    Implements the process methods of nemu.protocol.Client."""
+
+    def __init__(self, netns_fd: int | None):
+        self._executor = None
+        self._cgroup = None
+        self._profiles = {}
+        self._next_profile = 1
+        if netns_fd is not None:
+            # The thread starts on the first request; netns_fd must stay open
+            # until close() is called.
+            self._executor = concurrent.futures.ThreadPoolExecutor(1,
+                    initializer = compat.setns,
+                    initargs = (netns_fd, compat.CLONE_NEWNET))
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _call(self, func, *args, **kwargs):
+        if self._executor is None:
+            return func(*args, **kwargs)
+        return self._executor.submit(func, *args, **kwargs).result()
+
+    def spawn(self, *kargs, **kwargs) -> int:
+        return self._call(self._spawn, *kargs, **kwargs)
+
+    def spawn_many(self, specs: list[dict]) -> list[int]:
+        return self._call(self._spawn_many, specs)
+
+    def _spawn(self, argv: list[str], executable: str = None,
+            stdin = None, stdout = None, stderr = None,
+            cwd = None, env = None, user = None, profile = None,
+            ring = None) -> int:
+        if profile is not None:
+            if profile not in self._profiles:
+                raise RuntimeError("Profile %d does not exist." % profile)
+            profile = self._profiles[profile]
+        if env is None and profile is None:
+            env = dict(os.environ)
+            # As the slave does, when X is not forwarded
+            env.pop('DISPLAY', None)
+        return nemu.subprocess_.spawn(executable or argv[0], argv,
+                cwd = cwd, env = env, close_fds = True, stdin = stdin,
+                stdout = stdout, stderr = stderr, user = user,
+                profile = profile, ring = ring, cgroup = self._cgroup)
+
+    def _spawn_many(self, specs: list[dict]) -> list[int]:
+        pids = []
+        try:
+            for spec in specs:
+                pids.append(self._spawn(**spec))
+        except:
+            # All or nothing, as the slave does
+            for pid in pids:
+                os.kill(-pid, signal.SIGKILL)
+                nemu.subprocess_.wait(pid)
+            raise
+        return pids
+
+    def add_profile(self, user = None, env = None, cwd = None) -> int:
+        profile = nemu.subprocess_.Profile(user, env, cwd)
+        if profile.env is None:
+            profile.env = dict(os.environ)
+        profile.env.pop('DISPLAY', None)
+        self._profiles[self._next_profile] = profile
+        self._next_profile += 1
+        return self._next_profile - 1
+
+    def del_profile(self, profile: int):
+        if profile not in self._profiles:
+            raise RuntimeError("Profile %d does not exist." % profile)
+        del self._profiles[profile]
+
+    def set_cgroup(self, path: str | None):
+        self._cgroup = path
+
+    def pidfd(self, pid: int) -> int | None:
+        try:
+            return os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            return None
+
+    def pidfds(self, pids: list[int]) -> list[int | None]:
+        return [self.pidfd(pid) for pid in pids]
+
+    def poll(self, pid: int) -> int | None:
+        return nemu.subprocess_.poll(pid)
+
+    def wait(self, pid: int) -> int:
+        return nemu.subprocess_.wait(pid)
+
+    def signal(self, pid: int, sig = signal.SIGTERM):
+        # -PID to kill to whole process group
+        os.kill(-pid, sig)
+
 # Handle the creation of the child; parent gets (fd, pid), child creates and
 # runs a Server(); never returns.
 # Requires CAP_SYS_ADMIN privileges to run.
-def _start_child(nonetns: bool) -> (socket.socket, int):
+def _start_child(nonetns: bool, netns_fd: int = None,
+        lean: bool = False) -> (socket.socket, int):
     # Create socket pair to communicate
     (s0, s1) = compat.socketpair(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+    if lean:
+        argv = nemu.slave.command_line(s1.fileno(), nonetns, netns_fd)
+        if netns_fd is not None:
+            os.set_inheritable(netns_fd, True)
     # Spawn a child that will run in a loop
     pid = os.fork()
     if pid:
@@ -209,31 +513,14 @@ def _start_child(nonetns: bool) -> (socket.socket, int):
         return (s0, pid)
 
     # FIXME: clean up signal handers, atexit functions, etc.
-    try: # pragma: no cover
-        # coverage doesn't seem to understand fork
-        s0.close()
-        srv = nemu.protocol.Server(s1, s1)
-        if not nonetns:
-            # create new name space
-            unshare.unshare(unshare.CLONE_NEWNET)
-            # Enable packet forwarding
-            execute([SYSCTL_PATH, '-w', 'net.ipv4.ip_forward=1'])
-            execute([SYSCTL_PATH, '-w', 'net.ipv6.conf.default.forwarding=1'])
-        srv.run()
-    except BaseException as e:
-        s = "Slave node aborting: %s\n" % str(e)
-        sep = "=" * 70 + "\n"
-        sys.stderr.write(s + sep)
-        traceback.print_exc(file=sys.stdout)
-        sys.stderr.write(sep)
+    s0.close()
+    if lean: # pragma: no cover
         try:
-            # try to pass the error to parent, if possible
-            s1.send("500 " + s)
-        except:
-            pass
+            os.execv(argv[0], argv)
+        except BaseException as e:
+            sys.stderr.write("Cannot execute slave: %s\n" % str(e))
         os._exit(1)
-
-    os._exit(0) # pragma: no cover
+    nemu.slave.run(s1, nonetns, netns_fd)
     # NOTREACHED
 
 get_nodes = Node.get_nodes
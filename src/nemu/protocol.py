@@ -19,6 +19,7 @@
 
 import base64
 import errno
+import json
 import os
 import re
 import select
@@ -26,12 +27,12 @@ import signal
 import socket
 import sys
 import tempfile
-import time
 import traceback
 from pickle import loads, dumps
 from typing import Literal, Optional
 
 import nemu.iproute
+import nemu.netlink
 import nemu.subprocess_
 from nemu import compat, passfd
 from nemu.environ import *
@@ -58,13 +59,19 @@ _proto_commands = {
         "LIST": ("", "i"),
         "SET": ("iss", "s*"),
         "RTRN": ("ii", ""),
-        "DEL": ("i", "")
+        "DEL": ("i", ""),
+        "OPTS": ("iss", "s*")
     },
     "ADDR": {
         "LIST": ("", "i"),
         "ADD": ("isi", "s"),
         "DEL": ("iss", "s")
     },
+    "TC": {
+        "LIST": ("", "i"),
+        "SET": ("i", "s*"),
+        "MSET": ("b", "")
+    },
     "ROUT": {
         "LIST": ("", ""),
         "ADD": ("bbibii", ""),
@@ -74,7 +81,12 @@ _proto_commands = {
         "CRTE": ("b", "b*"),
         "POLL": ("i", ""),
         "WAIT": ("i", ""),
-        "KILL": ("i", "i")
+        "KILL": ("i", "i"),
+        "PIDF": ("i", "i*"),
+        "MANY": ("b", ""),
+        "PADD": ("b", ""),
+        "PDEL": ("i", ""),
+        "CGRP": ("", "b")
     },
 }
 # Commands valid only after PROC CRTE
@@ -85,9 +97,12 @@ _proc_commands = {
         "USER": ("b", ""),
         "CWD": ("b", ""),
         "ENV": ("bb", "b*"),
+        "PROF": ("i", ""),
         "SIN": ("", ""),
         "SOUT": ("", ""),
         "SERR": ("", ""),
+        "ROUT": ("", ""),
+        "RERR": ("", ""),
         "RUN": ("", ""),
         "ABRT": ("", ""),
     }
@@ -95,6 +110,9 @@ _proc_commands = {
 
 KILL_WAIT = 3  # seconds
 
+# File descriptors passed per message; the kernel limit is 253.
+_MAX_FDS = 250
+
 
 class Server(object):
     """Class that implements the communication protocol and dispatches calls
@@ -109,6 +127,11 @@ class Server(object):
         self._closed = False
         # Set to keep track of started processes
         self._children = set()
+        # Registered spawn profiles, by id
+        self._profiles = {}
+        self._next_profile = 1
+        # Where new processes are placed
+        self._cgroup = None
         # Buffer and flag for PROC mode
         self._proc = None
         # temporary xauth files
@@ -117,42 +140,14 @@ class Server(object):
         self._xfwd = None
         self._xsock = None
 
-        self._rfd_socket = rfd
-        self._rfd = _get_file(rfd, "r")
-        self._wfd_socket = wfd
-        self._wfd = _get_file(wfd, "w")
+        self._rfd = _Channel(rfd)
+        self._wfd = self._rfd if wfd is rfd or wfd == rfd else _Channel(wfd)
 
     def clean(self):
         try:
-            for pid in self._children:
-                # -PID to kill to whole process group
-                os.kill(-pid, signal.SIGTERM)
-            now = time.time()
-            while time.time() - now < KILL_WAIT:
-                ch = set(self._children)
-                for pid in ch:
-                    try:
-                        if nemu.subprocess_.poll(pid):
-                            self._children.remove(pid)
-                    except OSError as e:
-                        if e.errno == errno.ECHILD:
-                            self._children.remove(pid)
-                        else:
-                            raise
-                if not ch:
-                    break
-                time.sleep(0.1)
-
-            for pid in self._children:
-                warning("Killing forcefully process %d." % pid)
-                # -PID to kill to whole process group
-                os.kill(-pid, signal.SIGKILL)
-            for pid in self._children:
-                try:
-                    nemu.subprocess_.poll(pid)
-                except OSError as e:
-                    if e.errno != errno.ECHILD:
-                        raise
+            for pid in nemu.subprocess_.terminate(self._children, KILL_WAIT):
+                warning("Killed forcefully process %d." % pid)
+            self._children.clear()
         finally:
             for f in self._xauthfiles.values():
                 try:
@@ -338,12 +333,19 @@ class Server(object):
 
         self.reply(200, "%d environment definition(s) read." % (len(env) // 2))
 
+    def do_PROC_PROF(self, cmdname, profile):
+        if profile not in self._profiles:
+            self.reply(500, "Profile %d does not exist." % profile)
+            return
+        self._proc['profile'] = self._profiles[profile]
+        self.reply(200, "Using profile %d." % profile)
+
     def do_PROC_SIN(self, cmdname):
         self.reply(354,
                    "Pass the file descriptor now, with `%s\\n' as payload." %
                    cmdname)
         try:
-            fd, payload = passfd.recvfd(self._rfd, len(cmdname) + 1)
+            fd, payload = self._rfd.recvfd(len(cmdname) + 1)
         except (IOError, RuntimeError) as e:
             self.reply(500, "Error receiving FD: %s" % str(e))
             return
@@ -352,26 +354,94 @@ class Server(object):
             self.reply(500, "Invalid payload: %s." % payload)
             return
 
-        m = {'PROC SIN': 'stdin', 'PROC SOUT': 'stdout', 'PROC SERR': 'stderr'}
+        m = {'PROC SIN': 'stdin', 'PROC SOUT': 'stdout', 'PROC SERR': 'stderr',
+             'PROC ROUT': 'stdout', 'PROC RERR': 'stderr'}
         self._proc[m[cmdname]] = fd
+        if cmdname in ('PROC ROUT', 'PROC RERR'):
+            self._proc.setdefault('ring', []).append(m[cmdname])
         self.reply(200, 'FD saved as %s.' % m[cmdname])
 
-    # Same code for the three commands
-    do_PROC_SOUT = do_PROC_SERR = do_PROC_SIN
+    # Same code for all these commands
+    do_PROC_SOUT = do_PROC_SERR = do_PROC_ROUT = do_PROC_RERR = do_PROC_SIN
 
     def do_PROC_RUN(self, cmdname):
         params = self._proc
-        params['close_fds'] = True  # forced
         self._proc = None
         self._commands = _proto_commands
 
-        if 'env' not in params:
+        try:
+            chld = self._spawn(params)
+        finally:
+            # I can close the fds now
+            for d in ('stdin', 'stdout', 'stderr'):
+                if d in params:
+                    os.close(params[d])
+
+        self.reply(200, "%d running." % chld)
+
+    def do_PROC_MANY(self, cmdname, specs):
+        specs = json.loads(specs)
+        # Descriptors are referred to by their position in the list passed
+        nfds = max([s[d] + 1 for s in specs
+                    for d in ('stdin', 'stdout', 'stderr') if d in s] or [0])
+        fds = []
+        if nfds:
+            self.reply(354, "Pass the %d file descriptors now." % nfds)
+            try:
+                while len(fds) < nfds:
+                    got = self._rfd.recvfds(1, _MAX_FDS)
+                    if not got:
+                        raise RuntimeError("Missing file descriptors")
+                    fds += got
+            except (IOError, RuntimeError) as e:
+                for fd in fds:
+                    os.close(fd)
+                self.reply(500, "Error receiving FDs: %s" % str(e))
+                return
+
+        pids = []
+        try:
+            for spec in specs:
+                params = dict((str(k), v) for k, v in spec.items())
+                for d in ('stdin', 'stdout', 'stderr'):
+                    if d in params:
+                        params[d] = fds[params[d]]
+                if 'profile' in params:
+                    params['profile'] = self._profiles[params['profile']]
+                pids.append(self._spawn(params))
+        except:
+            # All or nothing
+            for pid in pids:
+                os.kill(-pid, signal.SIGKILL)
+                nemu.subprocess_.wait(pid)
+                self._forget(pid)
+            raise
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        self.reply(200, "%s running." % " ".join(str(pid) for pid in pids))
+
+    def _spawn(self, params: dict) -> int:
+        params['close_fds'] = True  # forced
+        if self._cgroup:
+            params['cgroup'] = self._cgroup
+        profile = params.get('profile')
+        if 'env' in params:
+            pass
+        elif profile is not None and profile.env is not None:
+            # Built once, when the profile was registered
+            params['env'] = profile.env
+        else:
             params['env'] = dict(os.environ)  # copy
 
         xauth = None
         if self._xfwd:
             display, protoname, hexkey = self._xfwd
             user = params['user'] if 'user' in params else None
+            if user is None and profile is not None and profile.credentials:
+                user = profile.credentials[0]
+            params['env'] = dict(params['env'])
             try:
                 fd, xauth = tempfile.mkstemp()
                 os.close(fd)
@@ -397,17 +467,40 @@ class Server(object):
             if 'DISPLAY' in params['env']:
                 del params['env']['DISPLAY']
 
-        try:
-            chld = nemu.subprocess_.spawn(**params)
-        finally:
-            # I can close the fds now
-            for d in ('stdin', 'stdout', 'stderr'):
-                if d in params:
-                    os.close(params[d])
-
+        chld = nemu.subprocess_.spawn(**params)
         self._children.add(chld)
         self._xauthfiles[chld] = xauth
-        self.reply(200, "%d running." % chld)
+        return chld
+
+    def _forget(self, pid: int):
+        # The process has been reaped
+        self._children.remove(pid)
+        if pid in self._xauthfiles:
+            try:
+                os.unlink(self._xauthfiles[pid])
+            except:
+                pass
+            del self._xauthfiles[pid]
+
+    def do_PROC_PADD(self, cmdname, spec):
+        spec = dict((str(k), v) for k, v in json.loads(spec).items())
+        profile = nemu.subprocess_.Profile(**spec)
+        if profile.env is None:
+            profile.env = dict(os.environ)
+        self._profiles[self._next_profile] = profile
+        self.reply(200, "%d profile registered." % self._next_profile)
+        self._next_profile += 1
+
+    def do_PROC_PDEL(self, cmdname, profile):
+        if profile not in self._profiles:
+            self.reply(500, "Profile %d does not exist." % profile)
+            return
+        del self._profiles[profile]
+        self.reply(200, "Profile removed.")
+
+    def do_PROC_CGRP(self, cmdname, path=None):
+        self._cgroup = path
+        self.reply(200, "New processes go to %s." % (path or "this cgroup"))
 
     def do_PROC_ABRT(self, cmdname):
         self._proc = None
@@ -424,13 +517,7 @@ class Server(object):
             ret = nemu.subprocess_.wait(pid)
 
         if ret is not None:
-            self._children.remove(pid)
-            if pid in self._xauthfiles:
-                try:
-                    os.unlink(self._xauthfiles[pid])
-                except:
-                    pass
-                del self._xauthfiles[pid]
+            self._forget(pid)
             self.reply(200, "%d exitcode." % ret)
         else:
             self.reply(450, "Not finished yet.")
@@ -449,6 +536,25 @@ class Server(object):
             os.kill(-pid, signal.SIGTERM)
         self.reply(200, "Process signalled.")
 
+    def do_PROC_PIDF(self, cmdname, *pids):
+        fds = []
+        try:
+            for pid in pids:
+                if pid not in self._children:
+                    raise ValueError("Process %d does not exist." % pid)
+                fds.append(os.pidfd_open(pid))
+            for i in range(0, len(fds), _MAX_FDS):
+                self._wfd.sendfds(fds[i:i + _MAX_FDS], b"1")
+        except Exception:
+            # need to fill the buffer on the other side, nevertheless
+            self._wfd.write("1")
+            self.reply(500, "Cannot send process descriptors.")
+            return
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self.reply(200, "%d process descriptor(s) sent." % len(fds))
+
     def do_IF_LIST(self, cmdname, ifnr=None):
         if ifnr is None:
             ifdata = nemu.iproute.get_if_data()[0]
@@ -470,6 +576,16 @@ class Server(object):
         nemu.iproute.set_if(iface)
         self.reply(200, "Done.")
 
+    def do_IF_OPTS(self, cmdname, ifnr, *args):
+        if len(args) % 2:
+            self.reply(500,
+                       "Invalid number of arguments for IF OPTS: must be even.")
+            return
+        opts = dict((str(args[i * 2]), int(args[i * 2 + 1]))
+                    for i in range(len(args) // 2))
+        nemu.netlink.set_link_options(ifnr, **opts)
+        self.reply(200, "Done.")
+
     def do_IF_RTRN(self, cmdname, ifnr, ns):
         nemu.iproute.change_netns(ifnr, ns)
         self.reply(200, "Done.")
@@ -479,9 +595,10 @@ class Server(object):
         self.reply(200, "Done.")
 
     def do_ADDR_LIST(self, cmdname, ifnr=None):
-        addrdata = nemu.iproute.get_addr_data()[0]
-        if ifnr is not None:
-            addrdata = addrdata[ifnr]
+        if ifnr is None:
+            addrdata = nemu.iproute.get_addr_data()[0]
+        else:
+            addrdata = nemu.iproute.get_addr(ifnr)
         self.reply(200, ["# Address data follows.",
                          _b64(dumps(addrdata, protocol=2))])
 
@@ -506,6 +623,31 @@ class Server(object):
         self.reply(200, ["# Routing data follows.",
                          _b64(dumps(rdata, protocol=2))])
 
+    def do_TC_LIST(self, cmdname, ifnr=None):
+        tcdata = nemu.iproute.get_tc_data()[0]
+        if ifnr is not None:
+            tcdata = tcdata[ifnr]
+        self.reply(200, ["# Traffic control data follows.",
+                         _b64(dumps(tcdata, protocol=2))])
+
+    def do_TC_SET(self, cmdname, ifnr, *args):
+        if len(args) % 2:
+            self.reply(500,
+                       "Invalid number of arguments for TC SET: must be even.")
+            return
+        d = {}
+        for i in range(len(args) // 2):
+            k, v = str(args[i * 2]), args[i * 2 + 1]
+            d[k] = v if k == "delay_distribution" else float(v)
+
+        nemu.iproute.set_tc(ifnr, **d)
+        self.reply(200, "Done.")
+
+    def do_TC_MSET(self, cmdname, changes):
+        nemu.iproute.set_tc_many([(int(ifnr), parameters)
+                                  for ifnr, parameters in json.loads(changes)])
+        self.reply(200, "Done.")
+
     def do_ROUT_ADD(self, cmdname, tipe, prefix, prefixlen, nexthop, ifnr,
                     metric):
         nemu.iproute.add_route(nemu.iproute.route(tipe, prefix, prefixlen,
@@ -542,7 +684,7 @@ class Server(object):
             return
         # Needs to be a separate command to handle synch & buffering issues
         try:
-            passfd.sendfd(self._wfd, self._xsock.fileno(), b"1")
+            self._wfd.sendfd(self._xsock.fileno(), b"1")
         except:
             # need to fill the buffer on the other side, nevertheless
             self._wfd.write("1")
@@ -562,10 +704,8 @@ class Client(object):
 
     def __init__(self, rfd: socket.socket, wfd: socket.socket):
         debug("Client(0x%x).__init__()" % id(self))
-        self._rfd_socket = rfd
-        self._rfd = _get_file(rfd, "r")
-        self._wfd_socket = wfd
-        self._wfd = _get_file(wfd, "w")
+        self._rfd = _Channel(rfd)
+        self._wfd = self._rfd if wfd is rfd or wfd == rfd else _Channel(wfd)
         self._forwarder = None
         # Wait for slave to send banner
         self._read_and_check_reply()
@@ -613,6 +753,11 @@ class Client(object):
             raise RuntimeError("Error from slave: %d %s" % (code, text))
         return text
 
+    @property
+    def closed(self) -> bool:
+        # Collected in a cycle, the socket may have been closed first
+        return not self._wfd or self._wfd.closed
+
     def shutdown(self):
         "Tell the client to quit."
         if not self._wfd:
@@ -622,10 +767,8 @@ class Client(object):
         self._send_cmd("QUIT")
         self._read_and_check_reply()
         self._rfd.close()
-        self._rfd_socket.close()
         self._rfd = None
         self._wfd.close()
-        self._wfd_socket.close()
         self._wfd = None
         if self._forwarder:
             os.kill(self._forwarder, signal.SIGTERM)
@@ -636,7 +779,7 @@ class Client(object):
         self._send_cmd("PROC", name)
         self._read_and_check_reply(3)
         try:
-            passfd.sendfd(self._wfd, fd, ("PROC " + name).encode("ascii"))
+            self._wfd.sendfd(fd, ("PROC " + name).encode("ascii"))
         except:
             # need to fill the buffer on the other side, nevertheless
             self._wfd.write("=" * (len(name) + 5) + "\n")
@@ -647,11 +790,13 @@ class Client(object):
 
     def spawn(self, argv: list[str], executable: str = None,
               stdin=None, stdout=None, stderr=None,
-              cwd=None, env=None, user=None):
+              cwd=None, env=None, user=None, profile: int = None,
+              ring: list[str] = None):
         """Start a subprocess in the slave; the interface resembles
         subprocess.Popen, but with less functionality. In particular
         stdin/stdout/stderr can only be None or a open file descriptor.
         See nemu.subprocess_.spawn for details."""
+        ring = ring or ()
 
         if executable is None:
             executable = argv[0]
@@ -664,6 +809,10 @@ class Client(object):
 
         # After this, if we get an error, we have to abort the PROC
         try:
+            if profile is not None:
+                self._send_cmd("PROC", "PROF", profile)
+                self._read_and_check_reply()
+
             if user is not None:
                 self._send_cmd("PROC", "USER", _b64(user))
                 self._read_and_check_reply()
@@ -683,11 +832,17 @@ class Client(object):
                 os.set_inheritable(stdin, True)
                 self._send_fd("SIN", stdin)
             if stdout is not None:
-                os.set_inheritable(stdout, True)
-                self._send_fd("SOUT", stdout)
+                if 'stdout' in ring:
+                    self._send_fd("ROUT", stdout)
+                else:
+                    os.set_inheritable(stdout, True)
+                    self._send_fd("SOUT", stdout)
             if stderr is not None:
-                os.set_inheritable(stderr, True)
-                self._send_fd("SERR", stderr)
+                if 'stderr' in ring:
+                    self._send_fd("RERR", stderr)
+                else:
+                    os.set_inheritable(stderr, True)
+                    self._send_fd("SERR", stderr)
         except:
             self._send_cmd("PROC", "ABRT")
             self._read_and_check_reply()
@@ -698,6 +853,57 @@ class Client(object):
 
         return pid
 
+    def spawn_many(self, specs: list[dict]) -> list[int]:
+        """Start many subprocesses in the slave with a single request; each
+        spec is a dictionary with the arguments of spawn(). They are started
+        back to back, and if any fails, none is left running. Returns their
+        process IDs, in the same order."""
+        fds = {}
+        data = []
+        for spec in specs:
+            argv = list(spec['argv'])
+            d = {'argv': argv, 'executable': spec.get('executable') or argv[0]}
+            for k in ('cwd', 'env', 'user', 'profile', 'ring'):
+                if spec.get(k) is not None:
+                    d[k] = spec[k]
+            for k in ('stdin', 'stdout', 'stderr'):
+                fd = spec.get(k)
+                if fd is not None:
+                    os.set_inheritable(fd, True)
+                    d[k] = fds.setdefault(fd, len(fds))
+            data.append(d)
+
+        self._send_cmd("PROC", "MANY", _b64(json.dumps(data)))
+        if fds:
+            self._read_and_check_reply(3)
+            fds = list(fds)
+            for i in range(0, len(fds), _MAX_FDS):
+                self._wfd.sendfds(fds[i:i + _MAX_FDS], b"1")
+        text = self._read_and_check_reply()
+        return [int(pid) for pid in text.split()[:len(specs)]]
+
+    def add_profile(self, user=None, env=None, cwd=None) -> int:
+        """Register a nemu.subprocess_.Profile in the slave, so credentials
+        and environment are resolved only once. Returns an id to pass as the
+        `profile' argument of spawn()."""
+        spec = dict((k, v) for k, v in (('user', user), ('env', env),
+                                        ('cwd', cwd)) if v is not None)
+        self._send_cmd("PROC", "PADD", _b64(json.dumps(spec)))
+        return int(self._read_and_check_reply().split()[0])
+
+    def del_profile(self, profile: int):
+        self._send_cmd("PROC", "PDEL", profile)
+        self._read_and_check_reply()
+
+    def set_cgroup(self, path: Optional[str]):
+        """Places processes started from now on in the cgroup v2 directory
+        `path', or in the slave's own cgroup if None."""
+        if path:
+            self._send_cmd("PROC", "CGRP", _b64(path))
+        else:
+            self._send_cmd("PROC", "CGRP")
+        self._read_and_check_reply()
+
     def poll(self, pid: int) -> Optional[int]:
         """Equivalent to Popen.poll(), checks if the process has finished.
         Returns the exitcode if finished, None otherwise."""
@@ -728,6 +934,31 @@ class Client(object):
             self._send_cmd("PROC", "KILL", pid)
         self._read_and_check_reply()
 
+    def pidfd(self, pid: int) -> Optional[int]:
+        """Get a process file descriptor (see pidfd_open(2)) for a child of
+        the slave, or None if the slave or the kernel cannot provide one. The
+        caller owns the descriptor."""
+        return self.pidfds([pid])[0]
+
+    def pidfds(self, pids: list[int]) -> list[Optional[int]]:
+        """Same as pidfd(), for many processes in a single exchange."""
+        self._send_cmd("PROC", "PIDF", *pids)
+        fds = []
+        while len(fds) < len(pids):
+            got = self._rfd.recvfds(1, _MAX_FDS)
+            if not got:
+                # Just the filler byte: failed
+                break
+            fds += got
+        code, text = self._read_reply()
+        if code // 100 != 2 or len(fds) != len(pids):
+            for fd in fds:
+                os.close(fd)
+            return [None] * len(pids)
+        for fd in fds:
+            os.set_inheritable(fd, False)
+        return fds
+
     def get_if_data(self, ifnr=None) -> dict[int, nemu.iproute.interface] | nemu.iproute.interface:
         if ifnr:
             self._send_cmd("IF", "LIST", ifnr)
@@ -750,6 +981,17 @@ class Client(object):
         self._send_cmd("IF", "DEL", ifnr)
         self._read_and_check_reply()
 
+    def set_link_options(self, ifnr: int, **options):
+        """Same as nemu.netlink.set_link_options, in the slave's name
+        space."""
+        cmd = ["IF", "OPTS", ifnr]
+        for k, v in options.items():
+            if v is not None:
+                cmd += [k, int(v)]
+        if len(cmd) > 3:
+            self._send_cmd(*cmd)
+            self._read_and_check_reply()
+
     def change_netns(self, ifnr: int, netns: int):
         self._send_cmd("IF", "RTRN", ifnr, netns)
         self._read_and_check_reply()
@@ -780,6 +1022,32 @@ class Client(object):
         data = self._read_and_check_reply()
         return loads(_db64(data.partition("\n")[2]))
 
+    def get_tc_data(self, ifnr=None):
+        if ifnr:
+            self._send_cmd("TC", "LIST", ifnr)
+        else:
+            self._send_cmd("TC", "LIST")
+        data = self._read_and_check_reply()
+        return loads(_db64(data.partition("\n")[2]))
+
+    def set_tc(self, ifnr: int, **parameters):
+        """Same as nemu.iproute.set_tc, run inside the name space."""
+        cmd = ["TC", "SET", ifnr]
+        for k, v in parameters.items():
+            if v is not None:
+                cmd += [k, str(v)]
+
+        self._send_cmd(*cmd)
+        self._read_and_check_reply()
+
+    def set_tc_many(self, changes: list[tuple[int, dict]]):
+        """Same as nemu.iproute.set_tc_many, run inside the name space."""
+        if not changes:
+            return
+        self._send_cmd("TC", "MSET", _b64(json.dumps(
+            [(ifnr, parameters) for ifnr, parameters in changes])))
+        self._read_and_check_reply()
+
     def add_route(self, route: nemu.iproute.route):
         self._add_del_route("ADD", route)
 
@@ -799,7 +1067,7 @@ class Client(object):
         self._read_and_check_reply()
         # Receive the socket
         self._send_cmd("X11", "SOCK")
-        fd, payload = passfd.recvfd(self._rfd, 1)
+        fd, payload = self._rfd.recvfd(1)
         self._read_and_check_reply()
         skt = compat.fromfd(fd, socket.AF_INET, socket.SOCK_DGRAM)
         os.close(fd)  # fromfd dup()'s
@@ -823,6 +1091,103 @@ class Client(object):
         self._forwarder = _spawn_x11_forwarder(server, sock, addr)
 
 
+class NetnsClient(Client):
+    """Client that performs network configuration in-process, through a
+    netlink socket living in the slave's name space. The slave is only used
+    for process handling and X11 forwarding."""
+
+    def __init__(self, rfd: socket.socket, wfd: socket.socket,
+                 pid: Optional[int] = None):
+        """`pid' is the slave process, whose network name space is joined
+        once it is ready. If None, the slave shares this process' name
+        space."""
+        self._netlink = self._ethtool = None
+        self._pid = pid
+        super(NetnsClient, self).__init__(rfd, wfd)
+        # The banner has been received: the name space is set up by now
+        self._netlink = self._in_netns(nemu.netlink.Netlink)
+
+    @property
+    def closed(self) -> bool:
+        return super(NetnsClient, self).closed or \
+                self._netlink is None or self._netlink.closed
+
+    def shutdown(self):
+        super(NetnsClient, self).shutdown()
+        # Further calls will fail, like with a shut down slave.
+        if self._netlink:
+            self._netlink.close()
+        if self._ethtool:
+            self._ethtool.close()
+
+    def _in_netns(self, func, *args, **kwargs):
+        # Sockets created stay in the name space, and programs run there, so
+        # the descriptor is not kept open.
+        if self._pid is None:
+            return func(*args, **kwargs)
+        netns_fd = os.open("/proc/%d/ns/net" % self._pid,
+                           os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            return nemu.netlink.run_in_netns(netns_fd, func, *args, **kwargs)
+        finally:
+            os.close(netns_fd)
+
+    def _get_ethtool(self) -> nemu.netlink.Ethtool:
+        if not self._ethtool:
+            self._ethtool = self._in_netns(nemu.netlink.Ethtool)
+        return self._ethtool
+
+    def get_if_data(self, ifnr=None) -> dict[int, nemu.iproute.interface] | nemu.iproute.interface:
+        if ifnr:
+            return self._netlink.get_if(ifnr)
+        return self._netlink.get_if_data()[0]
+
+    def set_if(self, interface: nemu.iproute.interface):
+        self._netlink.set_if(interface)
+
+    def del_if(self, ifnr: int):
+        self._netlink.del_if(ifnr)
+
+    def change_netns(self, ifnr: int, netns: int):
+        self._netlink.change_netns(ifnr, netns)
+
+    def set_link_options(self, ifnr: int, **options):
+        nemu.netlink.set_link_options(ifnr, netlink=self._netlink,
+                                      ethtool=self._get_ethtool, **options)
+
+    def get_addr_data(self, ifnr: int = None):
+        if ifnr:
+            return self._netlink.get_addr(ifnr)
+        return self._netlink.get_addr_data()[0]
+
+    def add_addr(self, ifnr: int, address: nemu.iproute.address):
+        self._netlink.add_addr(ifnr, address)
+
+    def del_addr(self, ifnr: int, address: nemu.iproute.address):
+        self._netlink.del_addr(ifnr, address)
+
+    def get_route_data(self) -> list[nemu.iproute.route]:
+        return self._netlink.get_route_data()
+
+    def add_route(self, route: nemu.iproute.route):
+        self._netlink.add_route(route)
+
+    def del_route(self, route: nemu.iproute.route):
+        self._netlink.del_route(route)
+
+    # There is no netlink implementation of traffic control: tc is executed
+    # from a thread in the name space, instead of by the slave.
+    def get_tc_data(self, ifnr=None):
+        tcdata = self._in_netns(nemu.iproute.get_tc_data)[0]
+        return tcdata if ifnr is None else tcdata[ifnr]
+
+    def set_tc(self, ifnr: int, **parameters):
+        self._in_netns(nemu.iproute.set_tc, ifnr, **parameters)
+
+    def set_tc_many(self, changes: list[tuple[int, dict]]):
+        self._in_netns(nemu.iproute.set_tc_many, changes)
+
+
 def _b64_OLD(text: str | bytes) -> str:
     if text is None:
         # easier this way
@@ -862,13 +1227,81 @@ def _db64(text: str) -> bytes:
     return base64.b64decode(text[1:])
 
 
-def _get_file(fd, mode):
-    # Since fdopen insists on closing the fd on destruction, I need to dup()
-    if hasattr(fd, "fileno"):
-        nfd = os.dup(fd.fileno())
-    else:
-        nfd = os.dup(fd)
-    return os.fdopen(nfd, mode, 1)
+class _Channel(object):
+    """Line-oriented text channel over a stream socket, that can also pass
+    file descriptors. It does its own buffering on the socket's descriptor,
+    instead of fdopen()ing dup()ed descriptors for each direction, so a
+    channel costs a single file descriptor.
+    If given a file descriptor instead of a socket object, the descriptor is
+    borrowed: it will not be closed."""
+
+    def __init__(self, sock: socket.socket | int):
+        if isinstance(sock, socket.socket):
+            self._sock = sock
+            self._owned = True
+        else:
+            self._sock = socket.socket(fileno=sock)
+            self._owned = False
+        self._buf = bytearray()
+
+    def fileno(self) -> int:
+        return self._sock.fileno()
+
+    @property
+    def closed(self) -> bool:
+        return self._sock is None or self._sock.fileno() < 0
+
+    def close(self):
+        if self._sock is None:
+            return
+        if self._owned:
+            self._sock.close()
+        else:
+            self._sock.detach()
+        self._sock = None
+
+    def readline(self) -> str:
+        """Read a line, including the trailing newline. Returns an empty
+        string at end of file."""
+        start = 0
+        while True:
+            pos = self._buf.find(b"\n", start)
+            if pos >= 0:
+                line = bytes(self._buf[:pos + 1])
+                del self._buf[:pos + 1]
+                return line.decode("utf-8")
+            start = len(self._buf)
+            data = self._sock.recv(65536)
+            if not data:
+                line = bytes(self._buf)
+                self._buf.clear()
+                return line.decode("utf-8")
+            self._buf += data
+
+    def write(self, text: str):
+        self._sock.sendall(text.encode("utf-8"))
+
+    def sendfd(self, fd: int, payload: bytes):
+        passfd.sendfd(self._sock, fd, payload)
+
+    def recvfd(self, size: int) -> tuple[int, str]:
+        if self._buf:
+            # The peer must wait for our reply before sending the fd.
+            raise RuntimeError("Protocol error, unexpected data before file "
+                               "descriptor")
+        return passfd.recvfd(self._sock, size)
+
+    def sendfds(self, fds: list[int], payload: bytes):
+        socket.send_fds(self._sock, [payload], fds)
+
+    def recvfds(self, size: int, maxfds: int) -> list[int]:
+        """Receive a message of `size' bytes, with up to `maxfds' file
+        descriptors; returns the descriptors."""
+        if self._buf:
+            raise RuntimeError("Protocol error, unexpected data before file "
+                               "descriptors")
+        msg, fds, flags, addr = socket.recv_fds(self._sock, size, maxfds)
+        return fds
 
 
 def _parse_display():
@@ -0,0 +1,77 @@
+# vim:ts=4:sw=4:et:ai:sts=4
+# -*- coding: utf-8 -*-
+
+# Copyright 2010, 2011 INRIA
+# Copyright 2011 Martina Ferrari <tina@tina.pm>
+#
+# This file is part of Nemu.
+#
+# Nemu is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 2, as published by the Free
+# Software Foundation.
+#
+# Nemu is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nemu.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Copier for the Ring buffers of nemu.subprocess_.
+
+It runs in a fresh interpreter, so nothing is inherited from the (possibly
+multi-threaded) process that starts it:
+
+    python -I -S ringcopy.py
+
+What is read from its standard input, a pipe, is copied into the ring buffer
+on its standard output, a memfd, until all the writers close the pipe. It
+detaches itself right away, so there is no need to wait for it.
+
+Only the standard library is used: nothing else can be imported here."""
+
+import mmap
+import os
+import struct
+import sys
+
+__all__ = ['HEADER', 'command_line']
+
+# Ring buffer header: total bytes written, bytes stored per system call.
+HEADER = struct.Struct("QQ")
+
+def command_line() -> list[str]:
+    """Return the argument vector that starts a copier."""
+    if not sys.executable:
+        raise RuntimeError("Cannot find the Python interpreter")
+    return [sys.executable, "-I", "-S", os.path.abspath(__file__)]
+
+def fill(fd: int, ringfd: int):
+    ringmap = mmap.mmap(ringfd, 0)
+    written, chunk = HEADER.unpack_from(ringmap, 0)
+    data = memoryview(ringmap)[HEADER.size:]
+    capacity = len(data)
+    while True:
+        # Read straight into the buffer, wrapping around
+        pos = written % capacity
+        end = min(pos + chunk, capacity)
+        bufs = [data[pos:end]]
+        if end - pos < chunk:
+            bufs.append(data[:chunk - (end - pos)])
+        n = os.readv(fd, bufs)
+        if not n:
+            break
+        written += n
+        # Published after the data
+        struct.pack_into("Q", ringmap, 0, written)
+
+def main():  # pragma: no cover
+    # Not a child of the process that started us, and out of reach of the
+    # signals sent to the program's process group.
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    fill(0, 1)
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
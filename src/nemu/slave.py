@@ -0,0 +1,143 @@
+# vim:ts=4:sw=4:et:ai:sts=4
+# -*- coding: utf-8 -*-
+
+# Copyright 2010, 2011 INRIA
+# Copyright 2011 Martina Ferrari <tina@tina.pm>
+#
+# This file is part of Nemu.
+#
+# Nemu is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License version 2, as published by the Free
+# Software Foundation.
+#
+# Nemu is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Nemu.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Slave process main loop.
+
+The slave either runs in a fork of the controller (see run()), or, for lean
+nodes, in a fresh interpreter started by executing this file:
+
+    python -I -S slave.py FD NETNS [PATH...]
+
+FD is the slave's end of the control socket, NETNS is "new" to create a new
+network name space, "none" to stay in the current one, or the number of an
+inherited file descriptor referring to a name space to join. PATHs are
+prepended to sys.path, since neither site nor the environment are processed.
+
+Only nemu.protocol (and what it needs) is loaded in that case; the package's
+__init__ is skipped, so the controller-side modules never get imported.
+"""
+
+# Keep module-level imports to the bare minimum: when executed as a script,
+# nemu modules can only be imported after _bootstrap() has run.
+import os
+import sys
+import traceback
+import types
+
+__all__ = ['run', 'command_line']
+
+def run(sock, nonetns: bool, netns_fd: int = None):
+    """Set up the name space and serve requests on `sock' until the
+    controller quits. Never returns."""
+    import unshare
+    import nemu.protocol
+    from nemu import compat
+    from nemu.environ import execute, SYSCTL_PATH
+
+    try: # pragma: no cover
+        # coverage doesn't seem to understand fork
+        _close_inherited_fds(sock, netns_fd)
+        srv = nemu.protocol.Server(sock, sock)
+        if netns_fd is not None:
+            # join an existing name space
+            compat.setns(netns_fd, unshare.CLONE_NEWNET)
+            os.close(netns_fd)
+        elif not nonetns:
+            # create new name space
+            unshare.unshare(unshare.CLONE_NEWNET)
+            # Enable packet forwarding
+            execute([SYSCTL_PATH, '-w', 'net.ipv4.ip_forward=1'])
+            execute([SYSCTL_PATH, '-w', 'net.ipv6.conf.default.forwarding=1'])
+        srv.run()
+    except BaseException as e:
+        s = "Slave node aborting: %s\n" % str(e)
+        sep = "=" * 70 + "\n"
+        sys.stderr.write(s + sep)
+        traceback.print_exc(file=sys.stdout)
+        sys.stderr.write(sep)
+        try:
+            # try to pass the error to parent, if possible
+            sock.send(("500 " + s).encode())
+        except:
+            pass
+        os._exit(1)
+
+    os._exit(0) # pragma: no cover
+    # NOTREACHED
+
+def _close_inherited_fds(sock, netns_fd: int = None):
+    # A forked slave carries copies of the controller's objects; never let the
+    # collector finalise them here: their destructors would tear down the
+    # controller's resources, or close descriptor numbers reused since.
+    import gc
+    gc.freeze()
+    # Everything else came from the controller: other nodes' control channels,
+    # netlink sockets, user files... Keeping them would waste descriptors and
+    # could keep connections open after the controller closes them.
+    import syslog
+    from nemu import compat, environ
+    keep = [0, 1, 2, sock.fileno()]
+    if netns_fd is not None:
+        keep.append(netns_fd)
+    try:
+        keep.append(environ._log_stream.fileno())
+    except Exception:
+        pass
+    # syslog's socket would be closed under its feet; it reconnects lazily.
+    syslog.closelog()
+    compat.close_fds(keep)
+
+def command_line(fd: int, nonetns: bool, netns_fd: int = None) -> list[str]:
+    """Return the argument vector that starts a lean slave serving on the
+    inherited descriptor `fd'."""
+    if not sys.executable:
+        raise RuntimeError("Cannot find the Python interpreter")
+    if netns_fd is not None:
+        netns = str(netns_fd)
+    else:
+        netns = "none" if nonetns else "new"
+    # The package directory's parent, and wherever the dependencies live.
+    pkgroot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path = [pkgroot] + [os.path.abspath(p) for p in sys.path
+            if p and os.path.isdir(p) and p != pkgroot]
+    return [sys.executable, "-I", "-S", os.path.abspath(__file__),
+            str(fd), netns] + path
+
+def _bootstrap(path: list[str]):
+    sys.path[0:0] = path
+    # Register a bare package, so importing nemu.protocol does not execute
+    # nemu/__init__.py (which loads the whole controller-side library).
+    pkg = types.ModuleType("nemu")
+    pkg.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    sys.modules["nemu"] = pkg
+
+def _main(argv: list[str]): # pragma: no cover
+    fd, netns = int(argv[1]), argv[2]
+    _bootstrap(argv[3:])
+    import socket
+    sock = socket.socket(fileno = fd)
+    if netns == "new":
+        run(sock, False)
+    elif netns == "none":
+        run(sock, True)
+    else:
+        run(sock, False, int(netns))
+
+if __name__ == "__main__":
+    _main(sys.argv)
@@ -17,12 +17,14 @@
 # You should have received a copy of the GNU General Public License along with
 # Nemu.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import fcntl
-import grp
+import mmap
 import os
 import pickle
 import pwd
 import select
+import shutil
 import signal
 import sys
 import time
@@ -31,16 +33,28 @@ from typing import TYPE_CHECKING, Optional
 
 if TYPE_CHECKING:
     from nemu import Node
-from nemu import compat
-from nemu.environ import eintr_wrapper
+from nemu import compat, ringcopy
+from nemu.environ import eintr_wrapper, warning
 
-__all__ = ['PIPE', 'STDOUT', 'Popen', 'Subprocess', 'spawn', 'wait', 'poll',
-           'get_user', 'system', 'backticks', 'backticks_raise']
+__all__ = ['PIPE', 'STDOUT', 'RING', 'Popen', 'Ring', 'Subprocess', 'spawn',
+           'wait', 'poll',
+           'wait_any', 'spawn_many', 'terminate', 'terminate_all', 'get_user',
+           'get_credentials', 'Profile', 'system', 'backticks', 'backticks_raise']
 
 # User-facing interfaces
 
 KILL_WAIT = 3  # seconds
 
+# Bytes moved per system call in Popen.communicate()
+_CHUNK = 1 << 20
+
+# Linux >= 6.9: pidfd_send_signal(2) to the process group of the pidfd.
+_PIDFD_SIGNAL_PROCESS_GROUP = 4
+
+# Default capacity of the ring buffers created by Popen for RING.
+RING_SIZE = 1 << 16
+_RING_HEADER = ringcopy.HEADER
+
 
 class Subprocess(object):
     """Class that allows the execution of programs inside a nemu Node. This is
@@ -51,8 +65,8 @@ class Subprocess(object):
 
     def __init__(self, node: "Node", argv: str | list[str], executable=None,
                  stdin=None, stdout=None, stderr=None,
-                 shell=False, cwd=None, env=None, user=None):
-        self._slave = node._slave
+                 shell=False, cwd=None, env=None, user=None, profile=None):
+        self._slave = node._spawner
         """Forks and execs a program, with stdio redirection and user
         switching.
         
@@ -72,33 +86,43 @@ class Subprocess(object):
         If specified, `env' replaces the caller's environment with the
         dictionary provided.
 
+        `profile' is an id returned by Node.register_profile(), and supplies
+        the user, environment, and directory when these are not given.
+
         The standard input, output, and error of the created process will be
         redirected to the file descriptors specified by `stdin`, `stdout`, and
         `stderr`, respectively. These parameters must be open file objects,
         integers, or None (for no redirection). Note that the descriptors will
-        not be closed by this class.
+        not be closed by this class. The output can also go to a Ring.
         
         Exceptions occurred while trying to set up the environment or executing
         the program are propagated to the parent."""
 
-        if user is None:
-            user = Subprocess.default_user
-
-        if isinstance(argv, str):
-            argv = [argv]
-        if shell:
-            argv = ['/bin/sh', '-c'] + argv
-
         # Initialize attributes that would be used by the destructor if spawn
         # fails
-        self._pid = self._returncode = None
+        self._pid = self._returncode = self._pidfd = None
         # confusingly enough, to go to the function at the top of this file,
         # I need to call it thru the communications protocol: remember that
         # happens in another process!
-        self._pid = self._slave.spawn(argv, executable=executable,
-                                      stdin=stdin, stdout=stdout, stderr=stderr,
-                                      cwd=cwd, env=env, user=user)
-
+        pid = self._slave.spawn(**_spawn_args(argv, executable, stdin, stdout,
+                                              stderr, shell, cwd, env, user,
+                                              profile))
+        # A process descriptor lets us wait and signal without asking the
+        # slave; without one, everything goes through the protocol.
+        self._started(node, pid, self._slave.pidfd(pid))
+
+    @classmethod
+    def _attach(cls, node: "Node", pid: int, pidfd: Optional[int]):
+        # For processes already started by the slave
+        self = cls.__new__(cls)
+        self._slave = node._spawner
+        self._returncode = None
+        self._started(node, pid, pidfd)
+        return self
+
+    def _started(self, node: "Node", pid: int, pidfd: Optional[int]):
+        self._pid = pid
+        self._pidfd = pidfd
         node._add_subprocess(self)
 
     @property
@@ -106,24 +130,65 @@ class Subprocess(object):
         """The real process ID of this subprocess."""
         return self._pid
 
+    def fileno(self) -> int:
+        """Returns a process file descriptor, that becomes readable when the
+        program finishes; it can be used with select, poll, or epoll. It is
+        closed once the exit code has been collected."""
+        if self._pidfd is None:
+            raise RuntimeError("No process descriptor available")
+        return self._pidfd
+
+    def _running(self, timeout: float = 0) -> bool:
+        # True if the process is surely still running after `timeout'
+        # seconds; False if it has finished, or we cannot tell.
+        if self._pidfd is None:
+            return False
+        r, w, x = eintr_wrapper(select.select, [self._pidfd], [], [], timeout)
+        return not r
+
+    def _reaped(self, returncode: int):
+        self._returncode = returncode
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+
     def poll(self) -> Optional[int]:
         """Checks status of program, returns exitcode or None if still running.
         See Popen.poll."""
-        if self._returncode is None:
-            self._returncode = self._slave.poll(self._pid)
+        if self._returncode is None and not self._running():
+            ret = self._slave.poll(self._pid)
+            if ret is not None:
+                self._reaped(ret)
         return self.returncode
 
     def wait(self) -> int:
         """Waits for program to complete and returns the exitcode.
         See Popen.wait"""
         if self._returncode is None:
-            self._returncode = self._slave.wait(self._pid)
+            # Wait here, so the slave stays free to serve other requests
+            self._running(None)
+            self._reaped(self._slave.wait(self._pid))
         return self.returncode
 
     def signal(self, sig=signal.SIGTERM):
-        """Sends a signal to the process."""
-        if self._returncode is None:
-            self._slave.signal(self._pid, sig)
+        """Sends a signal to the process (and its process group)."""
+        global _PIDFD_SIGNAL_PROCESS_GROUP
+        if self._returncode is not None:
+            return
+        if self._pidfd is not None and _PIDFD_SIGNAL_PROCESS_GROUP:
+            try:
+                signal.pidfd_send_signal(self._pidfd, sig, None,
+                                         _PIDFD_SIGNAL_PROCESS_GROUP)
+                return
+            except ProcessLookupError:
+                # Finished, but not yet reaped
+                return
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # Older kernel, cannot signal the whole group
+                _PIDFD_SIGNAL_PROCESS_GROUP = 0
+        self._slave.signal(self._pid, sig)
 
     @property
     def returncode(self):
@@ -143,23 +208,84 @@ class Subprocess(object):
         self.destroy()
 
     def destroy(self):
-        if self._returncode is not None or self._pid is None:
-            return
-        self.signal()
-        now = time.time()
-        while time.time() - now < KILL_WAIT:
-            if self.poll() is not None:
-                return
-            time.sleep(0.1)
-        sys.stderr.write("WARNING: killing forcefully process %d.\n" %
-                         self._pid)
-        self.signal(signal.SIGKILL)
-        self.wait()
+        terminate_all([self])
 
 
 PIPE = -1
 STDOUT = -2
 DEVNULL = -3
+RING = -4
+
+
+class Ring(object):
+    """Ring buffer in shared memory, that keeps the last `size' bytes
+    written to the standard output or error of processes, to be read at any
+    time with tail(). Pass it instead of a descriptor to Subprocess or Popen:
+    inside the node, a small process copies the output into the buffer, so
+    the program never blocks waiting for the reader, and nothing is copied
+    until it is asked for. A Ring must not be shared between programs started
+    separately, as each would get its own writer."""
+
+    def __init__(self, size: int = RING_SIZE):
+        if size <= 0:
+            raise ValueError("Invalid ring size: %d" % size)
+        # Room for one more write, so the last `size' bytes can be read while
+        # the next ones arrive
+        chunk = min(size, _CHUNK)
+        self._size = size
+        self._fd = os.memfd_create("nemu-ring", os.MFD_CLOEXEC)
+        try:
+            os.ftruncate(self._fd, _RING_HEADER.size + size + chunk)
+            self._map = mmap.mmap(self._fd, 0)
+        except:
+            os.close(self._fd)
+            raise
+        _RING_HEADER.pack_into(self._map, 0, 0, chunk)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, '_fd', None) is None:
+            return
+        self._map.close()
+        os.close(self._fd)
+        self._fd = None
+
+    def fileno(self) -> int:
+        if self._fd is None:
+            raise ValueError("I/O operation on closed ring buffer")
+        return self._fd
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def written(self) -> int:
+        """Total number of bytes written so far."""
+        return _RING_HEADER.unpack_from(self._map, 0)[0]
+
+    def tail(self, n: Optional[int] = None) -> bytes:
+        """Returns the last `n' bytes written (by default, all the ones kept),
+        or less if not that many have been written."""
+        if n is None or n > self._size:
+            n = self._size
+        capacity = len(self._map) - _RING_HEADER.size
+        end = self.written
+        start = max(end - n, 0)
+        first, last = start % capacity, end % capacity
+        first += _RING_HEADER.size
+        last += _RING_HEADER.size
+        if start == end:
+            return b""
+        if first < last:
+            data = self._map[first:last]
+        else:
+            data = self._map[first:] + self._map[_RING_HEADER.size:last]
+        # Anything older than `size' bytes might have been overwritten
+        lost = self.written - self._size - start
+        return data[lost:] if lost > 0 else data
 
 
 class Popen(Subprocess):
@@ -168,23 +294,33 @@ class Popen(Subprocess):
 
     def __init__(self, node, argv, executable=None,
                  stdin=None, stdout=None, stderr=None, bufsize=0,
-                 shell=False, cwd=None, env=None, user=None):
+                 shell=False, cwd=None, env=None, user=None, profile=None,
+                 ring_size: int = RING_SIZE):
         """As in Subprocess, `node' specifies the nemu Node to run in.
 
         The `stdin', `stdout', and `stderr' parameters also accept the special
         values subprocess.PIPE or subprocess.STDOUT. Check the stdlib's
         subprocess module for more details. `bufsize' specifies the buffer size
         for the buffered IO provided for PIPE'd descriptors.
+
+        `stdout' and `stderr' can also be RING, to keep only the last
+        `ring_size' bytes of output in a Ring, available as the `stdout_ring'
+        and `stderr_ring' attributes.
         """
 
         self.stdin = self.stdout = self.stderr = None
+        self.stdout_ring = self.stderr_ring = None
         self._pid = self._returncode = None
         fdmap = {"stdin": stdin, "stdout": stdout, "stderr": stderr}
         # if PIPE: all should be closed at the end
         for k, v in fdmap.items():
             if v is None:
                 continue
-            if v == PIPE:
+            if isinstance(v, Ring) or (v == RING and k != "stdin"):
+                if v == RING:
+                    fdmap[k] = v = Ring(ring_size)
+                setattr(self, k + "_ring", v)
+            elif v == PIPE:
                 r, w = compat.pipe()
                 if k == "stdin":
                     self.stdin = os.fdopen(w, 'wb', bufsize)
@@ -201,69 +337,239 @@ class Popen(Subprocess):
                 os.set_inheritable(fdmap[k], True)
         if stderr == STDOUT:
             fdmap['stderr'] = fdmap['stdout']
+            self.stderr_ring = self.stdout_ring
 
         super(Popen, self).__init__(node, argv, executable=executable,
                                     stdin=fdmap['stdin'], stdout=fdmap['stdout'],
                                     stderr=fdmap['stderr'],
-                                    shell=shell, cwd=cwd, env=env, user=user)
+                                    shell=shell, cwd=cwd, env=env, user=user,
+                                    profile=profile)
 
         # Close pipes, they have been dup()ed to the child
         for k, v in fdmap.items():
             if getattr(self, k) is not None:
                 eintr_wrapper(os.close, v)
 
-    def communicate(self, input: bytes | str = None) -> tuple[bytes, bytes]:
-        """See Popen.communicate."""
-        # FIXME: almost verbatim from stdlib version, need to be removed or
-        # something
+    def communicate(self, input: bytes | str = None, stdout_file=None,
+                    stderr_file=None) -> tuple[bytes, bytes]:
+        """See Popen.communicate.
+
+        If `stdout_file' or `stderr_file' (open files or descriptors) are
+        given, that output is copied there as it arrives, instead of being
+        kept in memory, and None is returned in its place. When possible,
+        data is moved with splice(2) without going through user space."""
         if type(input) is str:
             input = input.encode("utf-8")
-        wset = []
-        rset = []
-        err = None
-        out = None
+        poller = select.poll()
+        # fd -> [file object, sink, use splice], for the pipes being read
+        pending = {}
+        result = {"stdout": None, "stderr": None}
+        inview = None
+        offset = 0
         if self.stdin is not None:
             self.stdin.flush()
             if input:
-                wset.append(self.stdin)
+                inview = memoryview(input)
+                os.set_blocking(self.stdin.fileno(), False)
+                poller.register(self.stdin.fileno(), select.POLLOUT)
             else:
                 self.stdin.close()
-        if self.stdout is not None:
-            rset.append(self.stdout)
-            out = []
-        if self.stderr is not None:
-            rset.append(self.stderr)
-            err = []
-
-        offset = 0
-        while rset or wset:
-            r, w, x = select.select(rset, wset, [])
-            if self.stdin in w:
-                wrote = os.write(self.stdin.fileno(),
-                                 # buffer(input, offset, select.PIPE_BUF))
-                                 input[offset:offset + 512])  # XXX: py2.7
-                offset += wrote
-                if offset >= len(input):
-                    self.stdin.close()
-                    wset = []
-            for i in self.stdout, self.stderr:
-                if i in r:
-                    d = os.read(i.fileno(), 1024)  # No need for eintr wrapper
-                    if d == b"":
-                        i.close()
-                        rset.remove(i)
+        for k, target in ("stdout", stdout_file), ("stderr", stderr_file):
+            f = getattr(self, k)
+            if f is None:
+                continue
+            _grow_pipe(f.fileno())
+            if target is None:
+                sink = result[k] = bytearray()
+            elif isinstance(target, int):
+                sink = target
+            else:
+                target.flush()
+                sink = target.fileno()
+            pending[f.fileno()] = [f, sink, not isinstance(sink, bytearray)]
+            poller.register(f.fileno(), select.POLLIN)
+
+        buf = memoryview(bytearray(_CHUNK))
+        while inview is not None or pending:
+            for fd, event in eintr_wrapper(poller.poll):
+                if inview is not None and fd == self.stdin.fileno():
+                    try:
+                        offset += os.write(fd, inview[offset:offset + _CHUNK])
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        # The program does not want more input
+                        offset = len(inview)
+                    if offset >= len(inview):
+                        poller.unregister(fd)
+                        self.stdin.close()
+                        inview = None
+                    continue
+                entry = pending[fd]
+                if entry[2]:
+                    try:
+                        n = eintr_wrapper(os.splice, fd, entry[1], _CHUNK)
+                    except OSError as e:
+                        # Not supported for the target: copy instead
+                        if e.errno != errno.EINVAL:
+                            raise
+                        entry[2] = False
+                        continue
+                else:
+                    n = eintr_wrapper(os.readv, fd, [buf])
+                    if isinstance(entry[1], bytearray):
+                        entry[1] += buf[:n]
                     else:
-                        if i == self.stdout:
-                            out.append(d)
-                        else:
-                            err.append(d)
-
-        if out is not None:
-            out = b''.join(out)
-        if err is not None:
-            err = b''.join(err)
+                        _write_all(entry[1], buf[:n])
+                if n == 0:
+                    poller.unregister(fd)
+                    entry[0].close()
+                    del pending[fd]
+
+        out, err = result["stdout"], result["stderr"]
         self.wait()
-        return (out, err)
+        return (None if out is None else bytes(out),
+                None if err is None else bytes(err))
+
+    def iter_chunks(self, size: int = 65536):
+        """Generator over the standard output of the program as it arrives,
+        in chunks of at most `size' bytes; stdout must be a PIPE. Standard
+        error is not read meanwhile, so if it is a PIPE too, the program can
+        block on it: redirect it to stdout or to a file instead. The output
+        is closed at end of file; the program is not waited for."""
+        if self.stdout is None:
+            raise RuntimeError("Standard output is not a pipe")
+        fd = self.stdout.fileno()
+        _grow_pipe(fd)
+        while True:
+            data = eintr_wrapper(os.read, fd, size)
+            if not data:
+                break
+            yield data
+        self.stdout.close()
+
+    def iter_lines(self, size: int = 65536):
+        """Like iter_chunks, but yields one line at a time, including the
+        line terminator."""
+        buf = bytearray()
+        for chunk in self.iter_chunks(size):
+            start = len(buf)
+            buf += chunk
+            pos = 0
+            nl = buf.find(b"\n", start)
+            while nl >= 0:
+                yield bytes(buf[pos:nl + 1])
+                pos = nl + 1
+                nl = buf.find(b"\n", pos)
+            del buf[:pos]
+        if buf:
+            yield bytes(buf)
+
+
+def _grow_pipe(fd: int):
+    # Fewer wake-ups and system calls for programs that write a lot.
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, _CHUNK)
+    except OSError:
+        # Over the per-user limits, or not a pipe
+        pass
+
+
+def _write_all(fd: int, data: memoryview):
+    while data:
+        data = data[eintr_wrapper(os.write, fd, data):]
+
+
+def _spawn_args(argv: str | list[str], executable=None,
+                stdin=None, stdout=None, stderr=None,
+                shell=False, cwd=None, env=None, user=None, profile=None) -> dict:
+    # Subprocess arguments, as taken by the protocol client's spawn()
+    if user is None and profile is None:
+        user = Subprocess.default_user
+    ring = None
+    if isinstance(stdout, Ring) or isinstance(stderr, Ring):
+        # Passed as the descriptor of the buffer, filled by the slave
+        ring = [k for k, v in (('stdout', stdout), ('stderr', stderr))
+                if isinstance(v, Ring)]
+        if isinstance(stdout, Ring):
+            stdout = stdout.fileno()
+        if isinstance(stderr, Ring):
+            stderr = stderr.fileno()
+
+    if isinstance(argv, str):
+        argv = [argv]
+    if shell:
+        argv = ['/bin/sh', '-c'] + argv
+    return dict(argv=argv, executable=executable, stdin=stdin, stdout=stdout,
+                stderr=stderr, cwd=cwd, env=env, user=user, profile=profile,
+                ring=ring)
+
+
+def spawn_many(node: "Node", specs: list) -> list[Subprocess]:
+    """Starts many programs inside `node' at once, with a single request:
+    they are forked back to back, instead of waiting for a round trip to the
+    node for each one. Each spec is either an argument vector, or a
+    dictionary with the arguments of Subprocess (except `node'). If any
+    program cannot be started, none of them is left running and the error is
+    raised. Returns the Subprocess objects, in the same order."""
+    if not specs:
+        return []
+    args = [_spawn_args(**s) if isinstance(s, dict) else _spawn_args(s)
+            for s in specs]
+    pids = node._spawner.spawn_many(args)
+    pidfds = node._spawner.pidfds(pids)
+    return [Subprocess._attach(node, pid, pidfd)
+            for pid, pidfd in zip(pids, pidfds)]
+
+
+def wait_any(processes: list[Subprocess],
+             timeout: Optional[float] = None) -> list[Subprocess]:
+    """Waits until at least one of `processes' finishes, or `timeout' seconds
+    pass, and returns the ones that have finished, with their exit codes
+    collected. Waiting is done on the process descriptors, so there is no
+    limit on the number of processes nor on the number of nodes involved."""
+    done = [p for p in processes if p.poll() is not None]
+    if done:
+        return done
+    watch = dict((p._pidfd, p) for p in processes if p._pidfd is not None)
+    if len(watch) < len(processes):
+        # Some cannot be waited for here: poll them all periodically
+        deadline = None if timeout is None else time.time() + timeout
+        while not done:
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(0.1)
+            done = [p for p in processes if p.poll() is not None]
+        return done
+    poller = select.poll()
+    for fd in watch:
+        poller.register(fd, select.POLLIN)
+    ready = eintr_wrapper(poller.poll,
+                          None if timeout is None else timeout * 1000)
+    return [watch[fd] for fd, ev in ready if watch[fd].poll() is not None]
+
+
+def terminate_all(processes: list[Subprocess],
+                  timeout: float = KILL_WAIT):
+    """Terminates all `processes' at once: each is sent SIGTERM, and those
+    still running after `timeout' seconds, a single deadline for all of them,
+    are killed with SIGKILL. Their exit codes are collected."""
+    running = [p for p in processes
+               if p._pid is not None and p._returncode is None]
+    for p in running:
+        p.signal()
+    deadline = time.time() + timeout
+    while running:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        wait_any(running, remaining)
+        running = [p for p in running if p._returncode is None]
+    for p in running:
+        warning("Killing forcefully process %d." % p._pid)
+        p.signal(signal.SIGKILL)
+    for p in running:
+        p.wait()
 
 
 def system(node: "Node", args: str | list[str]) -> Optional[int]:
@@ -300,7 +606,9 @@ def backticks_raise(node: "Node", args: str | list[str]) -> str:
 # Server-side code, called from nemu.protocol.Server
 
 def spawn(executable: str, argv=None, cwd=None, env=None, close_fds: bool | list[int] = False,
-          stdin=None, stdout=None, stderr=None, user=None) -> int:
+          stdin=None, stdout=None, stderr=None, user=None,
+          profile: "Profile" = None, ring: Optional[list[str]] = None,
+          cgroup: Optional[str] = None) -> int:
     """Internal function that performs all the dirty work for Subprocess, Popen
     and friends. This is executed in the slave process, directly from the
     protocol.Server class.
@@ -314,9 +622,41 @@ def spawn(executable: str, argv=None, cwd=None, env=None, close_fds: bool | list
     When close_fds is True, it closes all file descriptors bigger than 2.  It
     can also be an iterable of file descriptors to close after fork.
 
+    A Profile can be given to supply the user, environment and directory,
+    for those not given explicitly.
+
+    The streams named in `ring' ('stdout', 'stderr') are descriptors of Ring
+    buffers: a process is started to fill each one from a pipe.
+
+    If `cgroup' is given, the path of a cgroup v2 directory, the process joins
+    it before executing the program.
+
     Note that 'std{in,out,err}' must be None, integers, or file objects, PIPE
     is not supported here. Also, the original descriptors are not closed.
+
+    In the common case (close_fds is True, no user or directory change), the
+    program is started with posix_spawn(3), which neither copies the caller's
+    memory nor closes descriptors one by one.
     """
+    if ring:
+        # A single writer per buffer, even if received twice
+        writers = {}
+        try:
+            for k in ring:
+                fd = stdout if k == 'stdout' else stderr
+                st = os.fstat(fd)
+                if (st.st_dev, st.st_ino) not in writers:
+                    writers[(st.st_dev, st.st_ino)] = _ring_writer(fd)
+                if k == 'stdout':
+                    stdout = writers[(st.st_dev, st.st_ino)]
+                else:
+                    stderr = writers[(st.st_dev, st.st_ino)]
+            return spawn(executable, argv, cwd, env, close_fds, stdin, stdout,
+                         stderr, user, profile, cgroup=cgroup)
+        finally:
+            for fd in writers.values():
+                os.close(fd)
+
     userfd = [stdin, stdout, stderr]
     filtered_userfd = [x for x in userfd if x is not None and x >= 0]
     for i in range(3):
@@ -326,14 +666,34 @@ def spawn(executable: str, argv=None, cwd=None, env=None, close_fds: bool | list
     # Verify there is no clash
     assert not ({0, 1, 2} & set(filtered_userfd))
 
+    credentials = None
+    if profile is not None:
+        if cwd is None:
+            cwd = profile.cwd
+        if env is None:
+            env = profile.env
+        if user is None:
+            credentials = profile.credentials
     if user is not None:
-        user, uid, gid = get_user(user)
-        home = pwd.getpwuid(uid)[5]
-        groups = [x[2] for x in grp.getgrall() if user in x[3]]
-        if not env:
-            env = dict(os.environ)
-        env['HOME'] = home
-        env['USER'] = user
+        credentials = get_credentials(user)
+        # Copied, as it might come from the profile
+        env = dict(env) if env else dict(os.environ)
+        env['HOME'] = credentials[3]
+        env['USER'] = credentials[0]
+    if credentials is not None:
+        user, uid, gid, home, groups = credentials
+
+    if close_fds is True and credentials is None and cwd is None and \
+            cgroup is None:
+        path = executable
+        if '/' not in executable:
+            # Searched here, as execvpe would do, with the new environment.
+            search = (env if env is not None else os.environ).get(
+                "PATH", os.defpath)
+            path = shutil.which(executable, path=search)
+        if path:
+            return _posix_spawn(path, argv or [executable], env, userfd)
+        # Not found: let the fork path report the error
 
     (r, w) = compat.pipe()
     pid = os.fork()
@@ -344,8 +704,10 @@ def spawn(executable: str, argv=None, cwd=None, env=None, close_fds: bool | list
             for i in range(3):
                 if userfd[i] is not None and userfd[i] >= 0:
                     os.dup2(userfd[i], i)
-                    if userfd[i] != i and userfd[i] not in userfd[0:i]:
-                        eintr_wrapper(os.close, userfd[i])  # only in child!
+            # Only after all the dup2()s: the same fd may be used twice
+            for fd in set(userfd):
+                if fd is not None and fd > 2:
+                    eintr_wrapper(os.close, fd)  # only in child!
 
             # Set up special control pipe
             eintr_wrapper(os.close, r)
@@ -353,12 +715,7 @@ def spawn(executable: str, argv=None, cwd=None, env=None, close_fds: bool | list
             fcntl.fcntl(w, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
 
             if close_fds is True:
-                for i in range(3, MAXFD):
-                    if i != w:
-                        try:
-                            os.close(i)
-                        except:
-                            pass
+                compat.close_fds([0, 1, 2, w])
             elif close_fds is not False:
                 for i in close_fds:
                     os.close(i)
@@ -367,7 +724,11 @@ def spawn(executable: str, argv=None, cwd=None, env=None, close_fds: bool | list
             # (it is necessary to kill the forked subprocesses)
             os.setpgrp()
 
-            if user is not None:
+            if cgroup is not None:
+                # Before anything else runs, so nothing escapes it
+                with open(os.path.join(cgroup, "cgroup.procs"), "w") as f:
+                    f.write("0")
+            if credentials is not None:
                 # Change user
                 os.setgid(gid)
                 os.setgroups(groups)
@@ -423,6 +784,19 @@ def spawn(executable: str, argv=None, cwd=None, env=None, close_fds: bool | list
     raise exc
 
 
+def _posix_spawn(path: str, argv: list[str], env, userfd) -> int:
+    # Descriptors are closed in the child only, after the dup2()s: the flags
+    # of this process are shared with other threads, which may be spawning
+    # too. Close-on-exec ones need no action, and those opened meanwhile are
+    # close-on-exec unless made inheritable on purpose (PEP 446).
+    actions = [(os.POSIX_SPAWN_DUP2, userfd[i], i) for i in range(3)
+               if userfd[i] is not None and userfd[i] >= 0]
+    # glibc ignores EBADF here, for descriptors closed in the meantime
+    actions += [(os.POSIX_SPAWN_CLOSE, fd) for fd in compat.inheritable_fds(3)]
+    return os.posix_spawn(path, argv, env if env is not None else os.environ,
+                          file_actions=actions, setpgroup=0)
+
+
 def poll(pid):
     """Check if the process already died. Returns the exit code or None if
     the process is still alive."""
@@ -437,6 +811,65 @@ def wait(pid):
     return eintr_wrapper(os.waitpid, pid, 0)[1]
 
 
+def terminate(pids: list[int], timeout: float = KILL_WAIT) -> list[int]:
+    """Same as terminate_all, for children of this process: sends SIGTERM to
+    the process groups of all `pids', waits for them with a single deadline,
+    and kills those still running at the end. Returns the pids that had to be
+    killed."""
+    left = set(pids)
+    for pid in left:
+        try:
+            # -PID to kill to whole process group
+            os.kill(-pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    poller = select.poll()
+    pidfds = {}
+    try:
+        for pid in left:
+            try:
+                pidfds[pid] = os.pidfd_open(pid)
+            except (AttributeError, OSError):
+                continue
+            poller.register(pidfds[pid], select.POLLIN)
+        deadline = time.time() + timeout
+        while True:
+            for pid in list(left):
+                if _collect(pid):
+                    left.remove(pid)
+                    if pid in pidfds:
+                        poller.unregister(pidfds[pid])
+            remaining = deadline - time.time()
+            if not left or remaining <= 0:
+                break
+            if all(pid in pidfds for pid in left):
+                eintr_wrapper(poller.poll, remaining * 1000)
+            else:
+                time.sleep(min(0.1, remaining))
+    finally:
+        for fd in pidfds.values():
+            os.close(fd)
+    for pid in left:
+        try:
+            os.kill(-pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    for pid in left:
+        try:
+            wait(pid)
+        except ChildProcessError:
+            pass
+    return sorted(left)
+
+
+def _collect(pid: int) -> bool:
+    # Reap the process if it has finished
+    try:
+        return poll(pid) is not None
+    except ChildProcessError:
+        return True
+
+
 def get_user(user):
     "Take either an username or an uid, and return a tuple (user, uid, gid)."
     if str(user).isdigit():
@@ -454,6 +887,52 @@ def get_user(user):
     return user, uid, gid
 
 
+def get_credentials(user) -> tuple[str, int, int, str, list[int]]:
+    """Like get_user, but also returns the home directory and the list of
+    groups of the user: (user, uid, gid, home, groups)."""
+    user, uid, gid = get_user(user)
+    home = pwd.getpwuid(uid)[5]
+    # Lets the name service answer directly, instead of scanning all groups
+    groups = os.getgrouplist(user, gid)
+    return user, uid, gid, home, groups
+
+
+class Profile(object):
+    """User credentials, environment, and working directory for spawn(),
+    resolved once and then reused for any number of processes: looking up
+    the groups of a user can be slow, depending on the name service."""
+
+    def __init__(self, user=None, env=None, cwd=None):
+        self.cwd = cwd
+        self.credentials = None
+        self.env = None if env is None else dict(env)
+        if user is not None:
+            self.credentials = get_credentials(user)
+            if self.env is None:
+                self.env = dict(os.environ)
+            self.env['HOME'] = self.credentials[3]
+            self.env['USER'] = self.credentials[0]
+
+
+def _ring_writer(ringfd: int) -> int:
+    # Starts a process that copies into the Ring buffer in `ringfd' what is
+    # written to the returned pipe, until all its writers close it. It is
+    # executed, not forked: we might have other threads (see
+    # node._DirectSpawner), whose locks would be inherited in any state.
+    argv = ringcopy.command_line()
+    r, w = os.pipe()
+    try:
+        pid = spawn(argv[0], argv, close_fds=True, stdin=r, stdout=ringfd)
+    except:
+        os.close(w)
+        raise
+    finally:
+        os.close(r)
+    # It detaches itself right away
+    wait(pid)
+    return w
+
+
 # internal stuff, do not look!
 
 try:
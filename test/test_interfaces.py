@@ -4,7 +4,7 @@
 from test_util import get_devs, get_devs_netns
 from nemu.environ import *
 import nemu, test_util
-import os, unittest
+import gc, os, sys, unittest
 
 class TestUtils(unittest.TestCase):
     def test_utils(self):
@@ -94,6 +94,111 @@ class TestInterfaces(unittest.TestCase):
             peer_name = nemu.iproute.get_if(ifaces[i].control.index).name
             self.assertTrue(peer_name in devs)
 
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_bulk_creation(self):
+        node0 = nemu.Node()
+        node1 = nemu.Node()
+        ifaces = node0.add_ifs(100, mtu = 1400)
+        self.assertEqual(len(ifaces), 100)
+        devs = get_devs_netns(node0)
+        hostdevs = get_devs()
+        for i in ifaces:
+            self.assertEqual(devs[i.name]['mtu'], 1400)
+            self.assertEqual(node0.get_interface(i.name), i)
+            peer_name = nemu.iproute.get_if(i.control.index).name
+            self.assertTrue(peer_name in hostdevs)
+
+        pairs = nemu.P2PInterface.create_pairs([(node0, node1),
+            (node1, node0), (node0, node1)])
+        self.assertEqual(len(pairs), 3)
+        self.assertEqual(pairs[1][0].name, node1.get_interface(
+            pairs[1][0].name).name)
+        self.assertTrue(pairs[1][1].name in get_devs_netns(node0))
+        self.assertEqual(len(node0.get_interfaces()), 1 + 100 + 3)
+        self.assertEqual(len(node1.get_interfaces()), 1 + 3)
+
+        # A name clash makes the whole batch fail, and nothing is left behind
+        name = nemu.interface.Interface._gen_if_name()
+        nemu.interface.Interface._nextid -= 1
+        self.assertEqual(node0.system([IP_PATH, "link", "add", name,
+            "type", "veth", "peer", "name", "foo0"]), 0)
+        self.assertRaises(RuntimeError, nemu.P2PInterface.create_pairs,
+                [(node0, node1)] * 3)
+        self.assertEqual(node0.system([IP_PATH, "link", "del", name]), 0)
+        self.assertEqual(len(node0.get_interfaces()), 1 + 100 + 3)
+        self.assertEqual(len(node1.get_interfaces()), 1 + 3)
+
+        for i in ifaces[:50]:
+            node0.del_if(i)
+        self.assertEqual(len(node0.get_interfaces()), 1 + 50 + 3)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_link_options(self):
+        def features(node, iface):
+            fd = os.open("/proc/%d/ns/net" % node.pid, os.O_RDONLY)
+            try:
+                et = nemu.netlink.Ethtool(fd)
+            finally:
+                os.close(fd)
+            res = et.get_features(iface.index)
+            et.close()
+            return res
+
+        node0 = nemu.Node()
+        node1 = nemu.Node(direct = False)
+        for node in (node0, node1):
+            if0 = node.add_if(numtxqueues = 4, numrxqueues = 4,
+                    txqueuelen = 5000, gso = False, tso = False, gro = True,
+                    mtu = 1400)
+            out = node.backticks([IP_PATH, "-d", "link", "show", "dev",
+                if0.name])
+            self.assertTrue("numtxqueues 4 numrxqueues 4" in out)
+            self.assertTrue("qlen 5000" in out)
+            self.assertEqual(if0.mtu, 1400)
+            feat = features(node, if0)
+            self.assertTrue("rx-gro" in feat)
+            self.assertFalse("tx-generic-segmentation" in feat)
+            self.assertFalse("tx-tcp-segmentation" in feat)
+            if0.gso = True
+            self.assertTrue("tx-generic-segmentation" in features(node, if0))
+
+        # The switch port gets the options given to connect()
+        switch = nemu.Switch()
+        switch.connect(if0, txqueuelen = 2000)
+        out = nemu.iproute.backticks([IP_PATH, "link", "show", "dev",
+            if0.control.name])
+        self.assertTrue("qlen 2000" in out)
+
+        if1, if2 = nemu.P2PInterface.create_pair(node0, node1,
+                numtxqueues = 2, numrxqueues = 2, txqueuelen = 100)
+        for node, i in ((node0, if1), (node1, if2)):
+            out = node.backticks([IP_PATH, "-d", "link", "show", "dev",
+                i.name])
+            self.assertTrue("numtxqueues 2 numrxqueues 2" in out)
+            self.assertTrue("qlen 100" in out)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_p2p_parameters(self):
+        node0 = nemu.Node()
+        node1 = nemu.Node()
+        if0, if1 = nemu.P2PInterface.create_pair(node0, node1,
+                bandwidth = 13107200)
+        for node, i in ((node0, if0), (node1, if1)):
+            out = node.backticks([TC_PATH, "qdisc", "show",
+                "dev", i.name])
+            self.assertTrue("tbf 1: root" in out)
+            self.assertTrue("rate 13107Kbit" in out)
+            # Read in-process and through the slave alike
+            self.assertEqual(node._slave.get_tc_data(i.index),
+                    nemu.protocol.Client.get_tc_data(node._slave, i.index))
+
+        if1.set_parameters()
+        out = node1.backticks([TC_PATH, "qdisc", "show", "dev",
+            if1.name])
+        self.assertFalse("tbf" in out)
+        self.assertRaises(ValueError, if0.set_parameters, delay = 0.001,
+                delay_correlation = 0.5)
+
     @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
     def test_interface_settings(self):
         node0 = nemu.Node()
@@ -166,6 +271,183 @@ class TestInterfaces(unittest.TestCase):
         self.assertTrue(len(if0.get_addresses()) >= 2)
         self.assertEqual(if0.get_addresses(), devs[if0.name]['addr'])
 
+        # Only this interface's addresses, through the slave too
+        node1 = nemu.Node(direct = False)
+        if1 = node1.add_if()
+        self.assertEqual(if1.get_addresses(), [])
+        if1.add_v4_address(address = '10.0.1.1', prefix_len = 24)
+        self.assertEqual(if1.get_addresses(), [{'address': '10.0.1.1',
+            'prefix_len': 24, 'broadcast': '10.0.1.255', 'family': 'inet'}])
+
+        ctl = if0.control
+        ctl.add_v4_address(address = '10.0.3.1', prefix_len = 24)
+        self.assertEqual([a for a in ctl.get_addresses()
+            if a['family'] == 'inet'], [{'address': '10.0.3.1',
+                'prefix_len': 24, 'broadcast': '10.0.3.255',
+                'family': 'inet'}])
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_interface_lookup(self):
+        node0 = nemu.Node()
+        if0 = node0.add_if()
+        self.assertTrue(node0.get_interface(if0.name) is if0)
+        self.assertRaises(IndexError, node0.get_interface, "foo0")
+
+        # Changes made behind our back are picked up too
+        self.assertEqual(node0.system([IP_PATH, "link", "add", "foo0",
+            "type", "veth", "peer", "name", "foo1"]), 0)
+        foo0 = node0.get_interface("foo0")
+        self.assertEqual(foo0.name, "foo0")
+        self.assertEqual(len(node0.get_interfaces()), 4)
+        self.assertEqual(node0.system([IP_PATH, "link", "set", "foo0",
+            "name", "bar0"]), 0)
+        self.assertRaises(IndexError, node0.get_interface, "foo0")
+        self.assertTrue(node0.get_interface("bar0") is foo0)
+        self.assertEqual(node0.system([IP_PATH, "link", "del", "bar0"]), 0)
+        self.assertRaises(IndexError, node0.get_interface, "bar0")
+        self.assertEqual(set(node0.get_interfaces()),
+                set([if0, node0.get_interface("lo")]))
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_interface_names(self):
+        # Names stay unique and short well past the old 4096 limit
+        self.addCleanup(setattr, nemu.interface.Interface, "_nextid",
+                nemu.interface.Interface._nextid)
+        names = set()
+        for i in range(300000):
+            name = nemu.interface.Interface._gen_if_name()
+            self.assertTrue(len(name) <= 15)
+            names.add(name)
+        self.assertEqual(len(names), 300000)
+
+        # Controllers whose PIDs share the lower bits do not clash
+        getpid = os.getpid
+        self.addCleanup(setattr, os, "getpid", getpid)
+        names = set()
+        for pid in (1234, 1234 + (1 << 16), 1234 + (1 << 21), (1 << 22) - 1):
+            os.getpid = lambda: pid
+            nemu.interface.Interface._nextid = 0
+            names.add(nemu.interface.Interface._gen_if_name())
+        os.getpid = getpid
+        self.assertEqual(len(names), 4)
+        self.assertTrue(all(len(name) == 15 for name in names))
+
+        # Wrapping around skips the names still in use
+        node0 = nemu.Node()
+        switch = nemu.Switch()
+        nemu.interface.Interface._nextid = \
+                (1 << nemu.interface._ID_BITS) - 1
+        if0 = node0.add_if()
+        self.assertTrue(nemu.find_interface(if0.name) is if0)
+        self.assertTrue(nemu.find_interface(if0.control.name) is if0.control)
+        self.assertTrue(nemu.find_interface(switch.name) is switch)
+        nemu.interface.Interface._nextid = \
+                (1 << nemu.interface._ID_BITS) - 1
+        if1 = node0.add_if()
+        self.assertTrue(if1.name not in (if0.name, if0.control.name))
+        self.assertTrue(nemu.find_interface(if1.name) is if1)
+
+        if1.name = "foo0"
+        self.assertEqual(nemu.find_interface("foo0"), None)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_interface_configure(self):
+        node0 = nemu.Node()
+        if0 = node0.add_if(up = True, mtu = 1400)
+        self.assertTrue(if0.up)
+        self.assertEqual(if0.mtu, 1400)
+        # name and address changes need the interface down; it is restored
+        if0.configure(name = "foo0", lladdr = '42:71:e0:90:ca:42', mtu = 1300)
+        devs = get_devs_netns(node0)
+        self.assertTrue("foo0" in devs)
+        self.assertTrue(devs["foo0"]['up'])
+        self.assertEqual(devs["foo0"]['lladdr'], '42:71:e0:90:ca:42')
+        self.assertEqual(devs["foo0"]['mtu'], 1300)
+        self.assertRaises(AttributeError, if0.configure, foo = 1)
+        self.assertRaises(RuntimeError, if0.configure, mtu = 1, up = False)
+        self.assertTrue(if0.up)
+
+        if0.control.configure(up = True, mtu = 1300)
+        devs = get_devs()
+        self.assertTrue(devs[if0.control.name]['up'])
+        self.assertEqual(devs[if0.control.name]['mtu'], 1300)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_interface_state(self):
+        node0 = nemu.Node()
+        if0 = node0.add_if(mtu = 1492)
+        state = if0.state()
+        self.assertEqual((state.index, state.name, state.mtu, state.up),
+                (if0.index, if0.name, 1492, False))
+        self.assertTrue(if0.state() is state)
+        self.assertRaises(AttributeError, setattr, state, 'mtu', 1500)
+
+        # Changes through the wrapper update the view
+        if0.up = True
+        self.assertTrue(if0.state().up)
+        self.assertFalse(state.up)
+
+        # Changes from outside are seen after a refresh
+        r = node0.system([IP_PATH, "link", "set", if0.name, "mtu", "1400"])
+        self.assertEqual(r, 0)
+        self.assertEqual(if0.state().mtu, 1492)
+        self.assertEqual(if0.refresh().mtu, 1400)
+
+        if0.set_snapshot()
+        r = node0.system([IP_PATH, "link", "set", if0.name, "mtu", "1300"])
+        self.assertEqual(if0.mtu, 1400)
+        node0.get_interfaces() # processes link notifications
+        self.assertEqual(if0.mtu, 1300)
+        if0.set_snapshot(False)
+
+        # Removed from outside
+        r = node0.system([IP_PATH, "link", "del", if0.name])
+        self.assertEqual(r, 0)
+        self.assertRaises(RuntimeError, if0.refresh)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_direct_configuration(self):
+        # In-process (netlink) and slave-based configuration must agree.
+        nodes = [nemu.Node(direct = True), nemu.Node(direct = False)]
+        results = []
+        ifaces = []
+        for node in nodes:
+            if0 = node.add_if(lladdr = '42:71:e0:90:ca:42', mtu = 1492)
+            ifaces.append(if0)
+            if0.up = True
+            if0.add_v4_address(address = '10.0.0.1', prefix_len = 24)
+            node.add_route(prefix = '10.1.0.0', prefix_len = 16,
+                    nexthop = '10.0.0.2')
+            devs = get_devs_netns(node)
+            self.assertTrue(devs[if0.name]['up'])
+            self.assertEqual(devs[if0.name]['mtu'], 1492)
+            self.assertEqual(if0.get_addresses(), devs[if0.name]['addr'])
+            results.append((if0.lladdr, if0.mtu, if0.up,
+                [(r.prefix, r.prefix_len, r.nexthop)
+                    for r in node.get_routes()]))
+        self.assertEqual(results[0], results[1])
+        for if0 in ifaces:
+            self.assertRaises(RuntimeError, setattr, if0, 'mtu', 1)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_collected_with_node(self):
+        # Collected in the same cycle, the node does not see the interfaces
+        # when it is destroyed: they must not try to use its slave later.
+        errors = []
+        hook = sys.unraisablehook
+        sys.unraisablehook = errors.append
+        try:
+            for direct in (True, False):
+                nodes = [nemu.Node(direct = direct) for i in range(2)]
+                ifaces = [nodes[0].add_if()]
+                ifaces += nemu.P2PInterface.create_pair(*nodes)
+                nodes[0]._cycle = (nodes, ifaces)
+                del nodes, ifaces
+                gc.collect()
+        finally:
+            sys.unraisablehook = hook
+        self.assertEqual([e.exc_value for e in errors], [])
+
 class TestWithDummy(unittest.TestCase):
     def setUp(self):
         self.cleanup = []
@@ -1,7 +1,7 @@
 #!/usr/bin/env python2
 # vim:ts=4:sw=4:et:ai:sts=4
 
-import nemu, nemu.environ, test_util
+import nemu, nemu.cgroup, nemu.environ, test_util
 import os, signal, subprocess, sys, time
 import unittest
 
@@ -19,6 +19,132 @@ class TestNode(unittest.TestCase):
 
         self.assertTrue(node.get_interface("lo").up)
 
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_persistent_node(self):
+        name = "nemu-test-%d" % os.getpid()
+        node = nemu.Node(name = name)
+        self.assertEqual(node.name, name)
+        self.assertTrue(os.path.exists(os.path.join("/run/netns", name)))
+        if0 = node.add_if()
+        ifname = if0.name
+        node.destroy()
+        # The name space and its interfaces survive the node
+        self.assertTrue(os.path.exists(os.path.join("/run/netns", name)))
+
+        node = nemu.Node.attach(name)
+        self.assertTrue(ifname in test_util.get_devs_netns(node))
+        self.assertTrue(node.get_interface("lo").up)
+        node.delete_netns()
+        self.assertFalse(os.path.exists(os.path.join("/run/netns", name)))
+        node.destroy()
+
+        self.assertRaises(OSError, nemu.Node.attach, name)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_lean_node(self):
+        node = nemu.Node(lean = True)
+        cmdline = open("/proc/%d/cmdline" % node.pid).read().split("\0")
+        self.assertTrue(cmdline[3].endswith("slave.py"))
+        self.assertTrue(node.get_interface("lo").up)
+        if0 = node.add_if()
+        self.assertTrue(if0.name in test_util.get_devs_netns(node))
+        self.assertEqual(node.backticks(["echo", "hello"]), "hello\n")
+        node.destroy()
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_direct_spawn(self):
+        ours = os.readlink("/proc/self/ns/net")
+        node = nemu.Node(direct_spawn = True)
+        if0 = node.add_if()
+        netns = os.readlink("/proc/%d/ns/net" % node.pid)
+        self.assertEqual(node.backticks("readlink /proc/self/ns/net"),
+                netns + "\n")
+        self.assertTrue(if0.name in node.backticks("ip -o link"))
+        # Through fork() instead of posix_spawn()
+        p = node.Popen(["readlink", "/proc/self/ns/net"], cwd = "/",
+                stdout = nemu.subprocess_.PIPE)
+        self.assertEqual(p.communicate()[0], netns.encode() + b"\n")
+        self.assertEqual(os.readlink("/proc/self/ns/net"), ours)
+
+        p = node.Subprocess(["sleep", "100"])
+        with open("/proc/%d/stat" % p.pid) as f:
+            self.assertEqual(int(f.read().split()[3]), os.getpid())
+        procs = node.spawn_many([["sleep", "100"]] * 10)
+        self.assertRaises(FileNotFoundError, node.spawn_many,
+                [["sleep", "100"], ["/foo/bar"]])
+        p.signal()
+        self.assertEqual(p.wait(), -signal.SIGTERM)
+        pids = [q.pid for q in procs]
+        node.destroy()
+        for pid in pids:
+            self.assertRaises(OSError, os.kill, pid, 0)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    @test_util.skipUnless(nemu.cgroup.find_mount(), "Test requires cgroup2")
+    def test_cgroup(self):
+        node = nemu.Node()
+        self.assertRaises(RuntimeError, node.usage)
+        node.destroy()
+
+        for node in (nemu.Node(cgroup = True),
+                nemu.Node(cgroup = True, direct_spawn = True)):
+            path = node._cgroup.path
+            cgroup = "0::/" + os.path.relpath(path,
+                    nemu.cgroup.find_mount()) + "\n"
+            self.assertEqual(node.backticks("grep ^0:: /proc/self/cgroup"),
+                    cgroup)
+            # Started in its own session, out of reach of the node's signals
+            p = node.Popen("setsid sleep 100 & echo $!; sleep 100",
+                    shell = True, stdout = nemu.subprocess_.PIPE)
+            orphan = int(p.stdout.readline())
+            p.stdout.close()
+            self.assertTrue({p.pid, orphan} <= set(node._cgroup.pids()))
+            node.system("i=0; while [ $i -lt 100000 ]; do i=$((i+1)); done")
+            self.assertTrue(node.usage()["usage_usec"] > 0)
+
+            controllers = node._cgroup.controllers()
+            if "cpu" in controllers:
+                node.set_resources(cpu_weight = 50, cpu_quota = 0.5)
+                with open(os.path.join(path, "cpu.max")) as f:
+                    self.assertEqual(f.read(), "50000 100000\n")
+                node.set_resources()
+                with open(os.path.join(path, "cpu.max")) as f:
+                    self.assertEqual(f.read(), "max 100000\n")
+            else:
+                self.assertRaises(RuntimeError, node.set_resources,
+                        cpu_quota = 0.5)
+            if "memory" in controllers:
+                node.set_resources(memory_max = 1 << 30)
+                self.assertTrue(node.usage()["memory_current"] > 0)
+
+            node.destroy()
+            self.assertEqual(p.returncode, -signal.SIGKILL)
+            # The group can only be removed once empty
+            self.assertFalse(os.path.exists(path))
+            # Not a child of ours: it may not have been reaped yet
+            try:
+                with open("/proc/%d/stat" % orphan) as f:
+                    state = f.read().rsplit(")", 1)[1].split()[0]
+                self.assertIn(state, ("Z", "X"))
+            except FileNotFoundError:
+                pass
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_node_fds(self):
+        files = [open("/dev/null") for i in range(10)]
+        before = len(os.listdir("/proc/self/fd"))
+        nodes = [nemu.Node(), nemu.Node(lean = True), nemu.Node()]
+        # control channel, plus the netlink and link monitor sockets
+        self.assertTrue(len(os.listdir("/proc/self/fd")) - before <= 3 * 3)
+        for node in nodes:
+            # stdio and the control channel; nothing inherited from us
+            self.assertTrue(len(os.listdir("/proc/%d/fd" % node.pid)) <= 4)
+            self.assertEqual(node.backticks(["echo", "hello"]), "hello\n")
+        for node in nodes:
+            node.destroy()
+        for f in files:
+            f.close()
+
     @test_util.skip("Not implemented")
     def test_detect_fork(self):
         # Test that nemu recognises a fork
@@ -1,10 +1,12 @@
 #!/usr/bin/env python2
 # vim:ts=4:sw=4:et:ai:sts=4
+import asyncio
 import errno
 
 import nemu, test_util
 import nemu.subprocess_ as sp
-import grp, os, pwd, signal, socket, sys, time, unittest
+import grp, io, os, pwd, select, signal, socket, sys, tempfile, time
+import unittest
 
 from nemu import compat
 
@@ -135,6 +137,32 @@ class TestSubprocess(unittest.TestCase):
         os.close(r0)
         self.assertEqual(sp.wait(p), 0)
 
+    def test_spawn_close_fds(self):
+        # Inheritable descriptors do not reach the program
+        fd = os.dup2(2, 100, inheritable = True)
+        r1, w1 = compat.pipe()
+        p = sp.spawn('/bin/ls', ['ls', '/proc/self/fd'], stdout = w1,
+                close_fds = True)
+        os.close(w1)
+        fds = set(int(x) for x in _readall(r1).split())
+        os.close(r1)
+        self.assertEqual(sp.wait(p), 0)
+        self.assertTrue(set([0, 1, 2]) <= fds)
+        self.assertFalse(fd in fds)
+        self.assertTrue(os.get_inheritable(fd))
+        os.close(fd)
+
+        # The program is searched in the new environment's PATH
+        r, w = compat.pipe()
+        p = sp.spawn('echo', ['echo', 'hi'], env = {'PATH': '/bin'},
+                stdout = w, close_fds = True)
+        os.close(w)
+        self.assertEqual(_readall(r), b"hi\n")
+        os.close(r)
+        self.assertEqual(sp.wait(p), 0)
+        self.assertRaises(OSError, sp.spawn, 'echo', env = {'PATH': ''},
+                close_fds = True)
+
     def test_Subprocess_basic(self):
         node = nemu.Node(nonetns = True)
         # User does not exist
@@ -217,6 +245,208 @@ class TestSubprocess(unittest.TestCase):
         p.signal() # since it has not been waited for, it should not raise
         self.assertEqual(p.wait(), -signal.SIGTERM)
 
+    def test_Subprocess_pidfd(self):
+        node = nemu.Node(nonetns = True)
+        p = node.Subprocess(['sleep', '100'])
+        fd = p.fileno()
+        self.assertEqual(select.select([p], [], [], 0)[0], [])
+        # The signal reaches the whole process group
+        r, w = compat.pipe()
+        q = node.Subprocess('sleep 100 & echo $!; wait', shell = True,
+                stdout = w)
+        os.close(w)
+        grandchild = int(os.read(r, 100))
+        os.close(r)
+        q.signal()
+        self.assertEqual(q.wait(), -signal.SIGTERM)
+        time.sleep(0.2)
+        try:
+            # Killed, maybe not yet reaped by its new parent
+            with open("/proc/%d/stat" % grandchild) as f:
+                self.assertEqual(f.read().split()[2], "Z")
+        except FileNotFoundError:
+            pass
+        # Closed once the exit code is collected
+        p.signal(signal.SIGKILL)
+        self.assertEqual(select.select([p], [], [], 5)[0], [p])
+        self.assertEqual(p.poll(), -signal.SIGKILL)
+        self.assertRaises(RuntimeError, p.fileno)
+        self.assertRaises(OSError, os.fstat, fd)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_wait_any(self):
+        # Many processes, over many nodes
+        nodes = [nemu.Node(nonetns = True), nemu.Node(),
+                nemu.Node(lean = True)]
+        procs = [n.Subprocess(['sleep', '100']) for n in nodes * 20]
+        self.assertEqual(sp.wait_any(procs, 0.1), [])
+        procs[7].signal()
+        self.assertEqual(sp.wait_any(procs), [procs[7]])
+        self.assertEqual(sp.wait_any(procs), [procs[7]])
+        for x in procs:
+            x.signal()
+        for x in procs:
+            self.assertEqual(x.wait(), -signal.SIGTERM)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_spawn_many(self):
+        node = nemu.Node()
+        self.assertEqual(node.spawn_many([]), [])
+        r, w = compat.pipe()
+        procs = node.spawn_many([['true']] * 300 + [
+            dict(argv = 'echo $FOO', shell = True, env = {'FOO': 'bar'},
+                stdout = w),
+            dict(argv = ['/bin/pwd'], cwd = '/', stdout = w, stderr = w)] +
+            [dict(argv = ['true'], stdout = w)] * 300)
+        os.close(w)
+        self.assertEqual(len(procs), 602)
+        self.assertEqual(len(set(p.pid for p in procs)), 602)
+        self.assertEqual([p.wait() for p in procs], [0] * 602)
+        # Both run at once, in any order
+        self.assertEqual(sorted(_readall(r).split()), [b"/", b"bar"])
+        os.close(r)
+
+        # All or nothing
+        before = set(int(pid) for pid in
+                node.backticks("ls /proc | grep '^[0-9]'").split())
+        self.assertRaises(FileNotFoundError, node.spawn_many,
+                [['sleep', '100'], [self.nofile]])
+        self.assertRaises(ValueError, node.spawn_many,
+                [['sleep', '100'], dict(argv = 'true', user = self.nouser)])
+        after = set(int(pid) for pid in
+                node.backticks("ls /proc | grep '^[0-9]'").split())
+        self.assertFalse(any(open("/proc/%d/cmdline" % pid).read() ==
+            "sleep\0" "100\0" for pid in after - before if
+            os.path.exists("/proc/%d" % pid)))
+
+        procs = node.spawn_many([['sleep', '100']] * 10)
+        self.assertEqual(sp.wait_any(procs, 0), [])
+        for p in procs:
+            p.signal()
+        self.assertEqual([p.wait() for p in procs], [-signal.SIGTERM] * 10)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_terminate_all(self):
+        nodes = [nemu.Node(), nemu.Node(direct_spawn = True)]
+        stubborn = 'trap "" TERM; echo; while :; do sleep 0.05; done'
+        r, w = compat.pipe()
+        procs = [n.Subprocess(stubborn, shell = True, stdout = w)
+                for n in nodes * 5]
+        os.close(w)
+        out = b""
+        while len(out) < 10: # wait for the traps to be installed
+            out += os.read(r, 10)
+        os.close(r)
+        procs += [n.Subprocess(['sleep', '100']) for n in nodes * 5]
+        procs.append(nodes[0].Subprocess('true'))
+        procs[-1].wait()
+
+        now = time.time()
+        log = io.StringIO()
+        nemu.environ.set_log_output(log)
+        try:
+            sp.terminate_all(procs, 0.5)
+        finally:
+            nemu.environ.set_log_output(sys.stderr)
+        # A single deadline for all of them
+        self.assertTrue(time.time() - now < 2)
+        self.assertEqual([p.returncode for p in procs],
+                [-signal.SIGKILL] * 10 + [-signal.SIGTERM] * 10 + [0])
+        self.assertEqual(log.getvalue().count("Killing forcefully"), 10)
+
+        # Same, for our own children
+        null = os.open("/dev/null", os.O_WRONLY)
+        pids = [sp.spawn('/bin/sh', ['sh', '-c', stubborn], stdout = null)
+                for i in range(5)]
+        os.close(null)
+        pids += [sp.spawn('sleep', ['sleep', '100']) for i in range(5)]
+        time.sleep(0.2)
+        now = time.time()
+        self.assertEqual(sp.terminate(pids, 0.5), sorted(pids[:5]))
+        self.assertTrue(time.time() - now < 2)
+        for pid in pids:
+            self.assertRaises(ChildProcessError, sp.poll, pid)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_profiles(self):
+        nobody = pwd.getpwnam('nobody')
+        # An empty environment is kept empty, but for the user's variables
+        self.assertEqual(sp.Profile(user = 'nobody', env = {}).env,
+                {'HOME': nobody[5], 'USER': 'nobody'})
+        for node in (nemu.Node(), nemu.Node(direct_spawn = True)):
+            self.assertRaises(ValueError, node.register_profile,
+                    user = self.nouser)
+            prof = node.register_profile(user = 'nobody', cwd = '/',
+                    env = {'PATH': os.environ['PATH'], 'FOO': 'bar'})
+            other = node.register_profile(cwd = '/tmp')
+            self.assertNotEqual(prof, other)
+
+            p = node.Popen('echo $FOO $USER $HOME; id -u; pwd', shell = True,
+                    stdout = sp.PIPE, profile = prof)
+            self.assertEqual(p.communicate()[0].decode().split(), ['bar',
+                'nobody', nobody[5], str(nobody[2]), '/'])
+            # Explicit arguments win
+            p = node.Popen(['pwd'], stdout = sp.PIPE, cwd = '/usr',
+                    profile = prof)
+            self.assertEqual(p.communicate()[0], b"/usr\n")
+            p = node.Popen(['pwd'], stdout = sp.PIPE, profile = other)
+            self.assertEqual(p.communicate()[0], b"/tmp\n")
+
+            r, w = compat.pipe()
+            procs = node.spawn_many([dict(argv = 'id -u', shell = True,
+                stdout = w, profile = prof)] * 3)
+            os.close(w)
+            self.assertEqual([p.wait() for p in procs], [0] * 3)
+            self.assertEqual(_readall(r), (b"%d\n" % nobody[2]) * 3)
+            os.close(r)
+
+            node.unregister_profile(prof)
+            self.assertRaises(RuntimeError, node.unregister_profile, prof)
+            self.assertRaises(RuntimeError, node.Subprocess, 'true',
+                    profile = prof)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_Popen_ring(self):
+        out = b"".join(b"%d\n" % i for i in range(1, 200001))
+        for node in (nemu.Node(), nemu.Node(lean = True),
+                nemu.Node(direct_spawn = True)):
+            # The program never waits for a reader
+            p = node.Popen(['seq', '200000'], stdout = sp.RING,
+                    ring_size = 1000)
+            self.assertEqual(p.wait(), 0)
+            self.assertEqual(p.stdout, None)
+            ring = p.stdout_ring
+            self.assertEqual(ring.size, 1000)
+            # The copy finishes after the program
+            while ring.written < len(out):
+                time.sleep(0.05)
+            self.assertEqual(ring.written, len(out))
+            self.assertEqual(ring.tail(), out[-1000:])
+            self.assertEqual(ring.tail(7), b"200000\n")
+            self.assertEqual(ring.tail(5000), out[-1000:])
+
+            p = node.Popen('echo out; echo err >&2; sleep 100', shell = True,
+                    stdout = sp.RING, stderr = sp.STDOUT)
+            self.assertTrue(p.stderr_ring is p.stdout_ring)
+            while p.stdout_ring.written < 8:
+                time.sleep(0.05)
+            self.assertEqual(sorted(p.stdout_ring.tail().split()),
+                    [b"err", b"out"])
+            p.signal()
+            p.wait()
+
+            rings = [sp.Ring(10) for i in range(5)]
+            self.assertEqual(rings[0].tail(), b"")
+            procs = node.spawn_many([dict(argv = ['echo', 'hi %d' % i],
+                stdout = rings[i], stderr = rings[i]) for i in range(5)])
+            self.assertEqual([p.wait() for p in procs], [0] * 5)
+            for i, ring in enumerate(rings):
+                while ring.written < 5:
+                    time.sleep(0.05)
+                self.assertEqual(ring.tail(), b"hi %d\n" % i)
+                ring.close()
+                self.assertRaises(ValueError, ring.fileno)
+
     def test_Popen(self):
         node = nemu.Node(nonetns = True)
 
@@ -309,6 +539,95 @@ class TestSubprocess(unittest.TestCase):
                 stdin = sp.PIPE, stdout = sp.PIPE, stderr = sp.PIPE)
         self.assertEqual(p.communicate(_longstring), (_longstring, ) * 2)
 
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_asyncio(self):
+        nodes = [nemu.Node(nonetns = True), nemu.Node(lean = True)]
+
+        async def run():
+            p = await nodes[0].create_subprocess_exec('cat',
+                    stdin = sp.PIPE, stdout = sp.PIPE, stderr = sp.PIPE)
+            self.assertEqual(await p.communicate(_longstring),
+                    (_longstring, b""))
+            self.assertEqual(p.returncode, 0)
+
+            p = await nodes[1].create_subprocess_shell('echo hello; exit 3',
+                    stdout = sp.PIPE)
+            self.assertEqual(await p.stdout.readline(), b"hello\n")
+            self.assertEqual(await p.wait(), 3)
+
+            # Many at once, with concurrent waiters
+            procs = [await n.create_subprocess_exec('sleep', '100')
+                    for n in nodes * 10]
+            waiters = [asyncio.ensure_future(p.wait()) for p in procs * 2]
+            await asyncio.sleep(0.1)
+            self.assertFalse(any(w.done() for w in waiters))
+            for p in procs:
+                p.terminate()
+            self.assertEqual(await asyncio.gather(*waiters),
+                    [-signal.SIGTERM] * 40)
+
+            # Reaped, and its descriptor closed, before the loop notices
+            p = await nodes[0].create_subprocess_exec('sleep', '100')
+            waiter = asyncio.ensure_future(p.wait())
+            await asyncio.sleep(0.1)
+            p.kill()
+            self.assertEqual(p._popen.wait(), -signal.SIGKILL)
+            self.assertEqual(await waiter, -signal.SIGKILL)
+
+        asyncio.run(run())
+
+    def test_Popen_streaming(self):
+        node = nemu.Node(nonetns = True)
+        big = os.urandom(1 << 16) * 40
+
+        # Larger than the pipe buffers, both ways
+        p = node.Popen('cat; cat >&2 < /dev/null; echo err >&2', shell = True,
+                stdin = sp.PIPE, stdout = sp.PIPE, stderr = sp.PIPE)
+        self.assertEqual(p.communicate(big), (big, b"err\n"))
+
+        # Straight to files
+        out = tempfile.TemporaryFile()
+        err = tempfile.TemporaryFile()
+        p = node.Popen('cat; echo err >&2', shell = True,
+                stdin = sp.PIPE, stdout = sp.PIPE, stderr = sp.PIPE)
+        self.assertEqual(p.communicate(big, stdout_file = out,
+            stderr_file = err.fileno()), (None, None))
+        self.assertEqual(p.returncode, 0)
+        out.seek(0)
+        err.seek(0)
+        self.assertEqual(out.read(), big)
+        self.assertEqual(err.read(), b"err\n")
+        out.close()
+        err.close()
+
+        # Appending: no splice(2) possible
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"head\n")
+            f.flush()
+            with open(f.name, "ab") as log:
+                p = node.Popen(['cat'], stdin = sp.PIPE, stdout = sp.PIPE)
+                self.assertEqual(p.communicate(_longstring,
+                    stdout_file = log), (None, None))
+            self.assertEqual(open(f.name, "rb").read(), b"head\n" +
+                    _longstring)
+
+        p = node.Popen(['cat'], stdin = sp.PIPE, stdout = sp.PIPE)
+        p.stdin.write(_longstring + b"no newline")
+        p.stdin.close()
+        chunks = list(p.iter_chunks(1000))
+        self.assertTrue(max(len(c) for c in chunks) <= 1000)
+        self.assertEqual(b"".join(chunks), _longstring + b"no newline")
+        self.assertEqual(p.wait(), 0)
+
+        p = node.Popen('seq 1 10000', shell = True, stdout = sp.PIPE)
+        lines = list(p.iter_lines(7))
+        self.assertEqual(lines, [b"%d\n" % i for i in range(1, 10001)])
+        self.assertEqual(p.wait(), 0)
+
+        p = node.Popen(['true'])
+        self.assertRaises(RuntimeError, next, p.iter_lines())
+        p.wait()
+
     def test_backticks(self):
         node = nemu.Node(nonetns = True)
         self.assertEqual(node.backticks("echo hello world"), "hello world\n")
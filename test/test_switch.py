@@ -43,6 +43,114 @@ class TestSwitch(unittest.TestCase):
         self.assertEqual(tcdata[i1.control.index], {"qdiscs": {}})
         self.assertEqual(tcdata[i2.control.index], {"qdiscs": {}})
 
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_switch_ports(self):
+        (n1, n2, i1, i2, l) = self.stuff
+        ifaces = n1.add_ifs(64)
+        for i in ifaces:
+            l.connect(i)
+        l.set_parameters(bandwidth = 13107200) # 100 mbits
+        l.up = True
+
+        # A port that goes away is forgotten
+        n2.del_if(i2)
+        l.mtu = 3000
+        self.assertEqual(i1.control.mtu, 3000)
+        self.assertEqual(sorted(l._ports.keys()), sorted(
+            [i1.control.index] + [i.control.index for i in ifaces]))
+
+        index = l.index
+        l.destroy()
+        ifdata = nemu.iproute.get_if_data()[0]
+        tcdata = nemu.iproute.get_tc_data()[0]
+        for i in [i1] + ifaces:
+            self.assertFalse(ifdata[i.control.index].up)
+            self.assertEqual(tcdata[i.control.index], {"qdiscs": {}})
+        self.assertTrue(index not in ifdata)
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_link_update(self):
+        (n1, n2, i1, i2, l) = self.stuff
+        n3 = nemu.Node()
+        i3 = n3.add_if()
+        i4 = n1.add_if()
+        l2 = nemu.Switch()
+        l2.connect(i3)
+        l2.connect(i4)
+
+        with nemu.link_update():
+            l.set_parameters(bandwidth = 13107200) # 100 mbits
+            l2.set_parameters(bandwidth = 13107200)
+            tcdata = nemu.iproute.get_tc_data()[0]
+            for i in (i1, i2, i3, i4):
+                self.assertEqual(tcdata[i.control.index], {"qdiscs": {}})
+        tcdata = nemu.iproute.get_tc_data()[0]
+        for i in (i1, i2, i3, i4):
+            self.assertEqual(tcdata[i.control.index],
+                    {"bandwidth": 13107000, "qdiscs": {"tbf": "1"}})
+
+        # A failure rolls back every switch
+        def update():
+            with nemu.link_update():
+                l.set_parameters()
+                l2.set_parameters(bandwidth = 13107200, delay = 0.001,
+                        delay_jitter = 0.001, delay_distribution = "bogus")
+        self.assertRaises(RuntimeError, update)
+        tcdata = nemu.iproute.get_tc_data()[0]
+        for i in (i1, i2, i3, i4):
+            self.assertEqual(tcdata[i.control.index],
+                    {"bandwidth": 13107000, "qdiscs": {"tbf": "1"}})
+
+        l.set_parameters()
+        tcdata = nemu.iproute.get_tc_data()[0]
+        self.assertEqual(tcdata[i1.control.index], {"qdiscs": {}})
+        self.assertEqual(tcdata[i3.control.index],
+                {"bandwidth": 13107000, "qdiscs": {"tbf": "1"}})
+
+    @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
+    def test_fabric_netns(self):
+        (n1, n2, i1, i2, l) = self.stuff
+        before = set(test_util.get_devs())
+        nemu.set_fabric_netns()
+        try:
+            i3 = n1.add_if()
+            i4 = n2.add_if()
+            l2 = nemu.Switch()
+        finally:
+            nemu.set_fabric_netns(False)
+        self.assertRaises(RuntimeError, l2.connect, i1)
+        self.assertRaises(RuntimeError, l.connect, i3)
+        l2.connect(i3)
+        l2.connect(i4)
+        l2.mtu = 3000
+        l2.up = True
+        self.assertEqual(set(test_util.get_devs()), before)
+
+        fabric = l2._fabric
+        ifdata = fabric.netlink.get_if_data()[0]
+        for i in (i3, i4):
+            self.assertEqual(ifdata[i.control.index].mtu, 3000)
+            self.assertTrue(ifdata[i.control.index].up)
+            self.assertEqual(i.control.mtu, 3000)
+        self.assertEqual((l2.stp, l2.forward_delay), (False, 0))
+        l2.configure(forward_delay = 4, stp = True)
+        self.assertEqual((l2.stp, l2.forward_delay), (True, 4))
+        self.assertEqual(sorted(fabric.netlink.get_bridge_ports(l2.index)),
+                sorted([i3.control.index, i4.control.index]))
+
+        l2.set_parameters(bandwidth = 13107200) # 100 mbits
+        tcdata = fabric._node._slave.get_tc_data()
+        for i in (i3, i4):
+            self.assertEqual(tcdata[i.control.index],
+                    {"bandwidth": 13107000, "qdiscs": {"tbf": "1"}})
+
+        l2.disconnect(i4)
+        self.assertEqual(fabric.netlink.get_bridge_ports(l2.index),
+                [i3.control.index])
+        l2.destroy()
+        self.assertEqual(set(fabric.netlink.get_if_data()[1]),
+                set(["lo", i3.control.name, i4.control.name]))
+
     @test_util.skipUnless(os.getuid() == 0, "Test requires root privileges")
     def test_switch_changes(self):
         (n1, n2, i1, i2, l) = self.stuff